@@ -0,0 +1,93 @@
+# Peri-event alignment of spike trains.
+#
+# See LICENSE.TXT that came with this file.
+
+import numpy as np
+
+def trial_ranges(spikes, starts, stops):
+    """
+    trial_ranges(spikes, starts, stops) -> (firsts, lasts)
+
+    Index ranges of the spikes in the trials. The spikes of trial i are
+    spikes[firsts[i]:lasts[i]], the spikes in [starts[i], stops[i]). spikes are sorted,
+    the trials may overlap and need not be sorted. Each trial costs two binary searches.
+    """
+    firsts = np.searchsorted(spikes, starts, side='left')
+    lasts = np.maximum(np.searchsorted(spikes, stops, side='left'), firsts)
+    return firsts, lasts
+
+def align_spikes(spikes, triggers, begin, end, limits=None):
+    """
+    align_spikes(spikes, triggers, begin, end, limits=None) -> (offsets, times)
+
+    Align sorted spikes to triggers as a ragged raster. Trial i takes the spikes in
+    [triggers[i]+begin, triggers[i]+end) that are also before limits[i] if limits are
+    given. times[offsets[i]:offsets[i+1]] are the spike times of trial i relative to its
+    trigger in the order of the spikes. All times are in ticks. The cost is
+    O((spikes + triggers) log spikes) without a loop over the trials.
+    Parameters
+    ----------
+    spikes: array
+        sorted spike timestamps
+    triggers: array
+        trigger timestamps
+    begin, end: int
+        window of a trial relative to its trigger
+    limits: array
+        optional timestamps ending the trials earlier than their windows
+    Returns
+    -------
+    offsets: int64 array of len(triggers)+1
+        beginning of every trial in times, offsets[-1] is len(times)
+    times: array
+        spike times relative to the triggers
+    """
+    triggers = np.asarray(triggers, dtype=np.int64)
+    stops = triggers + end
+    if limits is not None:
+        stops = np.minimum(stops, limits)
+    firsts, lasts = trial_ranges(spikes, triggers + begin, stops)
+    counts = lasts - firsts
+    offsets = np.zeros(len(triggers) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    # the spike indices of all trials as one array of consecutive ranges
+    trials = np.repeat(np.arange(len(triggers)), counts)
+    indices = np.arange(offsets[-1]) + (firsts - offsets[:-1])[trials]
+    return offsets, spikes[indices] - triggers[trials]
+
+def align_population(trains, triggers, begin, end, limits=None):
+    """
+    align_population(trains, triggers, begin, end, limits=None) -> (units, trials, times)
+
+    Align the sorted spike trains of several units to the triggers like align_spikes and
+    concatenate the rasters with a unit column. Only the aligned spikes are gathered, so
+    the cost does not grow with the spikes outside the trials. Returns the unit index in
+    trains, the trial index and the time relative to the trigger of every aligned spike,
+    sorted by unit and trial.
+    """
+    triggers = np.asarray(triggers, dtype=np.int64)
+    rasters = [align_spikes(train, triggers, begin, end, limits) for train in trains]
+    if not rasters:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    trial_counts = np.concatenate([np.diff(offsets) for offsets, _times in rasters])
+    pairs = np.repeat(np.arange(len(trial_counts)), trial_counts)
+    times = np.concatenate([times for _offsets, times in rasters])
+    return pairs // max(len(triggers), 1), pairs % max(len(triggers), 1), times
+
+def bin_times(times, edges):
+    """
+    bin_times(times, edges) -> bins
+
+    Bin index of every time like np.histogram with the sorted bin edges. The last bin
+    includes its right edge and times outside the edges get -1.
+    """
+    steps = np.diff(edges)
+    if len(steps) and np.all(steps == steps[0]):
+        # equal bins in ticks are found by integer division
+        bins = (times - edges[0]) // steps[0]
+    else:
+        bins = np.searchsorted(edges, times, side='right') - 1
+    bins[times == edges[-1]] = len(edges) - 2
+    bins[(times < edges[0]) | (times > edges[-1])] = -1
+    return bins
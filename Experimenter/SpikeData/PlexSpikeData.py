@@ -4,13 +4,59 @@
 # 
 # See LICENSE.TXT that came with this file.
 
-from SpikeRecord.Plexon.PlexClient import PlexClient
+import numpy as np
+from SpikeRecord.Plexon.PlexHub import get_hub
 from SpikeRecord.Plexon.PlexFile import PlexFile
+from SpikeRecord.Plexon.PlexStore import PlexStore, is_store
 from SpikeRecord.Plexon.PlexUtil import PlexUtil
 
+# initial capacity of a GrowableArray
+GROWABLE_CAPACITY = 1024
+
+class GrowableArray(object):
+    """
+    One-dimensional array growing at its end with amortized constant cost per value.
+
+    The values are kept in a buffer that doubles its capacity when it is full, instead
+    of copying the whole history on every np.append. Values can also be discarded from
+    the beginning to use the array as a queue. view() returns the values as a plain
+    ndarray sharing the buffer. The buffer is only written after the values and is 
+    replaced when it is full, so a view keeps its values while the array grows.
+    """
+    def __init__(self, dtype, capacity=GROWABLE_CAPACITY):
+        self.buffer = np.empty(capacity, dtype=dtype)
+        self.begin = 0
+        self.end = 0
+        
+    def __len__(self):
+        return self.end - self.begin
+    
+    def append(self, values):
+        count = len(values)
+        if self.end + count > len(self.buffer):
+            size = len(self) + count
+            capacity = len(self.buffer)
+            while capacity < size:
+                capacity *= 2
+            buffer = np.empty(capacity, dtype=self.buffer.dtype)
+            buffer[:len(self)] = self.view()
+            self.buffer = buffer
+            self.end -= self.begin
+            self.begin = 0
+        self.buffer[self.end:self.end+count] = values
+        self.end += count
+        
+    def discard(self, count):
+        # drop count values from the beginning
+        self.begin = min(self.begin + count, self.end)
+        
+    def view(self):
+        return self.buffer[self.begin:self.end]
+
 class PlexSpikeData(object):
-    # Base class handling spike records online or offline from Plexon.
-    def __init__(self, filename=None):
+    # Base class handling spike records online or offline from Plexon. With index_cache
+    # the block index of a plx file is cached in a sidecar file next to it.
+    def __init__(self, filename=None, client=None, follow=False, word_window=0, index_cache=False):
         self.online = True
         self.data = None
         self.data_type = None
@@ -22,15 +68,28 @@ class PlexSpikeData(object):
         
         self.pc = None
         self.pf = None
+        self.file_chunks = None
+        self.next_chunk = None
         
         if filename is None:
-            self.pc = PlexClient()
+            # All spike data in the process share the server stream through the hub. client
+            # stands in for it, e.g. a PlexReplayClient replaying a file.
+            self.pc = get_hub().subscribe() if client is None else client
             self.pc.InitClient()
+        elif follow:
+            # a plx file still being recorded is read incrementally like the server
+            self.pc = PlexFile(filename, follow=True)
         else:
             self.read_from_server = False
             self.read_from_file = True
-            self.pf = PlexFile(filename)
-        self.pu = PlexUtil()
+            # filename is either a plx file or a store converted from it
+            if is_store(filename):
+                self.pf = PlexStore(filename)
+            else:
+                self.pf = PlexFile(filename, index_cache=index_cache)
+        # unstrobed bits of a trigger word may be up to word_window ticks apart
+        self.pu = PlexUtil(word_window)
+        self.timestamp_frequency = None
         self.renew_data()
 
     def __del__(self):
@@ -50,14 +109,72 @@ class PlexSpikeData(object):
     def get_data_type(self):
         return self.data_type
     
+    def get_timestamp_frequency(self):
+        # timestamps are in ticks of the server or the file, convert with this frequency to seconds
+        if self.timestamp_frequency is None:
+            source = self.pc if self.read_from_server else self.pf
+            self.timestamp_frequency = source.GetTimeStampFrequency()
+        return self.timestamp_frequency
+    
+    def to_ticks(self, seconds):
+        return int(round(seconds * self.get_timestamp_frequency()))
+    
+    def to_seconds(self, ticks):
+        return ticks / float(self.get_timestamp_frequency())
+    
     def _update_data(self,callback=None):
         if self.read_from_server:
             self.data = self.pc.GetTimeStampArrays()
             self.online = True
         elif self.read_from_file and not self.file_has_read:
-            self.data = self.pf.GetTimeStampArrays(callback)
-            self.online = False
-            self.file_has_read = True
+            # The file is read in chunks with one chunk of lookahead. A chunk followed by 
+            # others is processed like an online read so that events split across chunks 
+            # are joined, and the last chunk is processed like a whole file.
+            if self.file_chunks is None:
+                self.file_chunks = self.pf.iter_events(callback=callback)
+                self.next_chunk = next(self.file_chunks, None)
+            if self.next_chunk is None:
+                self.data = self.pf.GetNullTimeStamp()
+            else:
+                self.data = self.next_chunk
+            self.next_chunk = next(self.file_chunks, None)
+            self.online = self.next_chunk is not None
+            self.file_has_read = self.next_chunk is None
         elif self.file_has_read:
             self.data = self.pf.GetNullTimeStamp()
-            self.online = False
\ No newline at end of file
+            self.online = False
+    
+    def _get_triggers(self):
+        # Stimulus triggers of the current data as {'value', 'timestamp'}. Strobed words
+        # are used if there are any, otherwise the words of the unstrobed bits. The external
+        # events of the data are split once for both kinds.
+        triggers = self.pu.GetExtEvents(self.data, event='first_strobe_word')
+        if len(triggers['value']) == 0:
+            triggers = self.pu.GetExtEvents(self.data, event='unstrobed_word', online=self.online)
+        return triggers
+    
+    def _renew_spike_trains(self):
+        # spike_trains[channel][unit] is a view of the spike buffer of the unit
+        self.spike_trains = {}
+        self.spike_buffers = {}
+        
+    def _append_spike_trains(self, new_spike_trains):
+        for channel,channel_trains in new_spike_trains.iteritems():
+            channel_buffers = self.spike_buffers.setdefault(channel, {})
+            spike_trains = self.spike_trains.setdefault(channel, {})
+            for unit,unit_train in channel_trains.iteritems():
+                if unit not in channel_buffers:
+                    channel_buffers[unit] = GrowableArray(unit_train.dtype)
+                channel_buffers[unit].append(unit_train)
+                spike_trains[unit] = channel_buffers[unit].view()
+    
+    def _update_all_data(self,callback=None,process=None):
+        # Update data until all data available is read. A file is read and processed 
+        # chunk by chunk so that only one chunk of events is in memory at a time.
+        self._update_data(callback)
+        if process is not None:
+            process()
+        while self.read_from_file and not self.file_has_read:
+            self._update_data(callback)
+            if process is not None:
+                process()
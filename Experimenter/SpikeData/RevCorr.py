@@ -5,44 +5,30 @@
 # See LICENSE.TXT that came with this file.
 
 import numpy as np
-from PlexSpikeData import PlexSpikeData
+from PlexSpikeData import PlexSpikeData, GrowableArray
+from PeriEvent import trial_ranges
 
 class RevCorrData(PlexSpikeData):
     def __init__(self, *args,**kwargs):
         super(RevCorrData, self).__init__(*args,**kwargs)
-        self.spike_trains = {}
-        self.x_indices = np.empty(0,dtype=np.int16)
-        self.y_indices = np.empty(0,dtype=np.int16)
-        self.timestamps = np.empty(0)
         self.new_triggers = None
         
     def renew_data(self):
-        self.spike_trains = {}
-        self.x_indices = np.empty(0,dtype=np.int16)
-        self.y_indices = np.empty(0,dtype=np.int16)
-        self.timestamps = np.empty(0)
+        self._renew_spike_trains()
+        self.x_indices = GrowableArray(np.int16)
+        self.y_indices = GrowableArray(np.int16)
+        self.timestamps = GrowableArray(np.int64)
         self.new_triggers = None
 
     def _update_data(self,callback=None):
         super(RevCorrData, self)._update_data(callback)
-        self.new_triggers = self.pu.GetExtEvents(self.data, event='first_strobe_word')
-        if len(self.new_triggers['value']) == 0:
-            self.new_triggers = self.pu.GetExtEvents(self.data, event='unstrobed_word', online=self.online)
-        new_spike_trains = self.pu.GetSpikeTrains(self.data)
-            
-        for channel,channel_trains in new_spike_trains.iteritems():
-            if channel not in self.spike_trains:
-                self.spike_trains[channel] = channel_trains
-            else:
-                for unit,unit_train in channel_trains.iteritems():
-                    if unit not in self.spike_trains[channel]:
-                        self.spike_trains[channel][unit] = unit_train
-                    else:
-                        self.spike_trains[channel][unit] = np.append(self.spike_trains[channel][unit], unit_train)
+        self.new_triggers = self._get_triggers()
+        self._append_spike_trains(self.pu.GetSpikeTrains(self.data))
     def get_data(self,callback=None):
-        self._update_data(callback)
+        self._update_all_data(callback)
         data = {'spikes':self.spike_trains, 
-                'x_indices':self.x_indices,'y_indices':self.y_indices,'timestamps':self.timestamps}
+                'x_indices':self.x_indices.view(),'y_indices':self.y_indices.view(),'timestamps':self.timestamps.view(),
+                'timestamp_frequency':self.get_timestamp_frequency()}
         return data
     
     def get_img(self, data, channel, unit, dimension, tau, img_format, cmap):
@@ -151,7 +137,7 @@ class STAData(RevCorrData):
 
     def renew_data(self):
         super(STAData, self).renew_data()
-        self.contrast = np.empty(0,dtype=np.int16)
+        self.contrast = GrowableArray(np.int16)
 
     def _update_data(self,callback=None):
         super(STAData,self)._update_data(callback)
@@ -160,14 +146,14 @@ class STAData(RevCorrData):
         x_index = (trigger_values & self.X_INDEX<<self.X_BIT_SHIFT)>>self.X_BIT_SHIFT
         y_index = (trigger_values & self.Y_INDEX<<self.Y_BIT_SHIFT)>>self.Y_BIT_SHIFT
         contrast = (trigger_values & self.CONTRAST<<self.CONTRAST_BIT_SHIFT)>>self.CONTRAST_BIT_SHIFT
-        self.x_indices = np.append(self.x_indices, x_index)
-        self.y_indices = np.append(self.y_indices, y_index)
-        self.contrast = np.append(self.contrast, contrast)
-        self.timestamps = np.append(self.timestamps, trigger_timestamps)
+        self.x_indices.append(x_index)
+        self.y_indices.append(y_index)
+        self.contrast.append(contrast)
+        self.timestamps.append(trigger_timestamps)
 
     def get_data(self,callback=None):
         data = super(STAData,self).get_data(callback)
-        data['contrast'] = self.contrast
+        data['contrast'] = self.contrast.view()
         return data
     
     def get_img(self, data, channel, unit, tau=0.085, img_format='rgb', cmap='jet', dimension=(32,32)):
@@ -199,20 +185,26 @@ class STAImg(RevCorrImg):
         rows = data['y_indices']
         contrast = data['contrast']
         timestamps = data['timestamps']
+        # spikes and timestamps are in ticks
+        frequency = data['timestamp_frequency']
         
         img = np.zeros(dimension)
         if len(timestamps)>1:
             spikes = spike_trains[channel][unit]
-            triggered_stim = spikes - tau
+            triggered_stim = spikes - int(round(tau*frequency))
             stim_times = np.zeros(timestamps.size-1, np.dtype('int'))
+            # spikes during every stimulus frame, i.e. from a trigger to the next
             for time in np.linspace(-0.01, 0.01, 3):
-                stim_times += np.histogram(triggered_stim, timestamps+time)[0]
+                frames = timestamps + int(round(time*frequency))
+                firsts, lasts = trial_ranges(triggered_stim, frames[:-1], frames[1:])
+                stim_times += lasts - firsts
             #stim_times = np.histogram(triggered_stim, timestamps)[0]
             take = stim_times > 0
             triggered_times = stim_times[take]
-            col = cols[take]
-            row = rows[take]
-            ctr = contrast[take]
+            # the last trigger only ends the frame before it
+            col = cols[:-1][take]
+            row = rows[:-1][take]
+            ctr = contrast[:-1][take]
             ctr[ctr==0] = -1
             for index,times in enumerate(triggered_times):
                 col_index = col[index]
@@ -243,9 +235,9 @@ class ParamMapData(RevCorrData):
         trigger_timestamps = self.new_triggers['timestamp']
         x_index = (trigger_values & self.X_INDEX<<self.X_BIT_SHIFT)>>self.X_BIT_SHIFT
         y_index = (trigger_values & self.Y_INDEX<<self.Y_BIT_SHIFT)>>self.Y_BIT_SHIFT
-        self.x_indices = np.append(self.x_indices, x_index)
-        self.y_indices = np.append(self.y_indices, y_index)
-        self.timestamps = np.append(self.timestamps, trigger_timestamps)
+        self.x_indices.append(x_index)
+        self.y_indices.append(y_index)
+        self.timestamps.append(trigger_timestamps)
     def get_data(self,callback=None):
         data = super(ParamMapData,self).get_data(callback)
         return data
@@ -262,17 +254,20 @@ class ParamMapIMG(RevCorrImg):
         cols = data['x_indices']
         rows = data['y_indices']
         timestamps = data['timestamps']
+        # spikes and timestamps are in ticks
+        frequency = data['timestamp_frequency']
         img = np.zeros(dimension)
         
         if len(timestamps)>1:
             spikes = spike_trains[channel][unit]
-            triggered_stim = spikes - tau
-            stim_times, _bins = np.histogram(triggered_stim, timestamps)
+            triggered_stim = spikes - int(round(tau*frequency))
+            firsts, lasts = trial_ranges(triggered_stim, timestamps[:-1], timestamps[1:])
+            stim_times = lasts - firsts
             take = stim_times > 0
             triggered_times = stim_times[take]
             
-            col = cols[take]
-            row = rows[take]
+            col = cols[:-1][take]
+            row = rows[:-1][take]
             for index,times in enumerate(triggered_times):
                 col_index = col[index]
                 row_index = row[index]
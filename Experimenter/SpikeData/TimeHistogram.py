@@ -5,9 +5,276 @@
 # See LICENSE.TXT that came with this file.
 
 import logging
+import collections
 import numpy as np
 import scipy.ndimage as nd
-from PlexSpikeData import PlexSpikeData
+from PlexSpikeData import PlexSpikeData, GrowableArray
+from PeriEvent import align_population, bin_times
+
+class PopulationPSTH(object):
+    """
+    PSTHs of all units and stimulus conditions accumulated in one count tensor.
+
+    counts[row, column, bin] are the spike counts of the unit of a row in the condition 
+    of a column, trials[row, column] the numbers of trials and rate_sums and 
+    rate_sum_squares the running sums of the trial mean rates. A batch of trials aligns
+    the spikes of all units at once and adds them to the tensor with one np.bincount.
+    get_result() takes a PSTHTuningResult of the trials so far.
+    Parameters
+    ----------
+    bins: array
+        bin edges in seconds
+    binsize: float
+        bin width in seconds
+    duration: float
+        duration of a trial in seconds
+    frequency: int
+        timestamp frequency of the spikes
+    conditions: list of int
+        consecutive condition indices
+    """
+    def __init__(self, bins, binsize, duration, frequency, conditions, sigma=5):
+        self.bins = bins
+        self.binsize = binsize
+        self.frequency = frequency
+        self.sigma = sigma
+        self.bin_ticks = np.round(bins * frequency).astype(np.int64)
+        self.duration_ticks = int(round(duration * frequency))
+        self.conditions = np.asarray(conditions)
+        self.units = []
+        self.rows = {}
+        self.counts = np.zeros((0, len(conditions), len(bins)-1),dtype=np.int64)
+        self.trials = np.zeros((0, len(conditions)),dtype=np.int64)
+        self.rate_sums = np.zeros((0, len(conditions)))
+        self.rate_sum_squares = np.zeros((0, len(conditions)))
+        # cell row*columns+column and time in seconds of every aligned spike
+        self.spike_cells = GrowableArray(np.int64)
+        self.spike_times = GrowableArray(np.float64)
+        self.result = None
+        
+    def _add_units(self, units):
+        new_units = [unit for unit in units if unit not in self.rows]
+        for unit in new_units:
+            self.rows[unit] = len(self.units)
+            self.units.append(unit)
+        if new_units:
+            grow = lambda array: np.concatenate((array, np.zeros((len(new_units),) + array.shape[1:], dtype=array.dtype)))
+            self.counts = grow(self.counts)
+            self.trials = grow(self.trials)
+            self.rate_sums = grow(self.rate_sums)
+            self.rate_sum_squares = grow(self.rate_sum_squares)
+        
+    def add_trials(self, spike_trains, begins, ends, conditions):
+        """
+        add_trials(spike_trains, begins, ends, conditions)
+
+        Add trials beginning at begins in ticks and ending before ends to the PSTHs of
+        all units in spike_trains. Every unit takes part in every trial.
+        """
+        units = sorted((channel, unit) for channel,channel_trains in spike_trains.iteritems() for unit in channel_trains)
+        self._add_units(units)
+        rows = np.array([self.rows[unit] for unit in units],dtype=np.int64)
+        columns = np.asarray(conditions,dtype=np.int64) - self.conditions[0]
+        trials = len(columns)
+        unit_indices, trial_indices, times = align_population([spike_trains[channel][unit] for channel,unit in units],
+                                                              begins, 0, self.duration_ticks, ends)
+        bin_indices = bin_times(times, self.bin_ticks)
+        binned = bin_indices >= 0
+        columns_count, bins_count = self.counts.shape[1:]
+        cells = rows[unit_indices] * columns_count + columns[trial_indices]
+        # the arrays are replaced rather than updated in place so results taken before stay as they are
+        self.counts = self.counts + np.bincount(cells[binned] * bins_count + bin_indices[binned], 
+                                                minlength=self.counts.size).reshape(self.counts.shape)
+        # every unit takes part in every trial
+        pair_cells = (rows[:,np.newaxis] * columns_count + columns).ravel()
+        pair_counts = np.bincount((unit_indices * trials + trial_indices)[binned], minlength=len(pair_cells))
+        rates = pair_counts / (self.binsize * bins_count)
+        self.trials = self.trials + np.bincount(pair_cells, minlength=self.trials.size).reshape(self.trials.shape)
+        self.rate_sums = self.rate_sums + np.bincount(pair_cells, rates, minlength=self.trials.size).reshape(self.trials.shape)
+        self.rate_sum_squares = self.rate_sum_squares + \
+                                np.bincount(pair_cells, rates*rates, minlength=self.trials.size).reshape(self.trials.shape)
+        self.spike_cells.append(cells)
+        self.spike_times.append(times / float(self.frequency))
+        self.result = None
+    
+    def get_result(self):
+        """
+        get_result() -> result
+
+        PSTHTuningResult of the trials added so far. It shares the arrays of the 
+        population, which are not changed by later trials, and is kept until then.
+        """
+        if self.result is None:
+            self.result = PSTHTuningResult(self.bins, self.binsize, list(self.units), self.conditions, self.counts, 
+                                           self.trials, self.rate_sums, self.rate_sum_squares, 
+                                           self.spike_cells.view(), self.spike_times.view(), self.sigma)
+        return self.result
+
+class PSTHTuningResult(collections.Mapping):
+    """
+    Dense PSTH tuning data of all units and stimulus conditions.
+
+    counts[row, column, bin] are the spike counts of units[row] in the condition 
+    conditions[column], trials[row, column] the numbers of trials and mean[row, column] 
+    and std[row, column] the mean of the smoothed PSTH and the standard deviation of the
+    trial mean rates. Cells without trials have nan mean and std. rows maps (channel, unit)
+    to its row and columns a condition to its column. spike_times are the times in seconds
+    of the spikes in the trials sorted by cell row*columns+column, the spikes of a cell are 
+    spike_times[spike_offsets[cell]:spike_offsets[cell+1]]. The spikes are sorted when 
+    they are first read. It is pickled as these arrays.
+
+    The result is also read like the nested histogram data dictionary 
+    result[channel][unit][condition][key] with the keys of PSTHView. Only the 
+    conditions with trials of a unit are listed.
+    """
+    def __init__(self, bins, binsize, units, conditions, counts, trials, rate_sums, rate_sum_squares, 
+                 spike_cells, spike_times, sigma=5):
+        self.bins = bins
+        self.binsize = binsize
+        self.sigma = sigma
+        self.units = units
+        self.conditions = conditions
+        self.rows = dict((unit, row) for row,unit in enumerate(units))
+        self.columns = dict((condition, column) for column,condition in enumerate(conditions))
+        self.counts = counts
+        self.trials = trials
+        # the cell of every spike until the spikes are sorted
+        self.spike_cells = spike_cells
+        self.spike_times = spike_times
+        self.spike_offsets = None
+        with np.errstate(invalid='ignore', divide='ignore'):
+            psth_data = counts / (binsize*trials[...,np.newaxis])
+            self.mean = np.mean(nd.gaussian_filter1d(psth_data, sigma=sigma, axis=-1), axis=-1)
+            mean_rates = rate_sums / trials
+            self.std = np.sqrt(np.maximum(rate_sum_squares / trials - mean_rates * mean_rates, 0.0))
+        self.channels = {}
+        for channel,unit in units:
+            self.channels.setdefault(channel, []).append(unit)
+    
+    def get_spikes(self, row, column):
+        """
+        get_spikes(row, column) -> spikes
+
+        Spike times in seconds relative to the trial begins of a unit in a condition.
+        """
+        self._sort_spikes()
+        cell = row * len(self.conditions) + column
+        return self.spike_times[self.spike_offsets[cell]:self.spike_offsets[cell+1]]
+    
+    def _sort_spikes(self):
+        if self.spike_offsets is not None:
+            return
+        # a stable sort keeps the spikes of a cell in the order of the trials
+        order = np.argsort(self.spike_cells, kind='mergesort')
+        self.spike_times = self.spike_times[order]
+        self.spike_offsets = np.zeros(self.counts.shape[0] * self.counts.shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.spike_cells, minlength=len(self.spike_offsets)-1), out=self.spike_offsets[1:])
+        self.spike_cells = None
+    
+    def __getstate__(self):
+        self._sort_spikes()
+        return self.__dict__
+    
+    def __getitem__(self, channel):
+        if channel not in self.channels:
+            raise KeyError(channel)
+        return PSTHChannelData(self, channel)
+    
+    def __iter__(self):
+        return iter(self.channels)
+    
+    def __len__(self):
+        return len(self.channels)
+
+class PSTHChannelData(collections.Mapping):
+    """
+    Units of a channel of a PSTHTuningResult read as result[channel].
+    """
+    def __init__(self, result, channel):
+        self.result = result
+        self.channel = channel
+    
+    def __getitem__(self, unit):
+        if (self.channel, unit) not in self.result.rows:
+            raise KeyError(unit)
+        return PSTHUnitData(self.result, self.result.rows[self.channel, unit])
+    
+    def __iter__(self):
+        return iter(self.result.channels[self.channel])
+    
+    def __len__(self):
+        return len(self.result.channels[self.channel])
+
+class PSTHUnitData(collections.Mapping):
+    """
+    Conditions with trials of a unit of a PSTHTuningResult read as result[channel][unit].
+    """
+    def __init__(self, result, row):
+        self.result = result
+        self.row = row
+    
+    def __getitem__(self, condition):
+        column = self.result.columns.get(condition)
+        if column is None or not self.result.trials[self.row, column]:
+            raise KeyError(condition)
+        return PSTHView(self.result, self.row, column)
+    
+    def __iter__(self):
+        columns = np.flatnonzero(self.result.trials[self.row])
+        return iter([int(condition) for condition in self.result.conditions[columns]])
+    
+    def __len__(self):
+        return int(np.count_nonzero(self.result.trials[self.row]))
+
+class PSTHView(collections.Mapping):
+    """
+    PSTH data of one unit and stimulus condition of a PSTHTuningResult.
+
+    It is read like the psth data dictionary with the keys 'trials', 'counts', 'bins', 
+    'spikes', 'psth_data', 'smooth_psth', 'mean' and 'std'. The values are computed when
+    they are first read and kept. It is pickled as a plain dictionary.
+    """
+    KEYS = ('trials', 'counts', 'bins', 'spikes', 'psth_data', 'smooth_psth', 'mean', 'std')
+    def __init__(self, result, row, column):
+        self.result = result
+        self.row = row
+        self.column = column
+        self.values = {}
+    
+    def __getitem__(self, key):
+        if key not in self.values:
+            self.values[key] = self._compute(key)
+        return self.values[key]
+    
+    def _compute(self, key):
+        result = self.result
+        cell = (self.row, self.column)
+        if key == 'trials':
+            return int(result.trials[cell])
+        elif key == 'counts':
+            return result.counts[cell].copy()
+        elif key == 'bins':
+            return result.bins
+        elif key == 'spikes':
+            return result.get_spikes(*cell)
+        elif key == 'psth_data':
+            return np.array(self['counts'],dtype='float') / (result.binsize*self['trials'])
+        elif key == 'smooth_psth':
+            return nd.gaussian_filter1d(self['psth_data'], sigma=result.sigma)
+        elif key == 'mean':
+            return result.mean[cell]
+        elif key == 'std':
+            return result.std[cell]
+        raise KeyError(key)
+    
+    def __iter__(self):
+        return iter(PSTHView.KEYS)
+    
+    def __len__(self):
+        return len(PSTHView.KEYS)
+    
+    def __reduce__(self):
+        return (dict, (dict(self),))
 
 class PSTHTuning(PlexSpikeData):
     ORI_MASK = 0xF<<0
@@ -20,29 +287,28 @@ class PSTHTuning(PlexSpikeData):
     def __init__(self, *args,**kwargs):
         super(PSTHTuning, self).__init__(*args,**kwargs)
         self.data_type = 'psth_tuning'
-        self.param_indices = np.empty(0,dtype=np.int16)
-        self.timestamps = np.empty(0)
+        self.param_indices = GrowableArray(np.int16)
+        self.timestamps = GrowableArray(np.int64)
         self.parameter = None
-        self.spike_trains = {}
-        self.histogram_data = {}
+        self._renew_spike_trains()
+        self.population = None
+        self.pending_trials = []
         
     def renew_data(self):
-        self.param_indices = np.empty(0,dtype=np.int16)
-        self.timestamps = np.empty(0)
-        self.spike_trains = {}
-        self.histogram_data = {}
+        self.param_indices = GrowableArray(np.int16)
+        self.timestamps = GrowableArray(np.int64)
+        self._renew_spike_trains()
+        self.population = None
+        self.pending_trials = []
     
     def get_data(self,callback=None):
-        self._update_data(callback)
-        self._get_psth_data()
-        return self.histogram_data
+        self._update_all_data(callback, self._get_psth_data)
+        return self._get_population().get_result()
     
     def _update_data(self,callback=None):
         super(PSTHTuning, self)._update_data(callback)
             
-        new_triggers = self.pu.GetExtEvents(self.data, event='first_strobe_word')
-        if len(new_triggers['value']) == 0:
-            new_triggers = self.pu.GetExtEvents(self.data, event='unstrobed_word', online=self.online)
+        new_triggers = self._get_triggers()
         trigger_values = new_triggers['value']
         
         take_mono = trigger_values & PSTHTuning.MONO_MASK == PSTHTuning.MONO_MASK
@@ -74,161 +340,142 @@ class PSTHTuning(PlexSpikeData):
         # [0, 15] for tuning stimulus parameters
         # 16 for monocular right stimulus
         # 17 for monocular right stimulus
-        self.param_indices = np.append(self.param_indices, param_indices)
-        self.timestamps = np.append(self.timestamps, new_triggers['timestamp'])
+        self.param_indices.append(param_indices)
+        self.timestamps.append(new_triggers['timestamp'])
         
-        new_spike_trains = self.pu.GetSpikeTrains(self.data)
-        for channel,channel_trains in new_spike_trains.iteritems():
-            if channel not in self.spike_trains:
-                self.spike_trains[channel] = channel_trains
-            else:
-                for unit,unit_train in channel_trains.iteritems():
-                    if unit not in self.spike_trains[channel]:
-                        self.spike_trains[channel][unit] = unit_train
-                    else:
-                        self.spike_trains[channel][unit] = np.append(self.spike_trains[channel][unit], unit_train)
+        self._append_spike_trains(self.pu.GetSpikeTrains(self.data))
     
     def _get_psth_data(self):
         logger = logging.getLogger('Experimenter.TimeHistogram')
         # process all on segments before the off segments in the timestamp queue
-        off_indices = np.nonzero(self.param_indices == -1)
+        param_indices = self.param_indices.view()
+        timestamps = self.timestamps.view()
+        off_indices = np.nonzero(param_indices == -1)
         while np.any(off_indices[0]):     # have any stimulus on segment
-            if self.param_indices[0] < 0: # remove the beginning off segment
-                on_indices = np.nonzero(self.param_indices > -1)
-                param_index = self.param_indices[0]
-                off_begin = self.timestamps[off_indices[0][0]]
+            if param_indices[0] < 0: # remove the beginning off segment
+                on_indices = np.nonzero(param_indices > -1)
+                param_index = param_indices[0]
+                off_begin = timestamps[off_indices[0][0]]
                 if np.any(on_indices[0]):
-                    off_end = self.timestamps[on_indices[0][0]-1]
+                    off_end = timestamps[on_indices[0][0]-1]
+                elif self.read_from_file and self.online:
+                    break   # the off segment may continue in the next chunk of the file
                 else:
-                    off_end = self.timestamps[off_indices[0][-1]]
+                    off_end = timestamps[off_indices[0][-1]]
                 if off_end > off_begin:
-                    logger.info('Processing background activity at duration %.2f:%.2f' %(off_begin, off_end))
+                    logger.info('Processing background activity at duration %.2f:%.2f' 
+                                %(self.to_seconds(off_begin), self.to_seconds(off_end)))
                     self._process_psth_data(off_begin, off_end, param_index)
-                on_indices = np.nonzero(self.param_indices >= 0)
+                on_indices = np.nonzero(param_indices >= 0)
                 if any(on_indices[0]):
-                    self.param_indices = self.param_indices[on_indices[0][0]:]
-                    self.timestamps = self.timestamps[on_indices[0][0]:]
+                    self._discard_triggers(on_indices[0][0])
                 else:
-                    self.param_indices = np.empty(0,dtype=np.int16)
-                    self.timestamps = np.empty(0)
+                    self._discard_triggers(len(param_indices))
             else:
-                if np.any(self.param_indices[1:off_indices[0][0]] != self.param_indices[:off_indices[0][0]-1]):
+                if np.any(param_indices[1:off_indices[0][0]] != param_indices[:off_indices[0][0]-1]):
                     logger.warning('Bad stimulation trigger: stimulus parameter are not the same between two off segments.')
-                on_begin = self.timestamps[0]
-                on_end = self.timestamps[off_indices[0][0]-1]
-                param_index = self.param_indices[0]
+                on_begin = timestamps[0]
+                on_end = timestamps[off_indices[0][0]-1]
+                param_index = param_indices[0]
                 if param_index not in range(18):
                     logger.warning('Bad stimulation trigger: stimulus parameter index exceeded defined range [0,17].')
                 if on_end > on_begin and param_index in range(18):
                     logger.info('Processing psth data for %s index: %d at duration %.2f:%.2f'
-                                %(self.parameter, param_index, on_begin, on_end))
+                                %(self.parameter, param_index, self.to_seconds(on_begin), self.to_seconds(on_end)))
                     self._process_psth_data(on_begin, on_end, param_index) # psth processing of on segment
-                self.param_indices = self.param_indices[off_indices[0][0]:] # remove processed on segment
-                self.timestamps = self.timestamps[off_indices[0][0]:]
-            off_indices = np.nonzero(self.param_indices == -1)
+                self._discard_triggers(off_indices[0][0]) # remove processed on segment
+            param_indices = self.param_indices.view()
+            timestamps = self.timestamps.view()
+            off_indices = np.nonzero(param_indices == -1)
+        self._process_pending_trials()
                 
+    def _discard_triggers(self, count):
+        self.param_indices.discard(count)
+        self.timestamps.discard(count)
+        
     def _process_psth_data(self,begin,end,param_index):
-        duration = 2.0
-        binsize = 0.01 #binsize 10 ms
-        bins = np.arange(0.,duration,binsize)
-        for channel,channel_trains in self.spike_trains.iteritems():
-            if channel not in self.histogram_data:
-                self.histogram_data[channel] = {}
-            for unit,unit_train in channel_trains.iteritems():
-                if unit not in self.histogram_data[channel]:
-                    self.histogram_data[channel][unit] = {}
-                if param_index not in self.histogram_data[channel][unit]:
-                    self.histogram_data[channel][unit][param_index] = {}
-                    self.histogram_data[channel][unit][param_index]['trials'] = 0
-                    self.histogram_data[channel][unit][param_index]['spikes'] = []
-                    self.histogram_data[channel][unit][param_index]['means'] = []
-                take = ((unit_train >= begin) & (unit_train < begin + duration) & (unit_train< end))
-                trial_spikes = unit_train[take] - begin
-                trial_mean = np.mean(np.array(np.histogram(trial_spikes, bins=bins)[0],dtype='float') / binsize)
-                spikes = np.append(self.histogram_data[channel][unit][param_index]['spikes'], trial_spikes)
-                trials = self.histogram_data[channel][unit][param_index]['trials'] + 1
-                psth_data = np.array(np.histogram(spikes, bins=bins)[0],dtype='float') / (binsize*trials)
-                smooth_psth = nd.gaussian_filter1d(psth_data, sigma=5)
-                mean = np.mean(smooth_psth)
-                self.histogram_data[channel][unit][param_index]['spikes'] = spikes
-                self.histogram_data[channel][unit][param_index]['trials'] = trials
-                self.histogram_data[channel][unit][param_index]['psth_data'] = psth_data
-                self.histogram_data[channel][unit][param_index]['smooth_psth'] = smooth_psth
-                self.histogram_data[channel][unit][param_index]['bins'] = bins
-                self.histogram_data[channel][unit][param_index]['mean'] = mean
-                self.histogram_data[channel][unit][param_index]['means'].append(trial_mean)
-                self.histogram_data[channel][unit][param_index]['std'] = np.std(self.histogram_data[channel][unit][param_index]['means'])
+        # the trials are processed together for all units after the trigger queue
+        self.pending_trials.append((begin, end, param_index))
+        
+    def _get_population(self):
+        if self.population is None:
+            duration = 2.0
+            binsize = 0.01 #binsize 10 ms
+            bins = np.arange(0.,duration,binsize)
+            # spikes are binned in ticks and the bins are kept in seconds for display
+            self.population = PopulationPSTH(bins, binsize, duration, self.get_timestamp_frequency(), range(-1,18))
+        return self.population
+        
+    def _process_pending_trials(self):
+        if not self.pending_trials:
+            return
+        begins, ends, param_indices = zip(*self.pending_trials)
+        self.pending_trials = []
+        self._get_population().add_trials(self.spike_trains, begins, ends, param_indices)
                 
 class PSTHAverage(PlexSpikeData):
     ONSET_MASK = 1<<12
     def __init__(self, *args,**kwargs):
         super(PSTHAverage, self).__init__(*args,**kwargs)
         self.data_type = 'psth_average'
-        self.timestamps = np.empty(0)
-        self.onset_timestamps = np.empty(0)
-        self.spike_trains = {}
+        self.timestamps = GrowableArray(np.int64)
+        self.onset_timestamps = GrowableArray(np.int64)
+        self._renew_spike_trains()
         self.histogram_data = {}
         
     def renew_data(self):
-        self.timestamps = np.empty(0)
-        self.spike_trains = {}
+        self.timestamps = GrowableArray(np.int64)
+        self._renew_spike_trains()
         self.histogram_data = {}
     
     def get_data(self,callback=None):
-        self._update_data(callback)
+        self._update_all_data(callback)
         self._get_psth_data()
         return self.histogram_data
     
     def _update_data(self,callback=None):
         super(PSTHAverage, self)._update_data(callback)
-        new_triggers = self.pu.GetExtEvents(self.data, event='first_strobe_word')
-        if len(new_triggers['value']) == 0:
-            new_triggers = self.pu.GetExtEvents(self.data, event='unstrobed_word', online=self.online)
+        new_triggers = self._get_triggers()
         trigger_values = new_triggers['value']
         is_onset_trigger = (trigger_values & PSTHTuning.ONSET_MASK) != 0
         onset_timestamps = new_triggers['timestamp'][is_onset_trigger]
-        self.onset_timestamps = np.append(self.onset_timestamps, onset_timestamps)
-        self.timestamps = np.append(self.timestamps, new_triggers['timestamp'])
+        self.onset_timestamps.append(onset_timestamps)
+        self.timestamps.append(new_triggers['timestamp'])
                 
-        new_spike_trains = self.pu.GetSpikeTrains(self.data)
-        for channel,channel_trains in new_spike_trains.iteritems():
-            if channel not in self.spike_trains:
-                self.spike_trains[channel] = channel_trains
-            else:
-                for unit,unit_train in channel_trains.iteritems():
-                    if unit not in self.spike_trains[channel]:
-                        self.spike_trains[channel][unit] = unit_train
-                    else:
-                        self.spike_trains[channel][unit] = np.append(self.spike_trains[channel][unit], unit_train)
+        self._append_spike_trains(self.pu.GetSpikeTrains(self.data))
             
     def _get_psth_data(self):
-        for channel,channel_trains in self.spike_trains.iteritems():
-            if channel not in self.histogram_data:
-                self.histogram_data[channel] = {}
-            for unit,_unit_train in channel_trains.iteritems():
-                if unit not in self.histogram_data[channel]:
-                    self.histogram_data[channel][unit] = {}
-                    self.histogram_data[channel][unit]['trials'] = 0
-                    self.histogram_data[channel][unit]['spikes'] = []
-                    self.histogram_data[channel][unit]['means'] = []
-                self._process_unit(channel,unit)
-                    
-    def _process_unit(self,channel,unit):
         duration = 0.152
         binsize = 0.001 #binsize 1 ms
         bins = np.arange(0.,duration,binsize)
+        # the spikes of all units are aligned to the onsets and binned in ticks at once
+        duration_ticks = self.to_ticks(duration)
+        bin_ticks = np.round(bins * self.get_timestamp_frequency()).astype(np.int64)
+        stimulus_on = self.onset_timestamps.view()
+        units = sorted((channel, unit) for channel,channel_trains in self.spike_trains.iteritems() for unit in channel_trains)
+        unit_indices, _trial_indices, times = align_population([self.spike_trains[channel][unit] for channel,unit in units],
+                                                               stimulus_on, 0, duration_ticks)
+        bin_indices = bin_times(times, bin_ticks)
+        binned = bin_indices >= 0
+        counts = np.bincount(unit_indices[binned] * (len(bins)-1) + bin_indices[binned], 
+                             minlength=len(units)*(len(bins)-1)).reshape(len(units), len(bins)-1)
+        # the aligned spikes are sorted by unit
+        unit_bounds = np.searchsorted(unit_indices, np.arange(len(units)+1))
+        for index,(channel,unit) in enumerate(units):
+            if channel not in self.histogram_data:
+                self.histogram_data[channel] = {}
+            if unit not in self.histogram_data[channel]:
+                self.histogram_data[channel][unit] = {}
+                self.histogram_data[channel][unit]['trials'] = 0
+                self.histogram_data[channel][unit]['spikes'] = []
+                self.histogram_data[channel][unit]['means'] = []
+            spikes = times[unit_bounds[index]:unit_bounds[index+1]]
+            self._process_unit(channel, unit, bins, binsize, len(stimulus_on), counts[index], spikes)
+                    
+    def _process_unit(self,channel,unit,bins,binsize,trials,counts,spikes):
         self.histogram_data[channel][unit]['bins'] = bins[:-1]*1000
-        stimulus_on = self.onset_timestamps
-        unit_train = self.spike_trains[channel][unit]
-        spikes = []
-        trials = 0
-        for begin in stimulus_on:
-            take = ((unit_train >= begin) & (unit_train < begin + duration))
-            trial_spikes = unit_train[take] - begin
-            spikes = np.append(spikes, trial_spikes)
-            trials = trials + 1
         print trials
-        psth_data = np.array(np.histogram(spikes, bins=bins)[0],dtype='float') / (binsize*trials)
+        psth_data = np.array(counts,dtype='float') / (binsize*trials)
         smoothed_psth = nd.gaussian_filter1d(psth_data, sigma=10)
         maxima_indices = (np.diff(np.sign(np.diff(smoothed_psth))) < 0).nonzero()[0] + 1
         minima_indices = (np.diff(np.sign(np.diff(smoothed_psth))) > 0).nonzero()[0] + 1
@@ -239,7 +486,7 @@ class PSTHAverage(PlexSpikeData):
         except:
             peak_time = None
         
-        self.histogram_data[channel][unit]['spikes'] = spikes
+        self.histogram_data[channel][unit]['spikes'] = self.to_seconds(spikes)
         self.histogram_data[channel][unit]['trials'] = trials
         self.histogram_data[channel][unit]['psth_data'] = psth_data
         self.histogram_data[channel][unit]['smoothed_psth'] = smoothed_psth
@@ -0,0 +1,42 @@
+# Time the online TimeHistogram and RevCorr pipelines on a replayed plx file
+#
+# Copyright (C) 2010-2012 Huang Xin
+#
+# See LICENSE.TXT that came with this file.
+import sys
+import time
+import numpy as np
+from SpikeRecord.Plexon.PlexReplay import PlexReplayClient
+import TimeHistogram
+import RevCorr
+
+PIPELINES = {'psth':TimeHistogram.PSTHAverage,
+             'tuning':TimeHistogram.PSTHTuning,
+             'sta':RevCorr.STAData}
+
+def run(filename, pipeline='psth', speed=1.0, interval=0.1):
+    client = PlexReplayClient(filename, speed=speed)
+    spike_data = PIPELINES[pipeline](client=client)
+    latencies = []
+    events = 0
+    start = time.time()
+    while not client.is_finished():
+        time.sleep(interval)
+        position = client.position
+        begin = time.time()
+        spike_data.get_data()
+        latencies.append(time.time() - begin)
+        events += client.position - position
+    elapsed = time.time() - start
+    latencies = np.array(latencies) * 1000
+    print '%s: %d events in %d reads in %.1f s at speed %.1f' %(pipeline, events, len(latencies), elapsed, speed)
+    print 'get_data latency: mean %.2f ms, median %.2f ms, max %.2f ms' \
+          %(latencies.mean(), np.median(latencies), latencies.max())
+    print 'throughput: %.0f events/s' %(events / max(latencies.sum() / 1000, 1e-6))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'Usage: python %s file.plx [psth|tuning|sta] [speed]' %sys.argv[0]
+        sys.exit(1)
+    run(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'psth',
+        float(sys.argv[3]) if len(sys.argv) > 3 else 1.0)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Compare the population PSTH with the histogram data of
+### the trial by trial PSTHTuning
+###########################################################
+
+import pickle
+import unittest
+import numpy as np
+import scipy.ndimage as nd
+from TimeHistogram import PopulationPSTH, PSTHView
+
+FREQUENCY = 40000
+DURATION = 2.0
+BINSIZE = 0.01
+BINS = np.arange(0., DURATION, BINSIZE)
+CONDITIONS = range(-1, 18)
+
+def make_spike_trains(seed=0, spikes=3000, span=20.0):
+    """
+    Random spike trains in ticks of two channels. No spike is on a bin edge of a trial
+    so the binning in ticks and in seconds agree.
+    """
+    rng = np.random.RandomState(seed)
+    spike_trains = {}
+    for channel, units in ((1, 'ab'), (3, 'a')):
+        for unit in units:
+            train = np.sort(rng.randint(0, int(span * FREQUENCY), spikes)).astype(np.int64)
+            train[train % int(BINSIZE * FREQUENCY) == 0] += 1
+            spike_trains.setdefault(channel, {})[unit] = train
+    return spike_trains
+
+def make_trials(seed=0, trials=12):
+    # trials begin on bin edges, some end before the trial duration
+    rng = np.random.RandomState(seed)
+    begins = np.arange(trials) * int(1.5 * FREQUENCY)
+    ends = begins + rng.choice([int(1.2 * FREQUENCY), int(2.5 * FREQUENCY)], trials)
+    conditions = rng.choice([-1, 0, 3, 16], trials)
+    return list(begins), list(ends), list(conditions)
+
+def baseline_histogram_data(spike_trains, begins, ends, conditions):
+    """
+    histogram_data[channel][unit][condition] of the trials processed one at a time
+    with np.histogram in seconds as PSTHTuning did before PopulationPSTH.
+    """
+    histogram_data = {}
+    for begin, end, condition in zip(begins, ends, conditions):
+        for channel, channel_trains in spike_trains.iteritems():
+            for unit, unit_train in channel_trains.iteritems():
+                data = histogram_data.setdefault(channel, {}).setdefault(unit, {}).setdefault(condition,
+                                                          {'trials':0, 'spikes':[], 'means':[]})
+                take = (unit_train >= begin) & (unit_train < begin + DURATION * FREQUENCY) & (unit_train < end)
+                trial_spikes = (unit_train[take] - begin) / float(FREQUENCY)
+                trial_mean = np.mean(np.array(np.histogram(trial_spikes, bins=BINS)[0], dtype='float') / BINSIZE)
+                data['spikes'] = np.append(data['spikes'], trial_spikes)
+                data['trials'] += 1
+                data['psth_data'] = np.array(np.histogram(data['spikes'], bins=BINS)[0], dtype='float') / (BINSIZE * data['trials'])
+                data['smooth_psth'] = nd.gaussian_filter1d(data['psth_data'], sigma=5)
+                data['bins'] = BINS
+                data['mean'] = np.mean(data['smooth_psth'])
+                data['means'].append(trial_mean)
+                data['std'] = np.std(data['means'])
+    return histogram_data
+
+class TestPopulationPSTH(unittest.TestCase):
+    def setUp(self):
+        self.spike_trains = make_spike_trains()
+        self.begins, self.ends, self.conditions = make_trials()
+        self.expected = baseline_histogram_data(self.spike_trains, self.begins, self.ends, self.conditions)
+
+    def get_result(self, batches):
+        population = PopulationPSTH(BINS, BINSIZE, DURATION, FREQUENCY, CONDITIONS)
+        for batch in batches:
+            population.add_trials(self.spike_trains, [self.begins[i] for i in batch],
+                                  [self.ends[i] for i in batch], [self.conditions[i] for i in batch])
+        return population.get_result()
+
+    def assert_same_histogram_data(self, result):
+        self.assertEqual(sorted(result.keys()), sorted(self.expected.keys()))
+        for channel, channel_data in self.expected.iteritems():
+            self.assertEqual(sorted(result[channel]), sorted(channel_data))
+            for unit, unit_data in channel_data.iteritems():
+                self.assertEqual(sorted(result[channel][unit]), sorted(unit_data))
+                for condition, expected in unit_data.iteritems():
+                    view = result[channel][unit][condition]
+                    self.assertEqual(view['trials'], expected['trials'])
+                    self.assertTrue(np.array_equal(view['bins'], expected['bins']))
+                    for key in ('spikes', 'psth_data', 'smooth_psth', 'mean', 'std'):
+                        self.assertTrue(np.allclose(view[key], expected[key]), key)
+
+    def test_one_batch(self):
+        self.assert_same_histogram_data(self.get_result([range(len(self.begins))]))
+
+    def test_trial_by_trial(self):
+        self.assert_same_histogram_data(self.get_result([[i] for i in xrange(len(self.begins))]))
+
+    def test_view_is_a_mapping(self):
+        view = self.get_result([range(len(self.begins))])[1]['a'][0]
+        self.assertTrue(isinstance(view, PSTHView))
+        self.assertEqual(sorted(view.keys()), sorted(PSTHView.KEYS))
+        self.assertEqual(len(view), len(PSTHView.KEYS))
+        self.assertTrue('mean' in view)
+        self.assertFalse('maxima' in view)
+        self.assertEqual(view.get('trials'), view['trials'])
+        self.assertEqual(dict(view.items())['std'], view['std'])
+        self.assertEqual(sorted(pickle.loads(pickle.dumps(view)).keys()), sorted(PSTHView.KEYS))
+
+if __name__ == "__main__":
+    unittest.main()
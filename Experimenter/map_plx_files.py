@@ -8,18 +8,65 @@ import os
 import re
 import sys
 import shutil
-from SpikeRecord.Plexon.PlexFile import PlexFile
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+from SpikeRecord.Plexon.PlexFile import read_plx_header, get_header_datetime
 from datetime import datetime
 
-def collect_plx_timestamp(plx_dir):
-    plx_timestamps = []
+# cache of the plx file times in the plx directory: {path: (size, mtime, time_stamp)}
+PLX_INDEX_FILE = '.plx_index.pkl'
+# threads reading plx headers, mostly waiting for network shares
+PLX_READ_THREADS = 16
+
+def load_plx_index(plx_dir):
+    try:
+        with open(os.path.join(plx_dir, PLX_INDEX_FILE), 'rb') as index_file:
+            return pickle.load(index_file)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+def save_plx_index(plx_dir, plx_index):
+    index_path = os.path.join(plx_dir, PLX_INDEX_FILE)
+    try:
+        with open(index_path + '.tmp', 'wb') as index_file:
+            pickle.dump(plx_index, index_file, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rename(index_path + '.tmp', index_path)
+    except (IOError, OSError), e:
+        print 'Cannot save PLX index file %s: %s' %(index_path, e)
+
+def read_plx_timestamp(filepath, plx_index):
+    # the header is only read when the file is new or changed since it was indexed
+    stat = os.stat(filepath)
+    cached = plx_index.get(filepath)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+        return cached
+    time_stamp = get_header_datetime(read_plx_header(filepath))
+    return (stat.st_size, stat.st_mtime, time_stamp)
+
+def collect_plx_timestamp(plx_dir, threads=PLX_READ_THREADS):
+    plx_files = []
     for root, _dirs, files in os.walk(plx_dir):
         for filename in files:
             if filename[-4:] == '.plx':
-                filepath = os.path.join(root,filename)
-                time_stamp = PlexFile(filepath).get_datetime()
-                plx_timestamps.append((filepath,time_stamp))
-                print 'Found PLX file %s created at %s' %(filepath, time_stamp.strftime('%Y/%m/%d %H:%M:%S'))
+                plx_files.append(os.path.join(root,filename))
+    
+    plx_index = load_plx_index(plx_dir)
+    pool = ThreadPool(threads)
+    try:
+        entries = pool.map(lambda filepath: read_plx_timestamp(filepath, plx_index), plx_files)
+    finally:
+        pool.close()
+        pool.join()
+    new_index = dict(zip(plx_files, entries))
+    if new_index != plx_index:
+        save_plx_index(plx_dir, new_index)
+    
+    plx_timestamps = []
+    for filepath, (_size, _mtime, time_stamp) in zip(plx_files, entries):
+        plx_timestamps.append((filepath,time_stamp))
+        print 'Found PLX file %s created at %s' %(filepath, time_stamp.strftime('%Y/%m/%d %H:%M:%S'))
     
     return sorted(plx_timestamps, key=lambda tup: tup[1])
 
@@ -65,31 +112,32 @@ if __name__ == '__main__':
     log_timestamps = collect_log_timestamp(argv[2])
     
     print 'Found %d PLX files and %d Experiments entries.' %(len(plx_timestamps),len(log_timestamps))
+    # both lists are sorted by time so they are merged by advancing the oldest log entry
+    log_index = 0
     for timestamp in plx_timestamps:
-        try:
-            while True:
-                oldest_log = log_timestamps[0]
-                elapse = (timestamp[1] - oldest_log[2]).total_seconds()
-                print 'Elapse %f for experiment %s' %(elapse, oldest_log[1])
-                if elapse >= 10.0: # skip experiments of ten secs ago
-                    print 'Skip experiment %s' %(oldest_log[1])
-                    log_timestamps.pop(0)
-                elif elapse <= 0:
-                    print "Skip PLX file %s" %timestamp[0]
-                    break
+        while log_index < len(log_timestamps):
+            oldest_log = log_timestamps[log_index]
+            elapse = (timestamp[1] - oldest_log[2]).total_seconds()
+            print 'Elapse %f for experiment %s' %(elapse, oldest_log[1])
+            if elapse >= 10.0: # skip experiments of ten secs ago
+                print 'Skip experiment %s' %(oldest_log[1])
+                log_index += 1
+            elif elapse <= 0:
+                print "Skip PLX file %s" %timestamp[0]
+                break
+            else:
+                log_index += 1
+                src_file = timestamp[0]
+                dst_file = os.path.join(oldest_log[0],oldest_log[1]+'.plx')
+                if update_file and os.path.exists(dst_file):
+                    print "File %s exists" %dst_file
+                elif simulation:
+                    print "Simulated creating file %s" %dst_file
                 else:
-                    log_timestamps.pop(0)
-                    src_file = timestamp[0]
-                    dst_file = os.path.join(oldest_log[0],oldest_log[1]+'.plx')
-                    if update_file and os.path.exists(dst_file):
-                        print "File %s exists" %dst_file
-                    elif simulation:
-                        print "Simulated creating file %s" %dst_file
-                    else:
-                        shutil.copyfile(src_file, dst_file)
-                        print "Created file %s" %dst_file
-                    break
-        except IndexError,e:
-            print "No more entry in log file. " + str(e)
+                    shutil.copyfile(src_file, dst_file)
+                    print "Created file %s" %dst_file
+                break
+        else:
+            print "No more entry in log file."
             break
          
\ No newline at end of file
@@ -85,6 +85,7 @@ class TestDAQTriggerExp(Experiment):
         finished = False
         while not finished:
             data = self.pc.GetTimeStampArrays()
+            frequency = float(self.pc.GetTimeStampFrequency())
             if mode == "strobed":
                 daq_stamps = self.pu.GetExtEvents(data, event='first_strobe_word')
             elif mode == "unstrobed":
@@ -103,7 +104,7 @@ class TestDAQTriggerExp(Experiment):
                 for index,(value,timestamp) in enumerate(zip(daq_stamps['value'],daq_stamps['timestamp'])) :
                     self._log_test("Stamp index:%d" % index)
                     self._log_test("Found DAQ stamps:%d, Soft stamps:%d" % (DAQ_nstamps, Soft_nstamps))
-                    self._log_test("found daq  trigger word: %d t=%f" % (value,timestamp))
+                    self._log_test("found daq  trigger word: %d t=%f" % (value,timestamp/frequency))
                     try:
                         soft_stamp = trig_receiver.get_comp_stamp()
                     except:
@@ -115,7 +116,7 @@ class TestDAQTriggerExp(Experiment):
                     except:
                         failed_times += 1
                         self._log_test("Assertion failed:\n\tDAQ stamp:\t%d\t(%s)\tt=%f\n\tSoft stamp:\t%d\t(%s)" \
-                            % (value,bin(value),timestamp,soft_stamp,bin(soft_stamp)))
+                            % (value,bin(value),timestamp/frequency,soft_stamp,bin(soft_stamp)))
                     self._log_test("Assertion failed times:%d\n" % failed_times)
             time.sleep(1.0)
     def _log_test(self, line):
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Ring buffer of Plexon timestamps
+###########################################################
+
+import threading
+import numpy as np
+
+# initial number of events held by a ring
+RING_CAPACITY = 1<<16
+
+EVENT_DTYPES = (('type', np.uint16), ('channel', np.uint16), ('unit', np.uint16), ('timestamp', np.int64))
+
+class EventRing(object):
+    """
+    Growable ring buffer of timestamps in the format of GetTimeStampArrays.
+
+    Events are numbered from 0 in the order they are appended. A reader keeps the number
+    of the next event it wants as its cursor and reads all events from there. Events
+    stay in the ring until they are released, and the ring doubles its capacity instead
+    of overwriting events not yet released. All methods are thread safe.
+    """
+    def __init__(self, capacity=RING_CAPACITY):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.arrays = dict((key, np.empty(capacity, dtype=dtype)) for key, dtype in EVENT_DTYPES)
+        # number of the oldest event held and of the next event appended
+        self.begin = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def _take(self, begin, end):
+        # events [begin, end) in order, which may wrap around the end of the arrays
+        first = begin % self.capacity
+        last = first + end - begin
+        if last <= self.capacity:
+            return dict((key, array[first:last].copy()) for key, array in self.arrays.iteritems())
+        last -= self.capacity
+        return dict((key, np.concatenate((array[first:], array[:last]))) for key, array in self.arrays.iteritems())
+
+    def _grow(self, size):
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        held = self._take(self.begin, self.end)
+        self.capacity = capacity
+        self.arrays = dict((key, np.empty(capacity, dtype=dtype)) for key, dtype in EVENT_DTYPES)
+        self._put(self.begin, held)
+
+    def _put(self, begin, data):
+        count = len(data['timestamp'])
+        first = begin % self.capacity
+        split = min(count, self.capacity - first)
+        for key, array in self.arrays.iteritems():
+            array[first:first+split] = data[key][:split]
+            array[:count-split] = data[key][split:]
+
+    def append(self, data):
+        """
+        append(data) -> end
+
+        Append the events of a {'type', 'channel', 'unit', 'timestamp'} dictionary and
+        return the number of the next event.
+        """
+        count = len(data['timestamp'])
+        with self.lock:
+            if self.end + count - self.begin > self.capacity:
+                self._grow(self.end + count - self.begin)
+            self._put(self.end, data)
+            self.end += count
+            return self.end
+
+    def read(self, cursor):
+        """
+        read(cursor) -> (data, cursor)
+
+        Return the events from the cursor to the end of the ring and the cursor after them.
+        Events already released before the cursor are skipped.
+        """
+        with self.lock:
+            begin = max(cursor, self.begin)
+            return self._take(begin, self.end), self.end
+
+    def release(self, cursor):
+        """
+        release(cursor)
+
+        Drop the events before the cursor.
+        """
+        with self.lock:
+            self.begin = min(max(cursor, self.begin), self.end)
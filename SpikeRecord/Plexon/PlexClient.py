@@ -8,12 +8,16 @@
 
 from __future__ import division
 import ctypes 
+import threading
 import numpy as np
 import logging
 logger = logging.getLogger('SpikeRecord.Plexon')
 from SpikeRecord import Plexon
+from SpikeRecord.Plexon.PlexBuffer import EventRing
 
 MAX_MAP_EVENTS_PER_READ = 8000
+# seconds the acquisition thread sleeps after the server is drained
+ACQUISITION_INTERVAL = 0.01
 
 class PlexClient(object):
     """
@@ -24,15 +28,25 @@ class PlexClient(object):
         self.library = Plexon._lib
         self.MAX_MAP_EVENTS_PER_READ = MAX_MAP_EVENTS_PER_READ
         self.MAPSampleRate = None
+        # the server timestamps are the lower 32 bits of the 40-bit timestamps
+        self.timestamp_wraps = 0
+        self.last_raw_timestamp = None
         self.EventTypeArray      = np.empty(self.MAX_MAP_EVENTS_PER_READ,dtype=np.uint16)
         self.EventChannelArray   = np.empty(self.MAX_MAP_EVENTS_PER_READ,dtype=np.uint16)
         self.EventUnitArray      = np.empty(self.MAX_MAP_EVENTS_PER_READ,dtype=np.uint16)
         self.EventTimestampArray = np.empty(self.MAX_MAP_EVENTS_PER_READ,dtype=np.uint32)
         self.ServerEventBuffer = (Plexon.PL_Event * self.MAX_MAP_EVENTS_PER_READ)()
+        # acquisition thread draining the server into the ring
+        self.ring = None
+        self.ring_cursor = 0
+        self.acquisition_thread = None
+        self.stop_acquisition = threading.Event()
+        self.acquisition_stats = {}
     def __enter__(self):
         self.InitClient()
         return self
     def __exit__(self, exc_type, exc_value, traceback):
+        self.StopAcquisition()
         self.CloseClient()
     def __getattr__(self, name):
         try: return getattr(self.library, name)
@@ -53,6 +67,8 @@ class PlexClient(object):
         if not TimeStampTick in (25, 40, 50):
             raise RuntimeError("Failed to get timestamp tick.")
         self.MAPSampleRate = 1000 / TimeStampTick * 1000
+        self.timestamp_wraps = 0
+        self.last_raw_timestamp = None
     def CloseClient(self):
         """
         CloseClient() 
@@ -61,6 +77,7 @@ class PlexClient(object):
         Sends ClientDisconnected command to the server.
         The server decrements the counter for the number of connected clients.
         """
+        self.StopAcquisition()
         if not self.library: return
         Plexon.PL_CloseClient()
 
@@ -78,6 +95,15 @@ class PlexClient(object):
         Return timestamp resolution in microseconds.
         """
         return Plexon.PL_GetTimeStampTick()
+    def GetTimeStampFrequency(self):
+        """
+        GetTimeStampFrequency() -> integer
+
+        Return the number of timestamp ticks per second, or None before the client is initialized.
+        """
+        if self.MAPSampleRate is None:
+            return None
+        return int(round(self.MAPSampleRate))
     def IsLongWaveMode(self):
         """
         IsLongWaveMode() -> bool
@@ -99,8 +125,18 @@ class PlexClient(object):
         -------
         'type', 'channel', 'unit', 'timestamp': dict keys
             Values are four 1-D arrays of the timestamp structure fields. The array length is the actual transferred TimeStamps.
-            'timestamp' is converted to seconds.
+            'timestamp' is in ticks as int64. Divide it by GetTimeStampFrequency() to get seconds.
+            The type, channel and unit arrays are only valid until the next call.
+            
+        While the acquisition thread is running all events acquired since the last call
+        are returned regardless of num, and the arrays stay valid.
         """
+        if self.acquisition_thread is not None:
+            data, self.ring_cursor = self.ring.read(self.ring_cursor)
+            self.ring.release(self.ring_cursor)
+            return data
+        return self._read_server(num)
+    def _read_server(self, num):
         num = ctypes.c_int(num)
         data = {}
         if self.library:
@@ -112,14 +148,85 @@ class PlexClient(object):
             data['type'] = self.EventTypeArray[:num.value]
             data['channel'] = self.EventChannelArray[:num.value]
             data['unit'] = self.EventUnitArray[:num.value] 
-            # make man readable timestamp
-            data['timestamp'] = self.EventTimestampArray[:num.value]/self.MAPSampleRate
+            data['timestamp'] = self._unwrap_timestamps(self.EventTimestampArray[:num.value])
         else:
             data['type'] = np.empty(0,dtype=np.uint16)
             data['channel'] = np.empty(0,dtype=np.uint16)
             data['unit'] = np.empty(0,dtype=np.uint16)
-            data['timestamp'] = np.empty(0)
+            data['timestamp'] = np.empty(0,dtype=np.int64)
         return data
+    def _unwrap_timestamps(self, raw_timestamps):
+        # The 32-bit timestamps roll over every 2**32 ticks, i.e. about 30 hours at 40 kHz. 
+        # A backward jump of more than half of the range is taken as a roll over.
+        ticks = raw_timestamps.astype(np.int64)
+        if len(ticks) == 0:
+            return ticks
+        previous = ticks[0] if self.last_raw_timestamp is None else self.last_raw_timestamp
+        wraps = self.timestamp_wraps + np.cumsum(np.ediff1d(ticks, to_begin=ticks[0] - previous) < -(1<<31))
+        self.timestamp_wraps = wraps[-1]
+        self.last_raw_timestamp = ticks[-1]
+        ticks += wraps.astype(np.int64) << 32
+        return ticks
+    def StartAcquisition(self, interval=ACQUISITION_INTERVAL):
+        """
+        StartAcquisition(interval)
+
+        Start a thread draining the server buffer into a ring buffer so that no events
+        are lost between calls of GetTimeStampArrays. The thread reads the server until
+        a read is not full, and sleeps interval seconds before the next drain.
+        """
+        if self.acquisition_thread is not None:
+            return
+        self.ring = EventRing()
+        self.ring_cursor = 0
+        self.acquisition_stats = {'batches':0, 'events':0, 'max_batch':0, 'suspected_overflows':0}
+        self.stop_acquisition.clear()
+        self.acquisition_thread = threading.Thread(target=self._acquire, args=(interval,), name='PlexClientAcquisition')
+        self.acquisition_thread.daemon = True
+        self.acquisition_thread.start()
+    def StopAcquisition(self):
+        """
+        StopAcquisition()
+
+        Stop the acquisition thread. Events acquired but not read yet are dropped.
+        """
+        if self.acquisition_thread is None:
+            return
+        self.stop_acquisition.set()
+        # the thread may stop itself, e.g. when it collects the last subscriber of a hub
+        if self.acquisition_thread is not threading.current_thread():
+            self.acquisition_thread.join()
+        self.acquisition_thread = None
+    def GetAcquisitionStats(self):
+        """
+        GetAcquisitionStats() -> {'batches', 'events', 'max_batch', 'suspected_overflows', 'buffered'}
+
+        Counters of the acquisition thread: number of non-empty server reads, events read,
+        largest read, full reads at the beginning of a drain, which suggest the server 
+        buffer overflowed while the thread was sleeping, and events waiting in the ring.
+        """
+        stats = dict(self.acquisition_stats)
+        stats['buffered'] = len(self.ring) if self.ring is not None else 0
+        return stats
+    def _acquire(self, interval):
+        stats = self.acquisition_stats
+        while not self.stop_acquisition.is_set():
+            first_read = True
+            while True:
+                data = self._read_server(self.MAX_MAP_EVENTS_PER_READ)
+                count = len(data['timestamp'])
+                if count == 0:
+                    break
+                self.ring.append(data)
+                stats['batches'] += 1
+                stats['events'] += count
+                stats['max_batch'] = max(stats['max_batch'], count)
+                if count < self.MAX_MAP_EVENTS_PER_READ:
+                    break
+                if first_read:
+                    stats['suspected_overflows'] += 1
+                first_read = False
+            self.stop_acquisition.wait(interval)
         
     def GetTimeStampStructures(self, num=MAX_MAP_EVENTS_PER_READ):
         """
@@ -7,14 +7,19 @@
 ###########################################################
 
 from __future__ import division
+import os
 import time
 import numpy as np
 import logging
 import mmap
+import zlib
+import struct
+import multiprocessing
 logger = logging.getLogger('SpikeRecord.Plexon')
 import ctypes
 from ctypes import Structure
 from datetime import datetime
+from SpikeRecord.Plexon import PlexIndex
 
 #######################################/
 # Plexon .plx File Structure Definitions
@@ -137,13 +142,237 @@ class PL_DataBlockHeader(Structure):
                 ('NumberOfWordsInWaveform', ctypes.c_short)]        # Number of samples per waveform in the data to follow
                 # 16 bytes
 
+# numpy equivalent of PL_DataBlockHeader
+DATA_BLOCK_DTYPE = np.dtype([('Type', '<i2'),
+                             ('UpperByteOf5ByteTimestamp', '<u2'),
+                             ('TimeStamp', '<u4'),
+                             ('Channel', '<i2'),
+                             ('Unit', '<i2'),
+                             ('NumberOfWaveforms', '<i2'),
+                             ('NumberOfWordsInWaveform', '<i2')])
+
+# record of the block index: file offset of the block followed by the block header
+BLOCK_INDEX_DTYPE = np.dtype([('Offset', '<i8')] + DATA_BLOCK_DTYPE.descr)
+
+# offset of NumberOfWaveforms in PL_DataBlockHeader
+WAVEFORM_SIZE_OFFSET = PL_DataBlockHeader.NumberOfWaveforms.offset
+# number of blocks of the same size seen before guessing a run of them
+MIN_BLOCK_STREAK = 2
+# bounds of the run length guessed in the block scanner
+MIN_BLOCK_RUN = 16
+MAX_BLOCK_RUN = 1<<16
+# number of block headers gathered at a time
+GATHER_BLOCKS = 1<<20
+
+# smallest byte range of the file parsed by a worker process
+PARALLEL_MIN_RANGE = 1<<24
+# number of chained valid block headers required to resynchronize on a block boundary
+RESYNC_CHAIN = 8
+# resynchronization gives up after searching so many bytes
+RESYNC_MAX_BYTES = 1<<20
+
+# sparse time index: one record every TIME_INDEX_STRIDE blocks with the block offset, the
+# largest timestamp of all blocks before it and the smallest timestamp of the block and all blocks after it
+TIME_INDEX_DTYPE = np.dtype([('Offset', '<i8'), ('MaxTickBefore', '<i8'), ('MinTickAfter', '<i8')])
+TIME_INDEX_STRIDE = 1024
+
+# default number of blocks read at a time when the file is read in chunks
+EVENT_CHUNK_SIZE = 1<<20
+
+# segment of contiguous samples in a slow channel: timestamp of the first sample in ticks, number of samples
+SEGMENT_DTYPE = np.dtype([('tick', '<i8'), ('count', '<i8')])
+
 TESTED_PLX_VERSIONS = (105,106)
 
+def read_plx_header(filename):
+    """
+    read_plx_header(filename) -> PL_FileHeader
+    
+    Read only the file header of a plx file. This is much cheaper than opening the file 
+    with PlexFile when only the header is wanted, e.g. for the recording time of many files.
+    """
+    with open(filename, 'rb') as plx_file:
+        data = plx_file.read(ctypes.sizeof(PL_FileHeader))
+    if len(data) != ctypes.sizeof(PL_FileHeader):
+        raise RuntimeError("File %s is too short for a plx file header." %filename)
+    return PL_FileHeader.from_buffer_copy(data)
+
+def get_header_datetime(file_header):
+    """
+    Time and date when the data of the file header was acquired.
+    """
+    year = file_header.Year
+    month = file_header.Month
+    day = file_header.Day
+    hour = file_header.Hour
+    minute = file_header.Minute
+    second = file_header.Second
+    return datetime(year,month,day,hour,minute,second)
+
+def get_block_ticks(blocks):
+    """
+    40-bit timestamps of blocks in ticks.
+    """
+    return (blocks['UpperByteOf5ByteTimestamp'].astype(np.int64) << 32) + blocks['TimeStamp']
+
+class ReadingProgress(object):
+    """
+    Report file reading progress to callback(percentage,done_size,file_size,elapsed_time,left_time)
+    every 30000 blocks.
+    """
+    def __init__(self, callback, begin_offset, end_offset):
+        self.callback = callback
+        self.begin_offset = begin_offset
+        self.end_offset = end_offset
+        self.file_size = end_offset/10**6
+        self.start_time = time.time()
+        self.previous_speed = 20.0
+        self.blocks = 0
+        
+    def update(self, current_pos, blocks=1):
+        if not self.callback:
+            return
+        reported = self.blocks // 30000
+        self.blocks += blocks
+        if self.blocks // 30000 > reported:
+            elapsed_time = time.time() - self.start_time
+            avg_speed = (current_pos - self.begin_offset)/10**6/max(elapsed_time,1e-6)
+            current_speed = self.previous_speed * 0.5 + avg_speed * 0.5
+            self.previous_speed = current_speed
+            estimated_time_left = (self.end_offset - current_pos)/10**6/current_speed
+            done_size = current_pos/10**6
+            done_percentage = current_pos / self.end_offset
+            self.callback(done_percentage,done_size,self.file_size,elapsed_time,estimated_time_left)
+            
+    def finish(self):
+        if self.callback:
+            elapsed_time = time.time() - self.start_time
+            self.callback(1.0,self.file_size,self.file_size,elapsed_time,0.0)
+
+def _parse_block_range(args):
+    """
+    Worker of the parallel parsing. Parse the blocks starting in [begin_offset, end_offset)
+    of the file and return (first block offset, offset after the last block, block index).
+    The first block is found by resynchronization unless the range starts at the data 
+    region. None is returned if no block boundary is found.
+    """
+    filename, begin_offset, end_offset, resync = args
+    pf = PlexFile(filename)
+    if resync:
+        begin_offset = pf.find_block_boundary(begin_offset, end_offset)
+        if begin_offset is None:
+            return None
+    offsets = pf.read_block_offsets(begin_offset=begin_offset, end_offset=end_offset)
+    blocks = pf._make_block_index(offsets)
+    next_offset = pf._get_block_end(blocks[-1]) if len(blocks) else begin_offset
+    return begin_offset, next_offset, blocks
+
+class PlexContinuousChannel(object):
+    """
+    Continuous A/D data of a slow channel.
+    
+    values holds the samples of all segments in one array. The samples of segment i 
+    are values[begin:begin+segments['count'][i]] where begin is the sum of the counts 
+    of the preceding segments.
+    """
+    def __init__(self, header, timestamp_frequency, values, segments):
+        self.channel = header.Channel
+        self.name = header.Name
+        self.frequency = header.ADFreq
+        self.gain = header.Gain
+        self.timestamp_frequency = timestamp_frequency
+        self.values = values
+        self.segments = segments
+        
+    def get_segment_values(self, index):
+        begin = self.segments['count'][:index].sum()
+        return self.values[begin:begin+self.segments['count'][index]]
+        
+    def get_timestamps(self):
+        """
+        get_timestamps() -> timestamps
+        
+        Timestamps of all samples in seconds.
+        """
+        counts = self.segments['count']
+        segment_begins = np.cumsum(counts) - counts
+        sample_index = np.arange(counts.sum()) - np.repeat(segment_begins, counts)
+        ticks = np.repeat(self.segments['tick'], counts) + sample_index*float(self.timestamp_frequency)/self.frequency
+        return ticks/float(self.timestamp_frequency)
+
+class PlexWaveforms(object):
+    """
+    Spike waveforms of a unit as a (N x points) int16 matrix of raw adc values.
+    
+    When the blocks of the unit are evenly spaced in the file the matrix is a strided
+    view into the memory map and values is available without copying. Otherwise the
+    rows are gathered from the file when they are indexed. Multiply the adc values by 
+    mv_per_bit to get the voltages in mV.
+    """
+    def __init__(self, words, starts, points, view, channel, unit, mv_per_bit, ticks, timestamp_frequency):
+        self._words = words
+        self._starts = starts
+        self._view = view
+        self.channel = channel
+        self.unit = unit
+        self.points = points
+        self.mv_per_bit = mv_per_bit
+        self.ticks = ticks
+        self.timestamp_frequency = timestamp_frequency
+        
+    def __len__(self):
+        return len(self._starts)
+    
+    @property
+    def shape(self):
+        return (len(self._starts), self.points)
+    
+    @property
+    def is_view(self):
+        return self._view is not None
+    
+    @property
+    def values(self):
+        """
+        The waveform matrix, a view into the file if possible or a gathered copy otherwise.
+        """
+        if self._view is not None:
+            return self._view
+        return self[:]
+    
+    def __getitem__(self, index):
+        if self._view is not None:
+            return self._view[index]
+        starts = self._starts[index]
+        return self._words[np.asarray(starts)[..., np.newaxis] + np.arange(self.points)]
+    
+    def get_mv(self, index=slice(None)):
+        """
+        get_mv(index) -> waveforms
+        
+        Waveforms of the indexed spikes in mV.
+        """
+        return self[index] * self.mv_per_bit
+
 class PlexFile(object):
     """
     Reading Plexon plx file
+    
+    If index_cache is True the block index of the file is saved in a sidecar file 
+    next to the plx file and is loaded when the same file is opened again.
+    
+    With workers > 1 the block index is built by as many processes, each of which
+    parses a byte range of the file.
+    
+    With follow the file is taken as still being recorded. GetTimeStampArrays then 
+    returns only the timestamps of the blocks appended since the last call, like
+    PlexClient does for the server.
     """
-    def __init__(self,filename):   
+    def __init__(self,filename,index_cache=False,workers=1,follow=False):
+        self.filename = filename
+        self.index_cache = index_cache
+        self.workers = workers
+        self.follow = follow
         self.file = open(filename, 'rb')
         if not self.file:
             logger.error("Could not open file " + filename)
@@ -153,6 +382,9 @@ class PlexFile(object):
                                "The version of this file is %d." \
                                %(','.join([str(v) for v in TESTED_PLX_VERSIONS]),self.file_header.Version))
         
+        self.mfile = None
+        self.block_index = None
+        self.time_index = None
         self.chan_headers = None
         self.event_headers = None
         self.slow_headers = None
@@ -167,6 +399,8 @@ class PlexFile(object):
                            self.file_header.NumDSPChannels * ctypes.sizeof(PL_ChanHeader) + \
                            self.file_header.NumEventChannels * ctypes.sizeof(PL_EventHeader) + \
                            self.file_header.NumSlowChannels * ctypes.sizeof(PL_SlowChannelHeader)
+        # offset after the last complete block read in follow mode
+        self.follow_offset = self.data_offset
     def __del__(self):
         if self.file:
             self.file.close()
@@ -183,13 +417,7 @@ class PlexFile(object):
         return header
     
     def get_datetime(self):
-        year = self.file_header.Year
-        month = self.file_header.Month
-        day = self.file_header.Day
-        hour = self.file_header.Hour
-        minute = self.file_header.Minute
-        second = self.file_header.Second
-        return datetime(year,month,day,hour,minute,second)
+        return get_header_datetime(self.file_header)
     
     def read_data_header(self):
         self.file.seek(self.data_header_offset)
@@ -197,60 +425,482 @@ class PlexFile(object):
         self.event_headers = [self._get_header(PL_EventHeader) for _i in range(self.file_header.NumEventChannels)]
         self.slow_headers = [self._get_header(PL_SlowChannelHeader) for _i in range(self.file_header.NumSlowChannels)]
     
-    def read_timestamps(self, callback):
-        evtcounts = self.single_wf_counts + self.ext_event_counts
+    def _get_mmap(self):
+        if self.mfile is None:
+            self.mfile = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        return self.mfile
+    
+    def _remap_grown_file(self):
+        # The map has the size of the file when it was mapped. The old map is released
+        # when no arrays viewing it are left.
+        if self.mfile is not None and len(self.mfile) < os.fstat(self.file.fileno()).st_size:
+            self.mfile = None
+    
+    def _get_block_view(self):
+        """
+        Structured view of a PL_DataBlockHeader at every even byte of the data region.
+        Every block has an even size so the header of the block at file offset pos is
+        found at index (pos - data_offset)//2 of this view. No data is copied.
+        """
+        mfile = self._get_mmap()
+        positions = (len(mfile) - ctypes.sizeof(PL_DataBlockHeader) - self.data_offset)//2 + 1
+        if positions <= 0:
+            return np.empty(0,dtype=DATA_BLOCK_DTYPE)
+        return np.ndarray(shape=(positions,), dtype=DATA_BLOCK_DTYPE,
+                          buffer=mfile, offset=self.data_offset, strides=(2,))
+    
+    def _get_waveform_size_view(self):
+        """
+        Like _get_block_view() but only the NumberOfWaveforms and NumberOfWordsInWaveform
+        fields of the header are viewed as a single int32 which is cheap to compare.
+        """
+        mfile = self._get_mmap()
+        offset = self.data_offset + WAVEFORM_SIZE_OFFSET
+        positions = (len(mfile) - ctypes.sizeof(PL_DataBlockHeader) - self.data_offset)//2 + 1
+        if positions <= 0:
+            return np.empty(0,dtype='<i4')
+        return np.ndarray(shape=(positions,), dtype='<i4',
+                          buffer=mfile, offset=offset, strides=(2,))
+    
+    def read_block_offsets(self, callback=None, begin_offset=None, end_offset=None, max_blocks=None):
+        """
+        read_block_offsets(callback, begin_offset, end_offset, max_blocks) -> offsets
         
-        event_type = np.zeros(evtcounts,dtype=np.uint16)
-        event_channel = np.zeros(evtcounts,dtype=np.uint16)
-        event_unit = np.zeros(evtcounts,dtype=np.uint16)
-        event_timestamp = np.zeros(evtcounts,dtype=np.float32)
-        index = 0
+        First pass of the file parsing. Walk through the chain of data blocks and return
+        the file offsets of all blocks whose header is in the file. The walk starts at 
+        begin_offset, which must be the offset of a block, and stops before end_offset
+        or after max_blocks blocks. By default the whole data region is walked.
         
-        ad_frequency = self.file_header.ADFrequency
+        Data blocks of the same size usually come in long runs, e.g. spikes with waveforms.
+        Once a few blocks of the same size are seen, we guess that the following blocks
+        have the same size and take a strided view of their headers. The longest prefix
+        of the run confirming the guess is accepted at once. The run length is doubled when
+        the whole guess is right and shrinks otherwise. Interleaved blocks of different
+        sizes are stepped through one by one.
+        """
+        mfile = self._get_mmap()
+        if begin_offset is None:
+            begin_offset = self.data_offset
+        if end_offset is None or end_offset > len(mfile):
+            end_offset = len(mfile)
+        # blocks start before end_offset and their headers are in the file
+        last_pos = min(end_offset - 1, len(mfile) - ctypes.sizeof(PL_DataBlockHeader))
+        waveform_sizes = self._get_waveform_size_view()
+        if max_blocks is None:
+            max_blocks = np.iinfo(np.int64).max
+        progress = ReadingProgress(callback, begin_offset, end_offset)
+        db_size = ctypes.sizeof(PL_DataBlockHeader)
+        unpack_waveform_size = struct.Struct('<hh').unpack_from
+        # blocks are collected as runs of (offset, size, count)
+        run_offsets = []
+        run_sizes = []
+        run_counts = []
+        append_offset = run_offsets.append
+        append_size = run_sizes.append
+        append_count = run_counts.append
+        run = MIN_BLOCK_RUN
+        min_streak = MIN_BLOCK_STREAK
+        streak = 0
+        last_size = None
+        single_blocks = 0
+        blocks = 0
+        pos = begin_offset
+        while pos <= last_pos and blocks < max_blocks:
+            number_of_waveforms, words_in_waveform = unpack_waveform_size(mfile, pos + WAVEFORM_SIZE_OFFSET)
+            size = db_size + 2 * number_of_waveforms * words_in_waveform
+            if size == last_size:
+                streak += 1
+            elif size < db_size:
+                logger.error("Found corrupted data block at offset %d. Stop reading the file." %pos)
+                break
+            else:
+                streak = 0
+                last_size = size
+            append_offset(pos)
+            append_size(size)
+            if streak < min_streak:
+                append_count(1)
+                pos += size
+                blocks += 1
+                single_blocks += 1
+                if single_blocks == 4096:
+                    progress.update(pos, single_blocks)
+                    single_blocks = 0
+                continue
+            # speculate a run of blocks of the same size
+            index = (pos - self.data_offset)//2
+            step = size//2
+            num = min(run, (last_pos - pos)//size + 1, max_blocks - blocks)
+            same_size = waveform_sizes[index:index+num*step:step] == waveform_sizes[index]
+            accepted = num if same_size.all() else same_size.argmin()
+            append_count(accepted)
+            pos += size*accepted
+            blocks += accepted
+            if accepted == num:
+                run = min(run*2, MAX_BLOCK_RUN)
+            else:
+                run = max(accepted*2, MIN_BLOCK_RUN)
+                streak = 0
+                last_size = None
+            # guess less often when the runs turn out to be short
+            if accepted < MIN_BLOCK_RUN:
+                min_streak = min(min_streak*2, MIN_BLOCK_RUN)
+            else:
+                min_streak = MIN_BLOCK_STREAK
+            progress.update(pos, accepted)
+        progress.finish()
+        # expand the runs into block offsets
+        run_counts = np.array(run_counts,dtype=np.int64)
+        run_begins = np.cumsum(run_counts) - run_counts
+        steps = np.arange(run_counts.sum(),dtype=np.int64) - np.repeat(run_begins, run_counts)
+        return np.repeat(np.array(run_offsets,dtype=np.int64), run_counts) + \
+               np.repeat(np.array(run_sizes,dtype=np.int64), run_counts) * steps
+    
+    def read_block_headers(self, offsets):
+        """
+        read_block_headers(offsets) -> headers
         
-        fileno = self.file.fileno()
-        mfile = mmap.mmap(fileno,0,access=mmap.ACCESS_READ)
-        #mfile = mmap.mmap(fileno,0,access=mmap.ACCESS_WRITE|mmap.ACCESS_READ,prot=mmap.PROT_READ|mmap.PROT_WRITE)
-
-        # timing file processing
-        start_time = time.time()
-        previous_speed = 20.0
-        current_speed = previous_speed
-        end_offset = len(mfile)
-        file_size = end_offset/10**6
-        nbs = 0
-        
-        current_pos = self.data_offset
-        data_offset = self.data_offset
+        Second pass of the file parsing. Gather the headers of the data blocks at offsets
+        into a structured array of DATA_BLOCK_DTYPE.
+        """
+        headers = self._get_block_view()
+        return headers[(offsets - self.data_offset)//2]
+    
+    def _get_index_key(self):
+        """
+        Size, modification time and header checksum identifying the content of the file.
+        """
+        stat = os.fstat(self.file.fileno())
+        checksum = zlib.crc32(self._get_mmap()[:self.data_offset]) & 0xffffffff
+        return (stat.st_size, stat.st_mtime, checksum)
+    
+    def _get_block_end(self, block):
+        return int(block['Offset']) + ctypes.sizeof(PL_DataBlockHeader) + \
+               2 * int(block['NumberOfWaveforms']) * int(block['NumberOfWordsInWaveform'])
+    
+    def _is_valid_block_header(self, block_type, channel, unit, waveforms, words):
+        if block_type == PL_SingleWFType:
+            return channel in self._dsp_channels and 0 <= unit <= 26 and \
+                   (waveforms == 0 or (waveforms == 1 and words == self.file_header.NumPointsWave))
+        elif block_type == PL_ExtEventType:
+            return 0 <= channel < 512 and waveforms == 0 and words == 0
+        elif block_type == PL_ADDataType:
+            return channel in self._slow_channels and waveforms == 1 and words > 0
+        return False
+    
+    def find_block_boundary(self, begin_offset, end_offset):
+        """
+        find_block_boundary(begin_offset, end_offset) -> offset
+        
+        Resynchronize on the chain of data blocks from an arbitrary file offset. Return
+        the first offset in [begin_offset, end_offset) from which RESYNC_CHAIN valid block
+        headers are chained, or from which valid headers are chained up to the end of 
+        the file. None is returned if there is no such offset within RESYNC_MAX_BYTES.
+        """
+        if self.chan_headers is None:
+            self.read_data_header()
+        self._dsp_channels = set(header.Channel for header in self.chan_headers)
+        self._slow_channels = set(header.Channel for header in self.slow_headers)
+        mfile = self._get_mmap()
         db_size = ctypes.sizeof(PL_DataBlockHeader)
+        unpack_header = struct.Struct('<hHIhhhh').unpack_from
+        # blocks have even sizes so they start at even distances from the data region
+        pos = begin_offset + (begin_offset - self.data_offset) % 2
+        limit = min(end_offset, begin_offset + RESYNC_MAX_BYTES, len(mfile) - db_size + 1)
+        while pos < limit:
+            chain_pos = pos
+            for _i in xrange(RESYNC_CHAIN):
+                if chain_pos == len(mfile):
+                    return pos
+                if chain_pos + db_size > len(mfile):
+                    break
+                block_type, _upper, _timestamp, channel, unit, waveforms, words = unpack_header(mfile, chain_pos)
+                if not self._is_valid_block_header(block_type, channel, unit, waveforms, words):
+                    break
+                chain_pos += db_size + 2 * waveforms * words
+            else:
+                return pos
+            pos += 2
+        return None
+    
+    def _build_block_index_parallel(self, callback=None):
+        """
+        Split the data region into byte ranges parsed by worker processes. Each worker 
+        resynchronizes on the first block of its range. The chain of blocks is continuous
+        only if every range ends where the next range starts, otherwise None is returned
+        and the file should be parsed serially.
+        """
+        mfile = self._get_mmap()
+        data_size = len(mfile) - self.data_offset
+        ranges = min(self.workers, data_size // PARALLEL_MIN_RANGE)
+        if ranges < 2:
+            return None
+        bounds = [self.data_offset + data_size * i // ranges for i in xrange(ranges + 1)]
+        tasks = [(self.filename, bounds[i], bounds[i+1], i > 0) for i in xrange(ranges)]
+        progress = ReadingProgress(callback, self.data_offset, len(mfile))
+        results = []
+        pool = multiprocessing.Pool(ranges)
         try:
-            while(True):
-                # pylint: disable=E1101
-                db = PL_DataBlockHeader.from_buffer_copy(mfile,current_pos)
-                nbs += 1
-                if db.Type == PL_SingleWFType or db.Type == PL_ExtEventType:
-                    event_type[index] = db.Type
-                    event_channel[index] = db.Channel
-                    event_unit[index] = db.Unit
-                    event_timestamp[index] = db.TimeStamp/ad_frequency
-                    index += 1
-                waveform_size = db.NumberOfWaveforms * db.NumberOfWordsInWaveform *2
-                current_pos += db_size + waveform_size      # skip waveform block
-                
-                if callback and nbs % 30000 == 0:        # callback to indicate progress every 30000 blocks
-                    elapsed_time = time.time() - start_time
-                    avg_speed = (current_pos - data_offset)/10**6/(elapsed_time)
-                    current_speed = previous_speed * 0.5 + avg_speed * 0.5
-                    previous_speed = current_speed
-                    estimated_time_left = (end_offset - current_pos)/10**6/current_speed
-                    done_size = current_pos/10**6
-                    done_percentage = current_pos / end_offset
-                    callback(done_percentage,done_size,file_size,elapsed_time,estimated_time_left)
-        except ValueError:
-            if callback:
-                elapsed_time = time.time() - start_time
-                callback(1.0,file_size,file_size,elapsed_time,0.0)
-            return {'type':event_type, 'channel':event_channel, 'unit':event_unit, 'timestamp':event_timestamp}
+            for result in pool.imap(_parse_block_range, tasks):
+                if result is None:
+                    logger.warning("Cannot resynchronize on a data block in range %d of the file. "
+                                   "Parse the file serially." %len(results))
+                    return None
+                results.append(result)
+                progress.update(result[1], len(result[2]))
+        finally:
+            pool.terminate()
+        for i in xrange(1, len(results)):
+            if results[i-1][1] != results[i][0]:
+                logger.warning("Data blocks of range %d end at offset %d but range %d starts at offset %d. "
+                               "Parse the file serially." %(i-1, results[i-1][1], i, results[i][0]))
+                return None
+        progress.finish()
+        return np.concatenate([blocks for _begin, _end, blocks in results])
+    
+    def build_block_index(self, callback=None):
+        """
+        build_block_index(callback) -> block_index
+        
+        Parse the file and return offsets and headers of all data blocks in a structured
+        array of BLOCK_INDEX_DTYPE.
+        """
+        if self.workers > 1:
+            block_index = self._build_block_index_parallel(callback)
+            if block_index is not None:
+                return block_index
+        offsets = self.read_block_offsets(callback)
+        return self._make_block_index(offsets)
+    
+    def _make_block_index(self, offsets):
+        block_index = np.empty(len(offsets),dtype=BLOCK_INDEX_DTYPE)
+        block_index['Offset'] = offsets
+        for begin in xrange(0, len(offsets), GATHER_BLOCKS):
+            headers = self.read_block_headers(offsets[begin:begin+GATHER_BLOCKS])
+            for name in DATA_BLOCK_DTYPE.names:
+                block_index[name][begin:begin+GATHER_BLOCKS] = headers[name]
+        return block_index
+    
+    def get_block_index(self, callback=None):
+        """
+        get_block_index(callback) -> block_index
+        
+        Return the block index of the file. The index is built once per PlexFile object.
+        With index_cache the index is memory-mapped from the sidecar file if it is still
+        valid for the file, and is rebuilt and saved otherwise.
+        """
+        if self.block_index is not None:
+            return self.block_index
+        if self.index_cache:
+            key = self._get_index_key()
+            self.block_index = PlexIndex.load_index(self.filename, key, BLOCK_INDEX_DTYPE)
+            if self.block_index is not None:
+                ReadingProgress(callback, self.data_offset, len(self._get_mmap())).finish()
+                return self.block_index
+        self.block_index = self.build_block_index(callback)
+        if self.index_cache:
+            PlexIndex.save_index(self.filename, key, self.block_index)
+        return self.block_index
+    
+    def build_time_index(self, callback=None):
+        """
+        build_time_index(callback) -> time_index
+        
+        Build the sparse time index of TIME_INDEX_DTYPE from the block index. Blocks are
+        only roughly in time order in the file, e.g. an A/D block is written after the 
+        spikes recorded during its sampling. So every record keeps the running maximum 
+        of the timestamps before it and the running minimum after it, both of which are
+        sorted and can be binary searched.
+        """
+        block_index = self.get_block_index(callback)
+        ticks = get_block_ticks(block_index)
+        strides = np.arange(0, len(block_index), TIME_INDEX_STRIDE)
+        time_index = np.empty(len(strides),dtype=TIME_INDEX_DTYPE)
+        if len(strides) == 0:
+            return time_index
+        time_index['Offset'] = block_index['Offset'][strides]
+        time_index['MaxTickBefore'][0] = -1
+        time_index['MaxTickBefore'][1:] = np.maximum.accumulate(ticks)[strides[1:] - 1]
+        time_index['MinTickAfter'] = np.minimum.accumulate(ticks[::-1])[::-1][strides]
+        return time_index
+    
+    def get_time_index(self, callback=None):
+        """
+        get_time_index(callback) -> time_index
+        
+        Return the sparse time index of the file. Like the block index it is built once 
+        per PlexFile object and is cached in a sidecar file with index_cache.
+        """
+        if self.time_index is not None:
+            return self.time_index
+        if self.index_cache:
+            key = self._get_index_key()
+            self.time_index = PlexIndex.load_index(self.filename, key, TIME_INDEX_DTYPE,
+                                                   PlexIndex.TIME_INDEX_SUFFIX)
+            if self.time_index is not None:
+                return self.time_index
+        self.time_index = self.build_time_index(callback)
+        if self.index_cache:
+            PlexIndex.save_index(self.filename, key, self.time_index, PlexIndex.TIME_INDEX_SUFFIX)
+        return self.time_index
+    
+    def read_window_blocks(self, t0, t1, callback=None):
+        """
+        read_window_blocks(t0, t1, callback) -> blocks
+        
+        Return the block index records of the blocks with timestamps in [t0, t1) seconds.
+        Only the part of the file between the nearest sparse index records around the 
+        window is parsed.
+        """
+        time_index = self.get_time_index(callback)
+        if len(time_index) == 0:
+            return np.empty(0,dtype=BLOCK_INDEX_DTYPE)
+        begin_tick = int(np.ceil(t0 * self.file_header.ADFrequency))
+        end_tick = int(np.ceil(t1 * self.file_header.ADFrequency))
+        # all blocks before the first record are earlier than the window
+        first = max(np.searchsorted(time_index['MaxTickBefore'], begin_tick) - 1, 0)
+        # the last record and all blocks after it are later than the window
+        last = np.searchsorted(time_index['MinTickAfter'], end_tick)
+        begin_offset = time_index['Offset'][first]
+        end_offset = time_index['Offset'][last] if last < len(time_index) else None
+        if end_offset is not None and end_offset <= begin_offset:
+            return np.empty(0,dtype=BLOCK_INDEX_DTYPE)
+        offsets = self.read_block_offsets(begin_offset=begin_offset, end_offset=end_offset)
+        blocks = self._make_block_index(offsets)
+        ticks = get_block_ticks(blocks)
+        return blocks[(ticks >= begin_tick) & (ticks < end_tick)]
+    
+    def read_window(self, t0, t1, types=None, channels=None, callback=None):
+        """
+        read_window(t0, t1, types, channels, callback) -> {'type', 'channel', 'unit', 'timestamp'}
+        
+        Parameters
+        ----------
+        t0, t1: float
+            Begin and end of the time window in seconds. The end is excluded.
+        types: sequence of int
+            Block types to read. Default is (PL_SingleWFType, PL_ExtEventType), i.e. the 
+            spikes and events returned by GetTimeStampArrays.
+        channels: sequence of int
+            Channels to read. Default is all channels.
+        callback(percentage,done_size,file_size,elapsed_time,left_time)
+            Callback method reports reading progress of the time index when it is built.
+        
+        Return dictionary of the timestamps in the time window. The cost of reading 
+        depends on the length of the window instead of the length of the file once 
+        the time index is built or loaded from the cache.
+        
+        Returns
+        -------
+        'type', 'channel', 'unit', 'timestamp': dict keys
+            Same as GetTimeStampArrays. For A/D blocks 'timestamp' is the time of the 
+            first sample in the block.
+        """
+        if types is None:
+            types = (PL_SingleWFType, PL_ExtEventType)
+        blocks = self.read_window_blocks(t0, t1, callback)
+        selected = np.in1d(blocks['Type'], types)
+        if channels is not None:
+            selected &= np.in1d(blocks['Channel'], channels)
+        return self._get_timestamp_arrays(blocks[selected])
+    
+    def _get_timestamp_arrays(self, blocks):
+        return {'type':blocks['Type'].astype(np.uint16),
+                'channel':blocks['Channel'].astype(np.uint16),
+                'unit':blocks['Unit'].astype(np.uint16),
+                'timestamp':get_block_ticks(blocks)}
+    
+    def _get_events(self, blocks):
+        block_type = blocks['Type']
+        return blocks[(block_type == PL_SingleWFType) | (block_type == PL_ExtEventType)]
+    
+    def read_timestamps(self, callback):
+        block_index = self.get_block_index(callback)
+        return self._get_timestamp_arrays(self._get_events(block_index))
+    
+    def iter_block_chunks(self, chunk_blocks=EVENT_CHUNK_SIZE, callback=None):
+        """
+        iter_block_chunks(chunk_blocks, callback) -> generator of blocks
+        
+        Generate the block index records of the file in chunks of at most chunk_blocks
+        blocks. A block index already built or cached is sliced. Otherwise the file is
+        parsed a chunk at a time and the block index of the whole file is never held 
+        in memory, unless with index_cache the chunks are kept to save the index after
+        the last chunk.
+        """
+        if self.block_index is None and self.index_cache:
+            self.block_index = PlexIndex.load_index(self.filename, self._get_index_key(), BLOCK_INDEX_DTYPE)
+        mfile = self._get_mmap()
+        progress = ReadingProgress(callback, self.data_offset, len(mfile))
+        if self.block_index is not None:
+            for begin in xrange(0, len(self.block_index), chunk_blocks):
+                blocks = self.block_index[begin:begin+chunk_blocks]
+                progress.update(blocks['Offset'][-1], len(blocks))
+                yield blocks
+            progress.finish()
+            return
+        # the block index records are much smaller than the events read from them
+        index_chunks = [] if self.index_cache else None
+        pos = self.data_offset
+        while True:
+            offsets = self.read_block_offsets(begin_offset=pos, max_blocks=chunk_blocks)
+            if len(offsets) == 0:
+                break
+            blocks = self._make_block_index(offsets)
+            if index_chunks is not None:
+                index_chunks.append(blocks)
+            pos = self._get_block_end(blocks[-1])
+            progress.update(pos, len(blocks))
+            yield blocks
+            if len(offsets) < chunk_blocks:
+                break
+        if index_chunks is not None:
+            if index_chunks:
+                self.block_index = np.concatenate(index_chunks)
+            else:
+                self.block_index = np.empty(0,dtype=BLOCK_INDEX_DTYPE)
+            PlexIndex.save_index(self.filename, self._get_index_key(), self.block_index)
+        progress.finish()
+    
+    def iter_events(self, chunk_events=EVENT_CHUNK_SIZE, callback=None):
+        """
+        iter_events(chunk_events, callback) -> generator of {'type', 'channel', 'unit', 'timestamp'}
+        
+        Parameters
+        ----------
+        chunk_events: int
+            Maximum number of timestamps in a chunk.
+        callback(percentage,done_size,file_size,elapsed_time,left_time)
+            Callback method reports file reading progress.
+        
+        Generate the timestamps of the file in chunks of bounded size so that a file
+        larger than the memory can be processed. The chunks are in the format of 
+        GetTimeStampArrays and follow the order of the file.
+        """
+        for blocks in self.iter_block_chunks(chunk_events, callback):
+            events = self._get_events(blocks)
+            if len(events):
+                yield self._get_timestamp_arrays(events)
+    
+    def read_appended_blocks(self, callback=None, max_blocks=EVENT_CHUNK_SIZE):
+        """
+        read_appended_blocks(callback, max_blocks) -> blocks
+        
+        Return the block index records of at most max_blocks complete blocks after the 
+        blocks returned before. The file is remapped when it has grown. A block at the
+        end of the file whose header or data is not completely written is left for a 
+        later call.
+        """
+        self._remap_grown_file()
+        file_size = len(self._get_mmap())
+        offsets = self.read_block_offsets(callback, begin_offset=self.follow_offset, max_blocks=max_blocks)
+        blocks = self._make_block_index(offsets)
+        block_ends = blocks['Offset'] + ctypes.sizeof(PL_DataBlockHeader) + \
+                     2 * blocks['NumberOfWaveforms'].astype(np.int64) * blocks['NumberOfWordsInWaveform']
+        blocks = blocks[block_ends <= file_size]
+        if len(blocks):
+            self.follow_offset = self._get_block_end(blocks[-1])
+        return blocks
     
     def GetTimeStampArrays(self,callback=None):
         """
@@ -261,14 +911,18 @@ class PlexFile(object):
         callback(percentage,done_size,file_size,elapsed_time,left_time)
             Callback method reports file reading progress.
         
-        Return dictionary of all timestamps.
+        Return dictionary of all timestamps. In follow mode only the timestamps of the
+        blocks appended since the last call are returned, at most EVENT_CHUNK_SIZE blocks
+        at a time.
         
         Returns
         -------
         'type', 'channel', 'unit', 'timestamp': dict keys
             Values are four 1-D arrays of the timestamp structure fields. The array length is the actual transferred TimeStamps.
-            'timestamp' is converted to seconds.
+            'timestamp' is the 40-bit timestamp in ticks as int64. Divide it by GetTimeStampFrequency() to get seconds.
         """
+        if self.follow:
+            return self._get_timestamp_arrays(self._get_events(self.read_appended_blocks(callback)))
         data = self.read_timestamps(callback)
         return data
 
@@ -277,69 +931,204 @@ class PlexFile(object):
         data['type'] = np.empty(0,dtype=np.uint16)
         data['channel'] = np.empty(0,dtype=np.uint16)
         data['unit'] = np.empty(0,dtype=np.uint16)
-        data['timestamp'] = np.empty(0)
+        data['timestamp'] = np.empty(0,dtype=np.int64)
         return data
     
-    def read_ad_data(self, callback=None):
-        self.read_data_header()
-        gains = [self.slow_headers[channel].Gain for channel in xrange(self.file_header.NumSlowChannels)]
-        adfreqs = [self.slow_headers[channel].ADFreq for channel in xrange(self.file_header.NumSlowChannels)]
+    def GetTimeStampFrequency(self):
+        """
+        GetTimeStampFrequency() -> integer
         
-        ad_data_counts = self.ad_data_counts
-        wf_buffer = (ctypes.c_short * 256)()
-        ad_channel = np.zeros(ad_data_counts,dtype=np.uint16)
-        ad_value = np.zeros(ad_data_counts,dtype=np.float32)
-        ad_timestamp = np.zeros(ad_data_counts,dtype=np.float32)
-        index = 0
+        Return the number of timestamp ticks per second.
+        """
+        return self.file_header.ADFrequency
+    
+    def _get_word_view(self):
+        """
+        The data region of the file viewed as 16-bit words.
+        """
+        mfile = self._get_mmap()
+        return np.ndarray(shape=(max(len(mfile) - self.data_offset, 0)//2,), dtype='<i2',
+                          buffer=mfile, offset=min(self.data_offset, len(mfile)))
+    
+    def _complete_blocks(self, blocks):
+        """
+        Drop the blocks whose waveform is truncated at the end of the file.
+        """
+        words = blocks['NumberOfWaveforms'].astype(np.int64) * blocks['NumberOfWordsInWaveform']
+        complete = blocks['Offset'] + ctypes.sizeof(PL_DataBlockHeader) + 2*words <= len(self._get_mmap())
+        if not complete.all():
+            logger.warning("Found %d truncated data blocks at the end of the file." %(complete.size - complete.sum()))
+            blocks = blocks[complete]
+        return blocks
+    
+    def read_block_waveforms(self, blocks):
+        """
+        read_block_waveforms(blocks) -> (words, counts)
         
-        ad_frequency = self.file_header.ADFrequency
+        Gather the waveform words following the headers of blocks, in the order of blocks.
+        Parameters
+        ----------
+        blocks: array of BLOCK_INDEX_DTYPE
         
-        fileno = self.file.fileno()
-        mfile = mmap.mmap(fileno,0,access=mmap.ACCESS_READ)
-
-        # timing file processing
-        start_time = time.time()
-        previous_speed = 20.0
-        current_speed = previous_speed
-        end_offset = len(mfile)
-        file_size = end_offset/10**6
-        nbs = 0
-        
-        current_pos = self.data_offset
-        data_offset = self.data_offset
+        Returns
+        -------
+        words: int16 array of the concatenated waveform words
+        counts: int64 array of the number of words of every block
+        """
+        counts = blocks['NumberOfWaveforms'].astype(np.int64) * blocks['NumberOfWordsInWaveform']
+        starts = (blocks['Offset'] - self.data_offset)//2 + ctypes.sizeof(PL_DataBlockHeader)//2
+        file_words = self._get_word_view()
+        words = np.empty(counts.sum(),dtype=np.int16)
+        done = 0
+        for begin in xrange(0, len(blocks), GATHER_BLOCKS//16):
+            block_counts = counts[begin:begin+GATHER_BLOCKS//16]
+            block_begins = np.cumsum(block_counts) - block_counts
+            num = block_counts.sum()
+            # word j of block k is found at starts[k] + j, with j counted from block_begins[k]
+            indices = np.repeat(starts[begin:begin+GATHER_BLOCKS//16] - block_begins, block_counts) + \
+                      np.arange(num,dtype=np.int64)
+            words[done:done+num] = file_words[indices]
+            done += num
+        return words, counts
+    
+    def _read_ad_blocks(self, callback=None):
+        if self.slow_headers is None:
+            self.read_data_header()
+        block_index = self.get_block_index(callback)
+        ad_blocks = self._complete_blocks(block_index[block_index['Type'] == PL_ADDataType])
+        samples, counts = self.read_block_waveforms(ad_blocks)
+        return ad_blocks, samples, counts
+    
+    def _get_chan_header(self, channel):
+        for header in self.chan_headers:
+            if header.Channel == channel:
+                return header
+        raise RuntimeError("Cannot find the header of DSP channel %d." %channel)
+    
+    def get_spike_mv_per_bit(self, channel):
+        """
+        get_spike_mv_per_bit(channel) -> mv_per_bit
+        
+        Voltage in mV of one bit of the spike waveform adc values of the DSP channel.
+        """
+        if self.chan_headers is None:
+            self.read_data_header()
+        gain = self._get_chan_header(channel).Gain * self.file_header.SpikePreAmpGain
+        max_value = 0.5 * 2**self.file_header.BitsPerSpikeSample
+        return self.file_header.SpikeMaxMagnitudeMV / max_value / gain
+    
+    def get_waveforms(self, channel, unit, callback=None):
+        """
+        get_waveforms(channel, unit, callback) -> PlexWaveforms
+        
+        Parameters
+        ----------
+        channel: int
+            DSP channel number, 1-based.
+        unit: int
+            Unit number, 0 for unsorted spikes.
+        callback(percentage,done_size,file_size,elapsed_time,left_time)
+            Callback method reports file reading progress when the block index is built.
+        
+        Return the waveforms of all spikes of the unit. No waveform is copied if the 
+        blocks of the unit are evenly spaced in the file, which is the case for a file
+        with a single channel or with the spikes of a channel written in a run.
+        """
+        block_index = self.get_block_index(callback)
+        blocks = block_index[(block_index['Type'] == PL_SingleWFType) & \
+                             (block_index['Channel'] == channel) & \
+                             (block_index['Unit'] == unit) & \
+                             (block_index['NumberOfWaveforms'] > 0)]
+        blocks = self._complete_blocks(blocks)
+        points = np.unique(blocks['NumberOfWaveforms'].astype(np.int64) * blocks['NumberOfWordsInWaveform'])
+        if len(points) > 1:
+            raise RuntimeError("Waveforms of channel %d unit %d have different lengths." %(channel, unit))
+        points = int(points[0]) if len(points) else self.file_header.NumPointsWave
         db_size = ctypes.sizeof(PL_DataBlockHeader)
-        try:
-            while(True):
-                # pylint: disable=E1101
-                db = PL_DataBlockHeader.from_buffer_copy(mfile,current_pos)
-                waveform_size = db.NumberOfWaveforms * db.NumberOfWordsInWaveform * 2
-                current_pos += db_size
-                if db.Type == PL_ADDataType:
-                    channel = db.Channel
-                    ctypes.memmove(wf_buffer, mfile[current_pos:current_pos+waveform_size], waveform_size)
-                    for i in xrange(db.NumberOfWordsInWaveform):
-                        ad_channel[index] = channel
-                        ad_value[index] = (wf_buffer[i]*5./2048.)/gains[channel]
-                        ad_timestamp[index] = (db.TimeStamp + i*ad_frequency/adfreqs[channel])/ad_frequency
-                        index += 1
-                current_pos += waveform_size
-                
-                nbs += 1
-                if callback and nbs % 30000 == 0:        # callback to indicate progress every 30000 blocks
-                    elapsed_time = time.time() - start_time
-                    avg_speed = (current_pos - data_offset)/10**6/(elapsed_time)
-                    current_speed = previous_speed * 0.5 + avg_speed * 0.5
-                    previous_speed = current_speed
-                    estimated_time_left = (end_offset - current_pos)/10**6/current_speed
-                    done_size = current_pos/10**6
-                    done_percentage = current_pos / end_offset
-                    callback(done_percentage,done_size,file_size,elapsed_time,estimated_time_left)
-        except ValueError:
-            if callback:
-                elapsed_time = time.time() - start_time
-                callback(1.0,file_size,file_size,elapsed_time,0.0)
-            return {'channel':ad_channel, 'value':ad_value, 'timestamp':ad_timestamp}
+        offsets = blocks['Offset']
+        view = None
+        if len(offsets) > 0:
+            strides = np.unique(np.diff(offsets))
+            if len(strides) <= 1:
+                stride = int(strides[0]) if len(strides) else db_size + 2*points
+                view = np.ndarray(shape=(len(offsets), points), dtype='<i2', buffer=self._get_mmap(),
+                                  offset=int(offsets[0]) + db_size, strides=(stride, 2))
+        starts = (offsets - self.data_offset + db_size)//2
+        return PlexWaveforms(self._get_word_view(), starts, points, view, channel, unit,
+                             self.get_spike_mv_per_bit(channel), get_block_ticks(blocks),
+                             self.file_header.ADFrequency)
+    
+    def _get_slow_header(self, channel):
+        for header in self.slow_headers:
+            if header.Channel == channel:
+                return header
+        raise RuntimeError("Cannot find the header of slow channel %d." %channel)
+    
+    def read_ad_data(self, callback=None):
+        ad_blocks, samples, counts = self._read_ad_blocks(callback)
+        ad_frequency = self.file_header.ADFrequency
+        block_channel = ad_blocks['Channel']
+        gains = np.ones(len(ad_blocks))
+        adfreqs = np.ones(len(ad_blocks))
+        for channel in np.unique(block_channel):
+            header = self._get_slow_header(channel)
+            gains[block_channel == channel] = header.Gain
+            adfreqs[block_channel == channel] = header.ADFreq
+        block_begins = np.cumsum(counts) - counts
+        sample_index = np.arange(counts.sum()) - np.repeat(block_begins, counts)
+        ad_channel = np.repeat(block_channel, counts).astype(np.uint16)
+        ad_value = ((samples*5./2048.)/np.repeat(gains, counts)).astype(np.float32)
+        ad_timestamp = ((np.repeat(ad_blocks['TimeStamp'], counts) + \
+                         sample_index*ad_frequency/np.repeat(adfreqs, counts))/ad_frequency).astype(np.float32)
+        return {'channel':ad_channel, 'value':ad_value, 'timestamp':ad_timestamp}
+    
+    def read_continuous(self, callback=None):
+        ad_blocks, samples, counts = self._read_ad_blocks(callback)
+        ad_frequency = self.file_header.ADFrequency
+        block_ticks = get_block_ticks(ad_blocks)
+        sample_begins = np.cumsum(counts) - counts
+        channels = {}
+        for channel in np.unique(ad_blocks['Channel']):
+            header = self._get_slow_header(channel)
+            take = np.flatnonzero(ad_blocks['Channel'] == channel)
+            channel_counts = counts[take]
+            channel_begins = np.cumsum(channel_counts) - channel_counts
+            sample_indices = np.repeat(sample_begins[take] - channel_begins, channel_counts) + \
+                             np.arange(channel_counts.sum(),dtype=np.int64)
+            values = (samples[sample_indices]*(5./2048./header.Gain)).astype(np.float32)
+            # a block continues the segment when it starts where the previous block ends
+            ticks = block_ticks[take]
+            expected_ticks = ticks[:-1] + channel_counts[:-1]*ad_frequency/header.ADFreq
+            segment_begins = np.concatenate(([0], np.flatnonzero(np.abs(ticks[1:] - expected_ticks) > 1) + 1))
+            segments = np.empty(len(segment_begins),dtype=SEGMENT_DTYPE)
+            segments['tick'] = ticks[segment_begins]
+            segments['count'] = np.add.reduceat(channel_counts, segment_begins)
+            channels[channel] = PlexContinuousChannel(header, ad_frequency, values, segments)
+        return channels
+    
+    def GetContinuousChannels(self,callback=None):
+        """
+        GetContinuousChannels(callback) -> {channel: PlexContinuousChannel}
         
+        Parameters
+        ----------
+        callback(percentage,done_size,file_size,elapsed_time,left_time)
+            Callback method reports file reading progress.
+        
+        Return continuous A/D data of all slow channels.
+        
+        Returns
+        -------
+        channel: dict keys
+            Slow channel numbers, 0-based.
+        PlexContinuousChannel: dict values
+            Scaled samples of the channel in one array and the (tick, count) table of 
+            the segments of contiguous sampling. Timestamps of the samples are only 
+            computed on demand.
+        """
+        data = self.read_continuous(callback)
+        return data
+    
     def GetADDataArrays(self,callback=None):
         """
         GetADDataArrays(callback) -> {'channel', 'value', 'timestamp'}
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Share one PlexClient stream among several readers
+###########################################################
+
+import threading
+import weakref
+import numpy as np
+import logging
+logger = logging.getLogger('SpikeRecord.Plexon')
+from SpikeRecord.Plexon.PlexClient import PlexClient
+from SpikeRecord.Plexon.PlexBuffer import EVENT_DTYPES
+
+class PlexHub(object):
+    """
+    Read events once from a client and fan them out to subscribers.
+
+    Every read of the client is kept as a batch until all subscribers have read it. The
+    arrays of a batch are shared read-only by the subscribers without copying. Each
+    subscriber has its own cursor and sees the events read from the client after its
+    subscription. Subscribers are referenced weakly so a subscriber dropped by its 
+    reader stops holding batches. Without subscribers nothing is held, and with acquire
+    the acquisition thread of the client only runs while the hub has subscribers.
+    Parameters
+    ----------
+    client: PlexClient or an object of the same interface
+        initialized client the events are read from
+    acquire: bool
+        start and stop the acquisition thread of the client with the subscriptions
+    """
+    def __init__(self, client, acquire=False):
+        self.client = client
+        self.acquire = acquire
+        # a subscriber collected while the lock is held releases it in the same thread
+        self.lock = threading.RLock()
+        self.batches = []
+        # number of the first batch in batches
+        self.first_batch = 0
+        # weak references of the subscribers
+        self.subscribers = set()
+
+    @property
+    def end(self):
+        return self.first_batch + len(self.batches)
+
+    def subscribe(self):
+        """
+        subscribe() -> subscriber
+
+        Return a PlexHubSubscriber reading the events from now on. The events the client
+        has acquired before are read and skipped.
+        """
+        subscriber = PlexHubSubscriber(self)
+        with self.lock:
+            if not self.subscribers and self.acquire:
+                self.client.StartAcquisition()
+            self._poll()
+            self.subscribers.add(weakref.ref(subscriber, self._remove))
+            subscriber.cursor = self.end
+            self._trim()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        unsubscribe(subscriber)
+
+        Stop holding batches for the subscriber.
+        """
+        self._remove(weakref.ref(subscriber))
+
+    def _remove(self, subscriber_ref):
+        with self.lock:
+            if subscriber_ref not in self.subscribers:
+                return
+            self.subscribers.discard(subscriber_ref)
+            self._trim()
+            if not self.subscribers and self.acquire:
+                # events acquired without subscribers would pile up in the client
+                self.client.StopAcquisition()
+
+    def _poll(self):
+        data = self.client.GetTimeStampArrays()
+        if len(data['timestamp']) == 0:
+            return
+        batch = {}
+        for key, array in data.iteritems():
+            # the client may reuse its arrays so they are copied once here
+            if not array.flags.owndata:
+                array = array.copy()
+            array.flags.writeable = False
+            batch[key] = array
+        self.batches.append(batch)
+
+    def _trim(self):
+        subscribers = [subscriber_ref() for subscriber_ref in list(self.subscribers)]
+        cursors = [subscriber.cursor for subscriber in subscribers if subscriber is not None]
+        oldest = min(cursors) if cursors else self.end
+        if oldest > self.first_batch:
+            del self.batches[:oldest - self.first_batch]
+            self.first_batch = oldest
+
+    def read(self, subscriber):
+        """
+        read(subscriber) -> {'type', 'channel', 'unit', 'timestamp'}
+
+        Poll the client and return the events the subscriber has not read.
+        """
+        with self.lock:
+            self._poll()
+            batches = self.batches[max(subscriber.cursor - self.first_batch, 0):]
+            subscriber.cursor = self.end
+            self._trim()
+        if len(batches) == 1:
+            return batches[0]
+        if len(batches) == 0:
+            return dict((key, np.empty(0, dtype=dtype)) for key, dtype in EVENT_DTYPES)
+        return dict((key, np.concatenate([batch[key] for batch in batches])) for key in batches[0])
+
+class PlexHubSubscriber(object):
+    """
+    Reader of a PlexHub with the PlexClient interface used by PlexSpikeData.
+    """
+    def __init__(self, hub):
+        self.hub = hub
+        self.cursor = 0
+    def InitClient(self):
+        pass
+    def CloseClient(self):
+        self.hub.unsubscribe(self)
+    def GetTimeStampFrequency(self):
+        return self.hub.client.GetTimeStampFrequency()
+    def GetTimeStampArrays(self):
+        return self.hub.read(self)
+
+_hub = None
+_hub_lock = threading.Lock()
+
+def get_hub():
+    """
+    get_hub() -> hub
+
+    The hub of the PlexClient shared in the process. The client is initialized when the
+    hub is first used, and its acquisition thread runs while the hub has subscribers.
+    """
+    global _hub
+    with _hub_lock:
+        if _hub is None:
+            client = PlexClient()
+            client.InitClient()
+            _hub = PlexHub(client, acquire=True)
+        return _hub
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Sidecar block index cache for Plexon plx files
+###########################################################
+
+import os
+import struct
+import numpy as np
+import logging
+logger = logging.getLogger('SpikeRecord.Plexon')
+
+INDEX_MAGIC = 'PLXINDEX'
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+TIME_INDEX_SUFFIX = '.tidx'
+
+# magic, version, plx file size, plx file mtime, plx header checksum, number of records
+INDEX_HEADER = struct.Struct('<8sIQdIQ')
+INDEX_HEADER_SIZE = 64
+
+def index_path(filename, suffix=INDEX_SUFFIX):
+    return filename + suffix
+
+def load_index(filename, key, dtype, suffix=INDEX_SUFFIX):
+    """
+    load_index(filename, key, dtype, suffix) -> records
+
+    Memory-map the sidecar index of the plx file.
+    Parameters
+    ----------
+    filename: str
+        path of the plx file
+    key: tuple
+        (size, mtime, checksum) of the plx file when the index is wanted
+    dtype: numpy dtype
+        record type of the index
+    suffix: str
+        suffix of the sidecar file, INDEX_SUFFIX or TIME_INDEX_SUFFIX
+
+    Returns
+    -------
+    records: read-only memmap of the index records, or None if the index is missing,
+        corrupted or built for another version of the plx file.
+    """
+    path = index_path(filename, suffix)
+    try:
+        with open(path, 'rb') as index_file:
+            header = index_file.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            return None
+        magic, version, size, mtime, checksum, records = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or (size, mtime, checksum) != tuple(key):
+            logger.info("Index file %s is out of date." %path)
+            return None
+        dtype = np.dtype(dtype)
+        if os.path.getsize(path) != INDEX_HEADER_SIZE + records * dtype.itemsize:
+            logger.warning("Index file %s is truncated." %path)
+            return None
+        if records == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', offset=INDEX_HEADER_SIZE, shape=(records,))
+    except (IOError, OSError):
+        return None
+
+def save_index(filename, key, records, suffix=INDEX_SUFFIX):
+    """
+    save_index(filename, key, records, suffix)
+
+    Write the records as the sidecar index of the plx file. The index is written to a
+    temporary file first and renamed so that an interrupted writing leaves no partial
+    index behind. Failures, e.g. on a read-only share, are logged and ignored.
+    """
+    path = index_path(filename, suffix)
+    temp_path = path + '.tmp'
+    size, mtime, checksum = key
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, size, mtime, checksum, len(records))
+    try:
+        with open(temp_path, 'wb') as index_file:
+            index_file.write(header.ljust(INDEX_HEADER_SIZE, '\0'))
+            np.ascontiguousarray(records).tofile(index_file)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+    except (IOError, OSError), e:
+        logger.warning("Cannot write index file %s: %s" %(path, e))
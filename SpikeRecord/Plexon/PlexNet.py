@@ -0,0 +1,414 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Stream Plexon timestamps over the network
+###########################################################
+
+"""
+Publish the batches of GetTimeStampArrays from the acquisition host and read them on
+analysis hosts through the PlexClient interface.
+
+Protocol, all integers little-endian:
+    request   subscriber -> publisher  'PLXR', next sequence number wanted (uint64)
+    hello     publisher -> subscriber  'PLXH', timestamp frequency (uint32), sequence number of the next frame (uint64)
+    frame     publisher -> subscriber  'PLXD', sequence number (uint64), number of events n (uint32),
+                                       followed by n types (uint16), n channels (uint16), n units (uint16)
+                                       and n timestamps (int64)
+
+A subscriber reconnecting asks for the frame after the last one it received and the
+publisher resends the frames still in its history. A subscriber that does not keep up
+with the stream is disconnected instead of stalling the acquisition, and resumes the
+same way.
+
+Usage: python PlexNet.py publish [address]
+       python PlexNet.py replay file.plx [address] [speed]
+address is host:port for TCP or a path for a Unix socket, default is 0.0.0.0:6100.
+"""
+
+import sys
+import time
+import socket
+import struct
+import threading
+import collections
+import Queue
+import numpy as np
+import logging
+logger = logging.getLogger('SpikeRecord.Plexon')
+from SpikeRecord.Plexon.PlexBuffer import EventRing, EVENT_DTYPES
+
+DEFAULT_ADDRESS = ('0.0.0.0', 6100)
+REQUEST = struct.Struct('<4sQ')
+HELLO = struct.Struct('<4sIQ')
+FRAME = struct.Struct('<4sQI')
+REQUEST_MAGIC = 'PLXR'
+HELLO_MAGIC = 'PLXH'
+FRAME_MAGIC = 'PLXD'
+# sequence number requested by a new subscriber to start from the next frame
+NEW_STREAM = (1<<64) - 1
+# frames kept by the publisher for reconnecting subscribers
+HISTORY_FRAMES = 1024
+# frames queued for a subscriber before it is disconnected as too slow
+MAX_PENDING_FRAMES = 256
+# seconds between polls of the client by the publisher
+PUBLISH_INTERVAL = 0.05
+# seconds between reconnection attempts of the subscriber
+RECONNECT_INTERVAL = 1.0
+# seconds InitClient waits for the hello of the publisher
+CONNECT_TIMEOUT = 5.0
+# bytes of one event in a frame
+EVENT_BYTES = sum(np.dtype(dtype).itemsize for _key, dtype in EVENT_DTYPES)
+
+def parse_address(address):
+    """
+    parse_address(address) -> (family, address)
+
+    A (host, port) tuple or a 'host:port' string is a TCP address, other strings are
+    paths of Unix sockets.
+    """
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return socket.AF_INET, (host or '0.0.0.0', int(port))
+    return socket.AF_UNIX, address
+
+def encode_frame(sequence, data):
+    count = len(data['timestamp'])
+    arrays = [np.ascontiguousarray(data[key], dtype=np.dtype(dtype).newbyteorder('<')).tostring()
+              for key, dtype in EVENT_DTYPES]
+    return FRAME.pack(FRAME_MAGIC, sequence, count) + ''.join(arrays)
+
+def decode_frame(payload, count):
+    data = {}
+    offset = 0
+    for key, dtype in EVENT_DTYPES:
+        dtype = np.dtype(dtype).newbyteorder('<')
+        data[key] = np.frombuffer(payload, dtype=dtype, count=count, offset=offset).astype(np.dtype(dtype).newbyteorder('='))
+        offset += count * dtype.itemsize
+    return data
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1<<20))
+        if not chunk:
+            raise EOFError("Connection closed.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+class PlexPublisher(object):
+    """
+    Serve the events of a client to PlexSubscriber objects over TCP or a Unix socket.
+    Parameters
+    ----------
+    client: PlexClient or an object of the same interface
+        initialized client the events are read from
+    address: tuple or str
+        address to listen on, see parse_address
+    interval: float
+        seconds between polls of the client
+    """
+    def __init__(self, client, address=DEFAULT_ADDRESS, interval=PUBLISH_INTERVAL):
+        self.client = client
+        self.family, self.address = parse_address(address)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=HISTORY_FRAMES)
+        self.sequence = 0
+        self.connections = []
+        self.stopping = threading.Event()
+        self.threads = []
+        self.serve_threads = []
+        self.server = None
+        self.stats = {'frames':0, 'events':0, 'dropped_subscribers':0}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.server = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen(8)
+        self.server.settimeout(0.2)
+        self.stopping.clear()
+        for target in (self._accept, self._publish):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+        for thread in self.serve_threads:
+            thread.join()
+        self.serve_threads = []
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def _accept(self):
+        while not self.stopping.is_set():
+            try:
+                sock, _address = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                logger.warning("Publisher stopped accepting subscribers: %s" %e)
+                return
+            sock.settimeout(CONNECT_TIMEOUT)
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+            self.serve_threads = [thread for thread in self.serve_threads if thread.is_alive()] + [thread]
+
+    def _serve(self, sock):
+        try:
+            magic, wanted = REQUEST.unpack(recv_exactly(sock, REQUEST.size))
+            if magic != REQUEST_MAGIC:
+                raise ValueError("Bad subscriber request.")
+            sock.settimeout(None)
+            with self.lock:
+                if wanted == NEW_STREAM or wanted > self.sequence:
+                    wanted = self.sequence
+                # frames still in the history are resent before the new frames
+                frames = [frame for sequence, frame in self.history if sequence >= wanted]
+                first = self.sequence - len(frames)
+                connection = PublisherConnection(sock, frames)
+                self.connections.append(connection)
+            sock.sendall(HELLO.pack(HELLO_MAGIC, self.client.GetTimeStampFrequency() or 0, first))
+            connection.send_frames(self.stopping)
+        except (socket.error, EOFError, ValueError), e:
+            logger.info("Subscriber disconnected: %s" %e)
+        finally:
+            with self.lock:
+                self.connections = [connection for connection in self.connections if connection.sock is not sock]
+            sock.close()
+
+    def _publish(self):
+        while not self.stopping.is_set():
+            data = self.client.GetTimeStampArrays()
+            if len(data['timestamp']):
+                self.publish(data)
+            self.stopping.wait(self.interval)
+
+    def publish(self, data):
+        """
+        publish(data)
+
+        Send a {'type', 'channel', 'unit', 'timestamp'} batch to all subscribers as the
+        next frame.
+        """
+        with self.lock:
+            frame = encode_frame(self.sequence, data)
+            self.history.append((self.sequence, frame))
+            self.sequence += 1
+            self.stats['frames'] += 1
+            self.stats['events'] += len(data['timestamp'])
+            for connection in list(self.connections):
+                try:
+                    connection.queue.put_nowait(frame)
+                except Queue.Full:
+                    logger.warning("Subscriber does not keep up with the stream. Disconnect it.")
+                    self.stats['dropped_subscribers'] += 1
+                    self.connections.remove(connection)
+                    connection.close()
+
+class PublisherConnection(object):
+    def __init__(self, sock, backlog):
+        self.sock = sock
+        self.backlog = backlog
+        self.queue = Queue.Queue(MAX_PENDING_FRAMES)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def send_frames(self, stopping):
+        for frame in self.backlog:
+            if stopping.is_set() or self.closed:
+                return
+            self.sock.sendall(frame)
+        self.backlog = None
+        while not stopping.is_set() and not self.closed:
+            try:
+                frame = self.queue.get(timeout=0.2)
+            except Queue.Empty:
+                continue
+            self.sock.sendall(frame)
+
+class PlexSubscriber(object):
+    """
+    Read the events of a PlexPublisher through the PlexClient interface, e.g. as the
+    client of PlexSpikeData. A thread receives the frames into a ring buffer and
+    reconnects when the connection is lost.
+    Parameters
+    ----------
+    address: tuple or str
+        address of the publisher, see parse_address
+    sequence: int
+        sequence number of the first frame wanted, 0 for the oldest frame the publisher
+        still has, default is the next frame published
+    reconnect_interval: float
+        seconds between reconnection attempts
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, sequence=NEW_STREAM, reconnect_interval=RECONNECT_INTERVAL):
+        self.family, self.address = parse_address(address)
+        self.reconnect_interval = reconnect_interval
+        self.ring = EventRing()
+        self.ring_cursor = 0
+        self.frequency = None
+        self.next_sequence = sequence
+        self.sock = None
+        self.connected = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stats = {'frames':0, 'events':0, 'lost_frames':0, 'reconnects':0}
+
+    def __enter__(self):
+        self.InitClient()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.CloseClient()
+
+    def InitClient(self, timeout=CONNECT_TIMEOUT):
+        """
+        InitClient(timeout)
+
+        Start receiving and wait until the publisher is connected or timeout seconds passed.
+        """
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._receive, name='PlexSubscriber')
+            self.thread.daemon = True
+            self.thread.start()
+        if not self.connected.wait(timeout):
+            logger.warning("Cannot connect to the publisher at %s. Keep trying." %(self.address,))
+
+    def CloseClient(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self._disconnect()
+        self.thread.join()
+        self.thread = None
+
+    def GetTimeStampFrequency(self):
+        return self.frequency
+
+    def GetTimeStampArrays(self):
+        """
+        GetTimeStampArrays() -> {'type', 'channel', 'unit', 'timestamp'}
+
+        Return the events received since the last call.
+        """
+        data, self.ring_cursor = self.ring.read(self.ring_cursor)
+        self.ring.release(self.ring_cursor)
+        return data
+
+    def _disconnect(self):
+        self.connected.clear()
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.reconnect_interval)
+        sock.connect(self.address)
+        sock.settimeout(None)
+        sock.sendall(REQUEST.pack(REQUEST_MAGIC, self.next_sequence))
+        magic, frequency, first = HELLO.unpack(recv_exactly(sock, HELLO.size))
+        if magic != HELLO_MAGIC:
+            raise ValueError("Bad publisher hello.")
+        if self.next_sequence != NEW_STREAM and first > self.next_sequence:
+            self._lose_frames(first - self.next_sequence)
+        self.next_sequence = first
+        self.frequency = frequency or None
+        self.sock = sock
+        self.connected.set()
+
+    def _lose_frames(self, count):
+        logger.warning("Lost %d frames of the stream." %count)
+        self.stats['lost_frames'] += count
+
+    def _receive(self):
+        while not self.stopping.is_set():
+            try:
+                if self.sock is None:
+                    self._connect()
+                # CloseClient may clear self.sock from another thread. The socket it
+                # closes then fails the receiving with socket.error.
+                sock = self.sock
+                if sock is None:
+                    continue
+                magic, sequence, count = FRAME.unpack(recv_exactly(sock, FRAME.size))
+                if magic != FRAME_MAGIC:
+                    raise ValueError("Bad frame.")
+                data = decode_frame(recv_exactly(sock, count * EVENT_BYTES), count)
+            except (socket.error, EOFError, ValueError), e:
+                if self.stopping.is_set():
+                    break
+                if self.sock is not None:
+                    logger.warning("Lost connection to the publisher: %s" %e)
+                    self.stats['reconnects'] += 1
+                self._disconnect()
+                self.stopping.wait(self.reconnect_interval)
+                continue
+            if sequence > self.next_sequence:
+                self._lose_frames(sequence - self.next_sequence)
+            self.next_sequence = sequence + 1
+            self.ring.append(data)
+            self.stats['frames'] += 1
+            self.stats['events'] += count
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('publish', 'replay') or (argv[1] == 'replay' and len(argv) < 3):
+        print 'Usage: python %s publish [address]' %argv[0]
+        print '       python %s replay file.plx [address] [speed]' %argv[0]
+        return 1
+    if argv[1] == 'publish':
+        from SpikeRecord.Plexon.PlexClient import PlexClient
+        client = PlexClient()
+        client.InitClient()
+        client.StartAcquisition()
+        address = argv[2] if len(argv) > 2 else DEFAULT_ADDRESS
+    else:
+        from SpikeRecord.Plexon.PlexReplay import PlexReplayClient
+        client = PlexReplayClient(argv[2], speed=float(argv[4]) if len(argv) > 4 else 1.0)
+        client.InitClient()
+        address = argv[3] if len(argv) > 3 else DEFAULT_ADDRESS
+    with PlexPublisher(client, address) as publisher:
+        print 'Publishing at %s' %(publisher.address,)
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Replay a plx file in place of PlexClient
+###########################################################
+
+from __future__ import division
+import time
+import numpy as np
+import logging
+logger = logging.getLogger('SpikeRecord.Plexon')
+from SpikeRecord.Plexon.PlexClient import MAX_MAP_EVENTS_PER_READ
+from SpikeRecord.Plexon.PlexFile import PlexFile
+from SpikeRecord.Plexon.PlexStore import PlexStore, is_store
+
+class PlexReplayClient(object):
+    """
+    Serve the events of a plx file, or a store converted from it, through the PlexClient
+    interface. The events are released by the wall clock as if the file were being
+    recorded, so the online code paths can be driven and timed without a MAP server.
+    Parameters
+    ----------
+    filename: str
+        path of the plx file or store
+    speed: float
+        ratio of the replay speed to the recording speed
+    max_events: int
+        maximum number of events returned by one read, as the server buffer of PlexClient
+    index_cache: bool
+        save the block index of the plx file in a sidecar file, see PlexFile
+    """
+    def __init__(self, filename, speed=1.0, max_events=MAX_MAP_EVENTS_PER_READ, index_cache=False):
+        if speed <= 0:
+            raise ValueError("Replay speed must be positive.")
+        self.filename = filename
+        self.speed = speed
+        self.MAX_MAP_EVENTS_PER_READ = max_events
+        self.source = PlexStore(filename) if is_store(filename) else PlexFile(filename, index_cache=index_cache)
+        self.MAPSampleRate = None
+        self.events = None
+        self.release_ticks = None
+        self.start_time = None
+        self.start_tick = 0
+        self.position = 0
+        self.reads = 0
+    def __enter__(self):
+        self.InitClient()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.CloseClient()
+    def InitClient(self):
+        """
+        InitClient()
+
+        Load the events of the file and start the replay clock. The first event is
+        released immediately.
+        """
+        if self.events is None:
+            self.events = self.source.GetTimeStampArrays()
+            # an event is released once every event before it is due
+            self.release_ticks = np.maximum.accumulate(self.events['timestamp'])
+            self.MAPSampleRate = self.source.GetTimeStampFrequency()
+        self.start_tick = self.release_ticks[0] if len(self.release_ticks) else 0
+        self.start_time = time.time()
+        self.position = 0
+        self.reads = 0
+    def CloseClient(self):
+        self.start_time = None
+    def IsSortClientRunning(self):
+        return self.start_time is not None
+    def GetTimeStampTick(self):
+        """
+        GetTimeStampTick() -> integer
+
+        Return timestamp resolution in microseconds.
+        """
+        return int(round(1e6 / self.MAPSampleRate))
+    def GetTimeStampFrequency(self):
+        """
+        GetTimeStampFrequency() -> integer
+
+        Return the number of timestamp ticks per second, or None before the client is initialized.
+        """
+        if self.MAPSampleRate is None:
+            return None
+        return int(round(self.MAPSampleRate))
+    def IsLongWaveMode(self):
+        return False
+    def get_replay_tick(self):
+        """
+        get_replay_tick() -> tick
+
+        The file time in ticks that the replay clock has reached.
+        """
+        elapsed_time = time.time() - self.start_time
+        return self.start_tick + int(elapsed_time * self.speed * self.MAPSampleRate)
+    def is_finished(self):
+        return self.events is not None and self.position >= len(self.release_ticks)
+    def GetTimeStampArrays(self, num=None):
+        """
+        GetTimeStampArrays(num) -> {'type', 'channel', 'unit', 'timestamp'}
+
+        Return the events released since the last read, at most num of them. Events
+        not returned stay pending for the next read as in the server buffer.
+        Parameters
+        ----------
+        num: number
+            Interger of maximun number of timestamp structures, default is max_events
+
+        Returns
+        -------
+        'type', 'channel', 'unit', 'timestamp': dict keys
+            Same as PlexClient.GetTimeStampArrays.
+        """
+        if self.start_time is None:
+            raise RuntimeError("Replay client is not initialized.")
+        if num is None:
+            num = self.MAX_MAP_EVENTS_PER_READ
+        released = np.searchsorted(self.release_ticks, self.get_replay_tick(), side='right')
+        begin = self.position
+        end = max(begin, min(released, begin + num))
+        self.position = end
+        self.reads += 1
+        return dict((key, value[begin:end]) for key, value in self.events.iteritems())
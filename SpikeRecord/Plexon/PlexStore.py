@@ -0,0 +1,269 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Columnar store of Plexon plx files
+###########################################################
+
+"""
+Convert a plx file to a directory of .npy columns which are memory-mapped when the
+store is opened, so that the file is parsed only once.
+
+Layout of a store:
+    header.json                     file, channel, event and slow channel headers
+    events/{type,channel,unit,timestamp}.npy
+                                    timestamps of GetTimeStampArrays
+    spikes/ch<channel>_u<unit>.npy  spike timestamps in ticks of every unit
+    waveforms/ch<channel>_u<unit>.npy
+                                    int16 waveform matrix of every unit
+    continuous/ch<channel>_values.npy, continuous/ch<channel>_segments.npy
+                                    samples and segments of every slow channel
+
+Usage: python PlexStore.py file.plx [store_dir]
+"""
+
+import os
+import sys
+import json
+import shutil
+import ctypes
+import numpy as np
+import logging
+logger = logging.getLogger('SpikeRecord.Plexon')
+from SpikeRecord.Plexon.PlexFile import PlexFile, PlexWaveforms, PlexContinuousChannel, ReadingProgress, \
+                                        PL_FileHeader, PL_ChanHeader, PL_EventHeader, PL_SlowChannelHeader, \
+                                        PL_SingleWFType, EVENT_CHUNK_SIZE, get_block_ticks, get_header_datetime
+
+STORE_VERSION = 1
+STORE_SUFFIX = '.plxstore'
+HEADER_FILE = 'header.json'
+EVENT_COLUMNS = ('type', 'channel', 'unit', 'timestamp')
+
+def _header_to_json(header):
+    if isinstance(header, ctypes.Structure):
+        return dict((name, _header_to_json(getattr(header, name))) for name, _type in header._fields_)
+    if isinstance(header, ctypes.Array):
+        return [_header_to_json(value) for value in header]
+    if isinstance(header, str):
+        return header.decode('latin-1')
+    return header
+
+def _fill_array(array, values):
+    for i, value in enumerate(values):
+        if isinstance(array[i], ctypes.Array):
+            _fill_array(array[i], value)
+        else:
+            array[i] = value
+
+def _header_from_json(Header, values):
+    header = Header()
+    for name, _type in Header._fields_:
+        value = values[name]
+        field = getattr(header, name)
+        if isinstance(field, ctypes.Array):
+            _fill_array(field, value)
+        elif isinstance(value, unicode):
+            setattr(header, name, value.encode('latin-1'))
+        else:
+            setattr(header, name, value)
+    return header
+
+def _unit_name(channel, unit):
+    return 'ch%d_u%d.npy' %(channel, unit)
+
+def _channel_name(channel, column):
+    return 'ch%d_%s.npy' %(channel, column)
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+def convert_plx(filename, store_path=None, waveforms=True, callback=None):
+    """
+    convert_plx(filename, store_path, waveforms, callback) -> store_path
+
+    Convert the plx file to a store. The store is written next to the plx file by
+    default. It is written to a temporary directory first and renamed when complete,
+    and an existing store is replaced.
+    Parameters
+    ----------
+    filename: str
+        path of the plx file
+    store_path: str
+        directory of the store, default is the plx path with suffix STORE_SUFFIX
+    waveforms: bool
+        whether to store the spike waveforms
+    callback(percentage,done_size,file_size,elapsed_time,left_time)
+        Callback method reports file reading progress.
+    """
+    if store_path is None:
+        store_path = os.path.splitext(filename)[0] + STORE_SUFFIX
+    temp_path = store_path + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    for directory in ('events', 'spikes', 'waveforms', 'continuous'):
+        os.makedirs(os.path.join(temp_path, directory))
+
+    pf = PlexFile(filename)
+    pf.read_data_header()
+    block_index = pf.get_block_index(callback)
+
+    events = pf.GetTimeStampArrays()
+    for column in EVENT_COLUMNS:
+        np.save(os.path.join(temp_path, 'events', column + '.npy'), events[column])
+
+    spikes = block_index[block_index['Type'] == PL_SingleWFType]
+    units = sorted(set(zip(spikes['Channel'].tolist(), spikes['Unit'].tolist())))
+    spike_ticks = get_block_ticks(spikes)
+    waveform_info = []
+    for channel, unit in units:
+        unit_spikes = (spikes['Channel'] == channel) & (spikes['Unit'] == unit)
+        np.save(os.path.join(temp_path, 'spikes', _unit_name(channel, unit)), spike_ticks[unit_spikes])
+        if waveforms:
+            try:
+                unit_waveforms = pf.get_waveforms(channel, unit)
+            except RuntimeError, e:
+                logger.warning("Skip the waveforms of channel %d unit %d: %s" %(channel, unit, e))
+                continue
+            if len(unit_waveforms):
+                np.save(os.path.join(temp_path, 'waveforms', _unit_name(channel, unit)), unit_waveforms.values)
+                np.save(os.path.join(temp_path, 'waveforms', 'ch%d_u%d_ticks.npy' %(channel, unit)), unit_waveforms.ticks)
+                waveform_info.append({'channel':channel, 'unit':unit, 'points':unit_waveforms.points,
+                                      'mv_per_bit':unit_waveforms.mv_per_bit})
+
+    continuous = pf.read_continuous()
+    for channel, channel_data in continuous.iteritems():
+        np.save(os.path.join(temp_path, 'continuous', _channel_name(channel, 'values')), channel_data.values)
+        np.save(os.path.join(temp_path, 'continuous', _channel_name(channel, 'segments')), channel_data.segments)
+
+    header = {'version':STORE_VERSION,
+              'source':os.path.abspath(filename),
+              'timestamp_frequency':pf.GetTimeStampFrequency(),
+              'file_header':_header_to_json(pf.file_header),
+              'chan_headers':[_header_to_json(header) for header in pf.chan_headers],
+              'event_headers':[_header_to_json(header) for header in pf.event_headers],
+              'slow_headers':[_header_to_json(header) for header in pf.slow_headers],
+              'units':[[int(channel), int(unit)] for channel, unit in units],
+              'waveforms':waveform_info,
+              'continuous':sorted(int(channel) for channel in continuous)}
+    with open(os.path.join(temp_path, HEADER_FILE), 'w') as header_file:
+        json.dump(header, header_file)
+
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(temp_path, store_path)
+    return store_path
+
+class PlexStore(object):
+    """
+    Reading a store converted from a plx file
+
+    The store provides the reading methods of PlexFile used for offline analysis. All
+    arrays are memory-mapped read-only so opening a store costs no parsing.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE)) as header_file:
+            self.header = json.load(header_file)
+        if self.header['version'] != STORE_VERSION:
+            raise RuntimeError("Store version other than %d is not supported. "
+                               "The version of this store is %d." %(STORE_VERSION, self.header['version']))
+        self.filename = self.header['source']
+        self.file_header = _header_from_json(PL_FileHeader, self.header['file_header'])
+        self.chan_headers = [_header_from_json(PL_ChanHeader, header) for header in self.header['chan_headers']]
+        self.event_headers = [_header_from_json(PL_EventHeader, header) for header in self.header['event_headers']]
+        self.slow_headers = [_header_from_json(PL_SlowChannelHeader, header) for header in self.header['slow_headers']]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def _load(self, *names):
+        return np.load(os.path.join(self.path, *names), mmap_mode='r')
+
+    def get_datetime(self):
+        return get_header_datetime(self.file_header)
+
+    def get_units(self):
+        return [tuple(unit) for unit in self.header['units']]
+
+    def get_spike_train(self, channel, unit):
+        """
+        get_spike_train(channel, unit) -> timestamps
+
+        Spike timestamps of the unit in ticks.
+        """
+        if [channel, unit] not in self.header['units']:
+            return np.empty(0,dtype=np.int64)
+        return self._load('spikes', _unit_name(channel, unit))
+
+    def get_waveforms(self, channel, unit, callback=None):
+        for info in self.header['waveforms']:
+            if info['channel'] == channel and info['unit'] == unit:
+                values = self._load('waveforms', _unit_name(channel, unit))
+                ticks = self._load('waveforms', 'ch%d_u%d_ticks.npy' %(channel, unit))
+                return PlexWaveforms(None, np.arange(len(values)), info['points'], values, channel, unit,
+                                     info['mv_per_bit'], ticks, self.GetTimeStampFrequency())
+        raise RuntimeError("Cannot find the waveforms of channel %d unit %d in the store." %(channel, unit))
+
+    def GetContinuousChannels(self, callback=None):
+        ReadingProgress(callback, 0, 0).finish()
+        channels = {}
+        for channel in self.header['continuous']:
+            header = [header for header in self.slow_headers if header.Channel == channel][0]
+            channels[channel] = PlexContinuousChannel(header, self.GetTimeStampFrequency(),
+                                                      self._load('continuous', _channel_name(channel, 'values')),
+                                                      self._load('continuous', _channel_name(channel, 'segments')))
+        return channels
+
+    def GetTimeStampArrays(self, callback=None):
+        """
+        GetTimeStampArrays(callback) -> {'type', 'channel', 'unit', 'timestamp'}
+
+        Same as PlexFile.GetTimeStampArrays but the arrays are read-only memory maps.
+        """
+        ReadingProgress(callback, 0, 0).finish()
+        return dict((column, self._load('events', column + '.npy')) for column in EVENT_COLUMNS)
+
+    def iter_events(self, chunk_events=EVENT_CHUNK_SIZE, callback=None):
+        """
+        iter_events(chunk_events, callback) -> generator of {'type', 'channel', 'unit', 'timestamp'}
+
+        Same as PlexFile.iter_events.
+        """
+        data = dict((column, self._load('events', column + '.npy')) for column in EVENT_COLUMNS)
+        events = len(data['timestamp'])
+        progress = ReadingProgress(callback, 0, events)
+        for begin in xrange(0, events, chunk_events):
+            progress.update(min(begin + chunk_events, events), chunk_events)
+            yield dict((column, data[column][begin:begin+chunk_events]) for column in EVENT_COLUMNS)
+        progress.finish()
+
+    def GetNullTimeStamp(self):
+        data = {}
+        data['type'] = np.empty(0,dtype=np.uint16)
+        data['channel'] = np.empty(0,dtype=np.uint16)
+        data['unit'] = np.empty(0,dtype=np.uint16)
+        data['timestamp'] = np.empty(0,dtype=np.int64)
+        return data
+
+    def GetTimeStampFrequency(self):
+        return self.header['timestamp_frequency']
+
+def main(argv):
+    if len(argv) < 2:
+        print 'Usage: python %s file.plx [store_dir]' %argv[0]
+        return 1
+    filename = argv[1]
+    store_path = argv[2] if len(argv) > 2 else None
+    def report(percentage, done_size, file_size, elapsed_time, left_time):
+        # pylint: disable=W0613
+        sys.stdout.write('\rConverting %s: %.0f%%' %(filename, percentage * 100))
+        sys.stdout.flush()
+    store_path = convert_plx(filename, store_path, callback=report)
+    print '\nCreated store %s' %store_path
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -11,52 +11,254 @@ import logging
 logger = logging.getLogger('SpikeRecord.Plexon')
 from SpikeRecord import Plexon
 
-def reconstruct_word_in_python(WORD_BITS,bits_num,unstrobed_bits,words_buffer,timestamps_buffer):
-    bits_indices = np.array([0]*WORD_BITS)
-    oldest_timestamps = np.array([unstrobed_bits[bit][0] for bit in xrange(WORD_BITS)])
-    # synonyms
-    bits_num = bits_num
-    unstrobed_bits = unstrobed_bits
-    words_buffer = words_buffer
-    timestamps_buffer = timestamps_buffer
+def group_word_bits(bits, ticks, groups):
+    """
+    group_word_bits(bits, ticks, groups) -> (words, ticks, word_begins)
+    
+    Combine the bit events in ascending order of groups into int32 words with 
+    bitwise_or.reduceat over the runs of the same group. A bit repeated in a group starts 
+    another word in the group, the n-th occurrences of the bits make the n-th word as 
+    when the bit streams are merged one word at a time. The ticks are returned in the order of 
+    the words, the bits of words[i] have ticks[word_begins[i]:word_begins[i+1]].
+    """
+    masks = np.left_shift(1, bits.astype(np.int64))
+    word_begins = np.append(0, np.flatnonzero(groups[1:] != groups[:-1]) + 1)
+    words = np.bitwise_or.reduceat(masks, word_begins)
+    # the sum of the bits differs from their union only if a bit is repeated
+    if not np.array_equal(words, np.add.reduceat(masks, word_begins)):
+        order = np.lexsort((bits, groups))
+        bits, ticks, groups = bits[order], ticks[order], groups[order]
+        # occurrence of the bit in the group, counted from 0
+        new_bit = np.ones(len(groups),dtype=bool)
+        new_bit[1:] = (groups[1:] != groups[:-1]) | (bits[1:] != bits[:-1])
+        positions = np.arange(len(groups))
+        occurrences = positions - np.maximum.accumulate(np.where(new_bit, positions, 0))
+        order = np.lexsort((occurrences, groups))
+        ticks, groups, occurrences = ticks[order], groups[order], occurrences[order]
+        masks = np.left_shift(1, bits[order].astype(np.int64))
+        word_begins = np.append(0, np.flatnonzero((groups[1:] != groups[:-1]) | (occurrences[1:] != occurrences[:-1])) + 1)
+        words = np.bitwise_or.reduceat(masks, word_begins)
+    return words.astype(np.int32), ticks, word_begins
+
+def combine_word_bits(bits, ticks):
+    """
+    combine_word_bits(bits, ticks) -> (words, timestamps)
     
-    where = np.where
-    left_shift = np.left_shift
-    timestamps_min = oldest_timestamps.min
+    Combine the bit events in ascending order of ticks into int32 words of the bits at 
+    the same timestamp. A bit repeated at the same timestamp starts another word at that
+    timestamp, see group_word_bits.
+    """
+    if len(ticks) == 0:
+        return np.empty(0,dtype=np.int32), np.empty(0,dtype=np.int64)
+    words, ticks, word_begins = group_word_bits(bits, ticks, ticks)
+    return words, ticks[word_begins].astype(np.int64)
+
+def reconstruct_words(WORD_BITS,unstrobed_bits_list):
+    """
+    reconstruct_words(WORD_BITS,unstrobed_bits_list) -> (words, timestamps)
     
-    words_count = 0
-    indices_sum = 0
-    while indices_sum < bits_num:
-        timestamp = timestamps_min()
-        word_bits = where(oldest_timestamps==timestamp)[0]
-        # construct word from bits
-        word = left_shift(1,word_bits).sum()
-        # increment the indices of previous word bits
-        bits_indices[word_bits] += 1
-        # increment indices sum so that the loop will run until all bits are processed
-        indices_sum += word_bits.size
-        # update oldest timestamp of previous word bits
-        oldest_timestamps[word_bits] = unstrobed_bits[word_bits,bits_indices[word_bits]]
-        # fill word and timestamp in buffers
-        words_buffer[words_count] = word
-        timestamps_buffer[words_count] = timestamp
-        words_count += 1
-    return words_count
-
-try:
-    import _unstrobed_word
-    reconstruct_word = _unstrobed_word.reconstruct_word_32
-except ImportError or ValueError:
-    reconstruct_word = reconstruct_word_in_python
-    logger.info("Cannot import C version of reconstruct_word. Building a C version is highly recommended. We will use Python version this time.")
+    Reconstruct words from the int64 timestamps in ticks of every unstrobed bit. The
+    timestamps of each bit are in ascending order. Returns int32 words and int64 timestamps.
+    """
+    lengths = [len(bits) for bits in unstrobed_bits_list]
+    ticks = np.concatenate(unstrobed_bits_list).astype(np.int64)
+    bits = np.repeat(np.arange(WORD_BITS), lengths)
+    order = np.argsort(ticks, kind='mergesort')
+    return combine_word_bits(bits[order], ticks[order])
+
+def reconstruct_event_words(WORD_BITS, channel, timestamp):
+    """
+    reconstruct_event_words(WORD_BITS, channel, timestamp) -> (words, timestamps)
+    
+    Same as reconstruct_words from the channels and timestamps of the external events. 
+    Unstrobed bit b is on channel b+1. The events are usually in time order already and
+    are only sorted if they are not.
+    """
+    bit_events = (channel >= 1) & (channel <= WORD_BITS)
+    bits = channel[bit_events].astype(np.int64) - 1
+    ticks = timestamp[bit_events].astype(np.int64)
+    if np.any(ticks[1:] < ticks[:-1]):
+        order = np.argsort(ticks, kind='mergesort')
+        bits, ticks = bits[order], ticks[order]
+    return combine_word_bits(bits, ticks)
+
+class UnstrobedWordDecoder(object):
+    """
+    Decode unstrobed words from successive reads of external events.
+
+    The bits of a word are set at once but their events may be a few ticks apart. A bit
+    event at most window ticks after the previous bit event belongs to the same word, 
+    which takes the timestamp of its first bit. A bit repeated in a word starts another 
+    word. More bits of the last word of a read may come in the next read, so the bit 
+    events of that word are held back and decoded with the next read. The held word is
+    complete once an event of any type in a read is more than window ticks after its
+    last bit, or with the final read.
+    Parameters
+    ----------
+    window: int
+        largest interval in ticks between successive bit events of a word. With 0 only 
+        bits at the same timestamp make a word.
+    word_bits: int
+        number of unstrobed bits, bit b is on channel b+1
+    """
+    def __init__(self, window=0, word_bits=32):
+        self.window = window
+        self.word_bits = word_bits
+        self.reset()
+
+    def reset(self):
+        """
+        reset()
+
+        Drop the held bit events and clear the statistics. The statistics count the 
+        decoded words, the merged words whose bits are not all at the same timestamp and 
+        the split words started by a repeated bit. max_spread is the largest interval in
+        ticks between the first and the last bit of a word.
+        """
+        self.held_bits = np.empty(0,dtype=np.int64)
+        self.held_ticks = np.empty(0,dtype=np.int64)
+        self.stats = {'words':0, 'merged_words':0, 'split_words':0, 'max_spread':0}
+
+    def decode(self, channel, timestamp, final=False, latest=None):
+        """
+        decode(channel, timestamp, final=False, latest=None) -> (words, timestamps)
+
+        Return the int32 words and int64 timestamps completed by the external events of a
+        read. The events are usually in time order already and are only sorted if they 
+        are not. latest is the timestamp of the latest event of any type in the read, 
+        which may complete the last word. With final all held bits are decoded.
+        """
+        bit_events = (channel >= 1) & (channel <= self.word_bits)
+        bits = channel[bit_events].astype(np.int64) - 1
+        ticks = timestamp[bit_events].astype(np.int64)
+        if len(self.held_ticks):
+            bits = np.concatenate((self.held_bits, bits))
+            ticks = np.concatenate((self.held_ticks, ticks))
+        if np.any(ticks[1:] < ticks[:-1]):
+            order = np.argsort(ticks, kind='mergesort')
+            bits, ticks = bits[order], ticks[order]
+        # a word begins where the interval from the previous bit exceeds the window
+        breaks = np.flatnonzero(ticks[1:] - ticks[:-1] > self.window) + 1
+        if final or (len(ticks) and latest is not None and latest > ticks[-1] + self.window):
+            held = len(ticks)
+        else:
+            # only the bits of the trailing open window are held back
+            held = breaks[-1] if len(breaks) else 0
+        self.held_bits, self.held_ticks = bits[held:], ticks[held:]
+        if held == 0:
+            return np.empty(0,dtype=np.int32), np.empty(0,dtype=np.int64)
+        groups = np.zeros(held,dtype=np.int64)
+        groups[breaks[breaks < held]] = 1
+        groups = np.cumsum(groups)
+        words, ticks, word_begins = group_word_bits(bits[:held], ticks[:held], groups)
+        timestamps = np.minimum.reduceat(ticks, word_begins)
+        spreads = np.maximum.reduceat(ticks, word_begins) - timestamps
+        self.stats['words'] += len(words)
+        self.stats['merged_words'] += int(np.count_nonzero(spreads))
+        self.stats['split_words'] += len(words) - int(groups[-1]) - 1
+        self.stats['max_spread'] = max(self.stats['max_spread'], int(spreads.max()))
+        return words, timestamps
+
+    def flush(self):
+        """
+        flush() -> (words, timestamps)
+
+        Return the word of the held bit events.
+        """
+        return self.decode(np.empty(0,dtype=np.uint16), np.empty(0,dtype=np.int64), final=True)
+
+def demux_spikes(data):
+    """
+    demux_spikes(data) -> (channels, units, timestamps, bounds)
+
+    Group the sorted spikes by channel and unit in one stable sort. The timestamps of the
+    i-th (channels[i], units[i]) pair are timestamps[bounds[i]:bounds[i+1]] in the order
+    of the data. Channels and units are in ascending order.
+    """
+    sorted_spikes = np.flatnonzero((data['type'] == Plexon.PL_SingleWFType) & (data['unit'] > 0))
+    channel = data['channel'][sorted_spikes]
+    unit = data['unit'][sorted_spikes]
+    keys = (channel.astype(np.int64) << 16) | unit
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    begins = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    if len(keys):
+        begins = np.append(0, begins)
+    bounds = np.append(begins, len(keys))
+    return (channel[order[begins]], unit[order[begins]],
+            data['timestamp'][sorted_spikes[order]], bounds)
+
+class ExtEvents(object):
+    """
+    External events of a read split by kind in one pass.
+
+    The external events are taken out of the read once and split into the kinds of 
+    events. The timestamps of other channels, e.g. of single unstrobed bits, are taken 
+    out of the external events on demand and kept. The arrays are shared by the readers 
+    of the events and are read-only.
+    Attributes
+    ----------
+    first_strobe_word, second_strobe_word: dict
+        {'value', 'timestamp'} of the strobed words
+    start, stop, pause, resume: array
+        timestamps of the events
+    bit_channel, bit_timestamp: array
+        channels and timestamps of the unstrobed bit events in the order of the read
+    """
+    def __init__(self, data):
+        ext_event_type = (data['type'] == Plexon.PL_ExtEventType)
+        self.channel = data['channel'][ext_event_type]
+        self.unit = data['unit'][ext_event_type]
+        self.timestamp = data['timestamp'][ext_event_type]
+        self.channels = {}
+        bit_events = self.channel < Plexon.PL_StrobedExtChannel
+        self.bit_channel = self.channel[bit_events]
+        self.bit_timestamp = self.timestamp[bit_events]
+        strobed_events = (self.channel == Plexon.PL_StrobedExtChannel)
+        strobed_unit = self.unit[strobed_events]
+        strobed_timestamp = self.timestamp[strobed_events]
+        second_strobe = (strobed_unit & 0x8000) != 0
+        self.first_strobe_word = {'value':strobed_unit[~second_strobe] & 0x7FFF, 'timestamp':strobed_timestamp[~second_strobe]}
+        self.second_strobe_word = {'value':strobed_unit[second_strobe], 'timestamp':strobed_timestamp[second_strobe]}
+        self.start = self.get_channel(Plexon.PL_StartExtChannel)
+        self.stop = self.get_channel(Plexon.PL_StopExtChannel)
+        self.pause = self.get_channel(Plexon.PL_Pause)
+        self.resume = self.get_channel(Plexon.PL_Resume)
+        for array in (self.channel, self.unit, self.timestamp, self.bit_channel, self.bit_timestamp,
+                      self.first_strobe_word['value'], self.first_strobe_word['timestamp'],
+                      self.second_strobe_word['value'], self.second_strobe_word['timestamp']):
+            array.flags.writeable = False
+
+    def get_channel(self, channel):
+        """
+        get_channel(channel) -> timestamps
+
+        Timestamps of the events on an external event channel.
+        """
+        if channel not in self.channels:
+            timestamps = self.timestamp[self.channel == channel]
+            timestamps.flags.writeable = False
+            self.channels[channel] = timestamps
+        return self.channels[channel]
+
+    def get_bit(self, bit):
+        """
+        get_bit(bit) -> timestamps
+
+        Timestamps of the events of unstrobed bit bit, which are on channel bit+1.
+        """
+        return self.get_channel(bit + 1)
 
 class PlexUtil(object):
     """
     Utilities for data collection
     """
-    def __init__(self):
-        self.last_word = None
-        self.last_timestamp = None
+    def __init__(self, word_window=0):
+        # unstrobed bits at most word_window ticks apart make a word
+        self.word_decoder = UnstrobedWordDecoder(word_window)
+        # the data of the last read and its external events
+        self.ext_events_data = None
+        self.ext_events = None
         
     def GetSpikesInfo(self,data):
         """
@@ -72,20 +274,24 @@ class PlexUtil(object):
         info: list of units for every spikes occurring channels
             [(channel, units)]
         """
-        sorted_spikes = (data['type'] == Plexon.PL_SingleWFType) & (data['unit'] > 0)
+        channels, units, _timestamps, _bounds = demux_spikes(data)
         info = []
-        for channel in np.unique(data['channel'][sorted_spikes]):
-            channel_units = map(chr, np.unique(data['unit'][sorted_spikes & (data['channel'] == channel)]) + (ord('a')-1))
-            info.append((channel, channel_units))
+        unique_channels, channel_begins = np.unique(channels, return_index=True)
+        for channel, channel_units in zip(unique_channels, np.split(units, channel_begins[1:])):
+            info.append((channel, map(chr, channel_units + (ord('a')-1))))
         return info
         
     def GetSpikeTrains(self,data):
+        """
+        GetSpikeTrains(data) -> spike_trains
+
+        Return spike trains of all sorted units as {channel: {unit: spike_train}}. The 
+        spike trains are slices of one array of the spikes grouped by unit.
+        """
         spike_trains = {}
-        sorted_spikes = (data['type'] == Plexon.PL_SingleWFType) & (data['unit'] > 0)
-        for channel in np.unique(data['channel'][sorted_spikes]):
-            spike_trains[channel] = {}
-            for unit in map(chr,np.unique(data['unit'][sorted_spikes & (data['channel'] == channel)]) + (ord('a')-1)):
-                spike_trains[channel][unit] = self.GetSpikeTrain(data, channel=channel, unit=unit)
+        channels, units, timestamps, bounds = demux_spikes(data)
+        for index, (channel, unit) in enumerate(zip(channels, units)):
+            spike_trains.setdefault(channel, {})[chr(unit + ord('a') - 1)] = timestamps[bounds[index]:bounds[index+1]]
         return spike_trains
             
     def GetSpikeTrain(self, data, channel, unit):
@@ -105,7 +311,7 @@ class PlexUtil(object):
         Returns
         -------
         spiketrain: array 
-            timestamp array of the specific unit
+            timestamp array of the specific unit in ticks
         """
         unit_spikes = (data['type'] == Plexon.PL_SingleWFType) & \
                       (data['channel'] == channel) & \
@@ -116,6 +322,23 @@ class PlexUtil(object):
     def GetEventsNum(self, data):
         return len(data['timestamp'])
     
+    def DemuxExtEvents(self, data):
+        """
+        DemuxExtEvents(data) -> ext_events
+
+        Return the external events of data split by kind as an ExtEvents. The events of
+        the last data are kept so the kinds of events taken from the same data in turn 
+        are split only once.
+        Parameters
+        ----------
+        data: dict
+            {'type', 'channel', 'unit', 'timestamp'} dictionary from the return value of PlexClient.GetTimeStampArray().
+        """
+        if data is not self.ext_events_data:
+            self.ext_events = ExtEvents(data)
+            self.ext_events_data = data
+        return self.ext_events
+
     #@profile
     def GetExtEvents(self, data, event, bit=None, online=True):
         """
@@ -134,71 +357,19 @@ class PlexUtil(object):
         -------
         extevents: timestamp array of 'first_strobe', 'second_strobe', 'start', 'stop', 'pause', 'resume' events. for strobe_word events 
         the array is contained in a dictionary which take the key 'value' as the strobed word and the key 'timestamp' as event stamp.
+        All timestamps are in ticks like the timestamps in data.
         """
-        ext_event_type = (data['type'] == Plexon.PL_ExtEventType)
-        #extevents = data['type'][ext_event_type]
-        channel = data['channel'][ext_event_type]
-        unit = data['unit'][ext_event_type]
-        timestamp = data['timestamp'][ext_event_type]
-        # for strobed word event
-        if event in ('first_strobe_word','second_strobe_word'):
-            strobed_events = (channel == Plexon.PL_StrobedExtChannel)
-            strobed_unit = unit[strobed_events]
-            strobed_timestamp = timestamp[strobed_events]
-            first_strobe  = (strobed_unit & 0x8000) == 0
-            second_strobe = (strobed_unit & 0x8000) != 0
-            if event == 'first_strobe_word':
-                return {'value':strobed_unit[first_strobe] & 0x7FFF , 'timestamp':strobed_timestamp[first_strobe]}
-            else:
-                return {'value':strobed_unit[second_strobe]         , 'timestamp':strobed_timestamp[second_strobe]}
-        # for start event 
-        if event == 'start':
-            return timestamp[channel == Plexon.PL_StartExtChannel]
-        # for stop event
-        if event == 'stop':
-            return timestamp[channel == Plexon.PL_StopExtChannel]
-        # for pause event
-        if event == 'pause':
-            return timestamp[channel == Plexon.PL_Pause]
-        # for resume event 
-        if event == 'resume':
-            return timestamp[channel == Plexon.PL_Resume]
+        ext_events = self.DemuxExtEvents(data)
+        if event in ('first_strobe_word','second_strobe_word','start','stop','pause','resume'):
+            return getattr(ext_events, event)
         # for unstrobed events
         if event == 'unstrobed_bit':
-            return timestamp[channel == bit + 1 ]
+            return ext_events.get_bit(bit)
         # reconstruct unstrobed word from unstrobed bits
         if event == 'unstrobed_word':
-            infinity = float('inf')
-            WORD_BITS = 32
-            # add an additional infinity in array end so that index of unstrobed_bits will not get out of range
-            unstrobed_bits_list = [timestamp[channel == bit+1] for bit in xrange(WORD_BITS)]
-            bits_length = [len(unstrobed_bits_list[bit]) for bit in xrange(WORD_BITS)] # actural bits length
-            max_length = max(bits_length)
-            bits_num = sum(bits_length)
-            # make 2d array of timestamp 
-            unstrobed_bits = np.array([np.append(unstrobed_bits_list[bit], [infinity]*(max_length-bits_length[bit]+1)) \
-                                       for bit in xrange(WORD_BITS)],dtype=np.float32)
-            # create numpy buffer to hold words and timestamps
-            words_buffer = np.empty(bits_num,dtype=np.int32)
-            timestamps_buffer = np.empty(bits_num,dtype=np.float32)
-            
-            words_count = reconstruct_word(WORD_BITS,bits_num,unstrobed_bits,words_buffer,timestamps_buffer)
-            
-            words = words_buffer[:words_count]
-            timestamps = timestamps_buffer[:words_count]
-            if len(timestamps) and self.last_timestamp == timestamps[0]:
-                words[0] += self.last_word
-            elif self.last_word is not None:
-                words = np.append(self.last_word, words)
-                timestamps = np.append(self.last_timestamp, timestamps)
-                if len(timestamps)==1: 
-                    self.last_word = None
-                    self.last_timestamp = None
-                    return {'value': np.array(words), 'timestamp': np.array(timestamps)}
-            if online:      # in offline mode all timestamps are read at once
-                if len(timestamps):
-                    self.last_word = words[-1]
-                    self.last_timestamp = timestamps[-1]
-                return {'value': np.array(words[:-1]), 'timestamp': np.array(timestamps[:-1])}
-            else:
-                return {'value': np.array(words), 'timestamp': np.array(timestamps)}
+            # the bits of the last word are held until a later event closes its window 
+            # unless all timestamps are read at once in offline mode
+            latest = data['timestamp'].max() if len(data['timestamp']) else None
+            words, timestamps = self.word_decoder.decode(ext_events.bit_channel, ext_events.bit_timestamp,
+                                                         final=not online, latest=latest)
+            return {'value': words, 'timestamp': timestamps}
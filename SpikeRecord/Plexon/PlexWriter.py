@@ -0,0 +1,465 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Writer of synthetic Plexon plx files
+###########################################################
+
+"""
+Write valid plx files of chosen size and content for test fixtures and benchmarks.
+
+PlexWriter writes data blocks in time order and fills in the header counters when
+closed. SyntheticRecording generates spikes of Poisson or LNP (linear-nonlinear-Poisson)
+units with waveforms, stimulus words on the strobed channel or the unstrobed bits, and
+slow channels, one second at a time until the duration or the file size is reached.
+
+Usage: python PlexWriter.py file.plx size_MB [poisson|lnp] [seed]
+"""
+
+from __future__ import division
+import sys
+import datetime
+import numpy as np
+import logging
+logger = logging.getLogger('SpikeRecord.Plexon')
+from SpikeRecord.Plexon.PlexFile import PL_FileHeader, PL_ChanHeader, PL_EventHeader, PL_SlowChannelHeader, \
+                                        PL_SingleWFType, PL_ExtEventType, PL_ADDataType, \
+                                        PL_StrobedExtChannel, PL_StartExtChannel, PL_StopExtChannel, \
+                                        LATEST_PLX_FILE_VERSION, DATA_BLOCK_DTYPE, ReadingProgress, get_block_ticks
+
+PLX_MAGIC_NUMBER = 0x58454c50
+# file versions the writer can produce
+WRITER_VERSIONS = (105, 106)
+# sizes of the counter arrays in PL_FileHeader: [channel][unit] and [event_number]
+COUNTS_CHANNELS = 130
+COUNTS_UNITS = 5
+EV_COUNTS_SIZE = 512
+# continuous channel counters start at this index of EVCounts
+SLOW_COUNTS_BASE = 300
+# words in a block header
+BLOCK_HEADER_WORDS = DATA_BLOCK_DTYPE.itemsize // 2
+# the stimulus words carry the onset bit of the tuning experiments so that they are never zero
+WORD_ONSET_FLAG = 1<<12
+# samples of a slow channel in one A/D block
+AD_BLOCK_SAMPLES = 200
+# the recordings are generated this many seconds at a time
+RECORDING_CHUNK = 1.0
+
+def make_blocks(block_type, channels, units, ticks, words_per_block):
+    """
+    make_blocks(block_type, channels, units, ticks, words_per_block) -> blocks
+
+    Data block headers of one type. channels, units and words_per_block are arrays or
+    scalars broadcast to the ticks.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    blocks = np.zeros(len(ticks), dtype=DATA_BLOCK_DTYPE)
+    blocks['Type'] = block_type
+    blocks['UpperByteOf5ByteTimestamp'] = (ticks >> 32) & 0xFF
+    blocks['TimeStamp'] = ticks & 0xFFFFFFFF
+    blocks['Channel'] = channels
+    blocks['Unit'] = units
+    blocks['NumberOfWordsInWaveform'] = words_per_block
+    blocks['NumberOfWaveforms'] = np.asarray(words_per_block) > 0
+    return blocks
+
+def spike_blocks(channel, unit, ticks, waveforms):
+    """
+    spike_blocks(channel, unit, ticks, waveforms) -> (blocks, words)
+
+    Spike blocks of a unit with the waveform matrix of shape (len(ticks), points).
+    """
+    waveforms = np.asarray(waveforms, dtype=np.int16)
+    return make_blocks(PL_SingleWFType, channel, unit, ticks, waveforms.shape[1]), waveforms.reshape(-1)
+
+def event_blocks(channel, ticks, units=0):
+    """
+    event_blocks(channel, ticks, units) -> (blocks, words)
+
+    Event blocks of a channel. units are the strobed words of the strobed channel.
+    """
+    units = np.asarray(units, dtype=np.uint16).astype(np.int16)
+    return make_blocks(PL_ExtEventType, channel, units, ticks, 0), np.empty(0, dtype=np.int16)
+
+def ad_blocks(channel, ticks, values):
+    """
+    ad_blocks(channel, ticks, values) -> (blocks, words)
+
+    A/D blocks of a slow channel. values is the sample matrix of shape (len(ticks), samples),
+    ticks are the timestamps of the first sample of the blocks.
+    """
+    values = np.asarray(values, dtype=np.int16)
+    return make_blocks(PL_ADDataType, channel, 0, ticks, values.shape[1]), values.reshape(-1)
+
+def merge_blocks(parts):
+    """
+    merge_blocks(parts) -> (blocks, words)
+
+    Merge (blocks, words) pairs into one pair in time order. Blocks of the same timestamp
+    keep the order of the parts.
+    """
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        return np.empty(0, dtype=DATA_BLOCK_DTYPE), np.empty(0, dtype=np.int16)
+    blocks = np.concatenate([part[0] for part in parts])
+    words = np.concatenate([part[1] for part in parts])
+    sizes = blocks['NumberOfWordsInWaveform'].astype(np.int64) * blocks['NumberOfWaveforms']
+    starts = np.cumsum(sizes) - sizes
+    order = np.argsort(get_block_ticks(blocks), kind='mergesort')
+    sizes = sizes[order]
+    new_starts = np.cumsum(sizes) - sizes
+    word_index = np.repeat(starts[order] - new_starts, sizes) + np.arange(sizes.sum())
+    return blocks[order], words[word_index]
+
+class PlexWriter(object):
+    """
+    Write a plx file block by block in time order.
+
+    The header and the channel headers are written when the writer is created. The
+    timestamp and waveform counters and the last timestamp in the file header are
+    updated when the writer is closed.
+    Parameters
+    ----------
+    filename: str
+        path of the plx file
+    frequency: int
+        timestamp frequency in hertz
+    points, pre_threshold: int
+        number of points of the waveforms and number of them before the threshold crossing
+    version: int
+        plx file version, 105 or 106
+    spike_channels, event_channels, slow_channels: sequences of int
+        channel numbers of the channel headers. Spike and event channels are 1-based, slow
+        channels are 0-based.
+    slow_frequency: int
+        digitization frequency of the slow channels
+    comment: str
+        comment in the file header
+    recording_time: datetime
+        time of the recording in the file header, default is now
+    """
+    def __init__(self, filename, frequency=40000, points=32, pre_threshold=8, version=LATEST_PLX_FILE_VERSION,
+                 spike_channels=(), event_channels=(), slow_channels=(), slow_frequency=1000,
+                 comment='', recording_time=None):
+        if version not in WRITER_VERSIONS:
+            raise ValueError("Cannot write plx file version %d." %version)
+        self.filename = filename
+        self.frequency = frequency
+        self.points = points
+        self.last_tick = 0
+        self.file_header = PL_FileHeader()
+        self.chan_headers = []
+        self.event_headers = []
+        self.slow_headers = []
+        self.ts_counts = np.zeros((COUNTS_CHANNELS, COUNTS_UNITS), dtype=np.int64)
+        self.wf_counts = np.zeros((COUNTS_CHANNELS, COUNTS_UNITS), dtype=np.int64)
+        self.ev_counts = np.zeros(EV_COUNTS_SIZE, dtype=np.int64)
+
+        if recording_time is None:
+            recording_time = datetime.datetime.now()
+        header = self.file_header
+        header.MagicNumber = PLX_MAGIC_NUMBER
+        header.Version = version
+        header.Comment = comment
+        header.ADFrequency = frequency
+        header.WaveformFreq = frequency
+        header.NumDSPChannels = len(spike_channels)
+        header.NumEventChannels = len(event_channels)
+        header.NumSlowChannels = len(slow_channels)
+        header.NumPointsWave = points
+        header.NumPointsPreThr = pre_threshold
+        header.Year = recording_time.year
+        header.Month = recording_time.month
+        header.Day = recording_time.day
+        header.Hour = recording_time.hour
+        header.Minute = recording_time.minute
+        header.Second = recording_time.second
+        header.Trodalness = 1
+        header.DataTrodalness = 1
+        header.BitsPerSpikeSample = 12
+        header.BitsPerSlowSample = 12
+        header.SpikeMaxMagnitudeMV = 3000
+        header.SlowMaxMagnitudeMV = 5000
+        header.SpikePreAmpGain = 1000
+        for channel in spike_channels:
+            chan_header = PL_ChanHeader()
+            chan_header.Name = 'DSP%03d' %channel
+            chan_header.SIGName = 'sig%03d' %channel
+            chan_header.Channel = channel
+            chan_header.SIG = channel
+            chan_header.Gain = 32
+            chan_header.NUnits = COUNTS_UNITS - 1
+            self.chan_headers.append(chan_header)
+        for channel in event_channels:
+            event_header = PL_EventHeader()
+            event_header.Name = 'EVT%02d' %channel
+            event_header.Channel = channel
+            self.event_headers.append(event_header)
+        for channel in slow_channels:
+            slow_header = PL_SlowChannelHeader()
+            slow_header.Name = 'AD%02d' %channel
+            slow_header.Channel = channel
+            slow_header.ADFreq = slow_frequency
+            slow_header.Gain = 1
+            slow_header.Enabled = 1
+            slow_header.PreAmpGain = 1000
+            self.slow_headers.append(slow_header)
+
+        self.file = open(filename, 'wb')
+        self._write_headers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_headers(self):
+        self.file.write(bytearray(self.file_header))
+        for header in self.chan_headers + self.event_headers + self.slow_headers:
+            self.file.write(bytearray(header))
+
+    def tell(self):
+        return self.file.tell()
+
+    def write_blocks(self, *parts):
+        """
+        write_blocks(*parts)
+
+        Write (blocks, words) pairs made by spike_blocks, event_blocks and ad_blocks. The
+        blocks are merged in time order and must not be earlier than the blocks written
+        before.
+        """
+        blocks, words = merge_blocks(parts)
+        if len(blocks) == 0:
+            return
+        ticks = get_block_ticks(blocks)
+        if ticks[0] < self.last_tick:
+            raise ValueError("Blocks must be written in time order: tick %d is before tick %d." %(ticks[0], self.last_tick))
+        self.last_tick = ticks[-1]
+
+        # every block is a header followed by its words so the output is assembled in words
+        sizes = blocks['NumberOfWordsInWaveform'].astype(np.int64) * blocks['NumberOfWaveforms']
+        block_words = BLOCK_HEADER_WORDS + sizes
+        block_starts = np.cumsum(block_words) - block_words
+        output = np.empty(block_words.sum(), dtype='<i2')
+        header_index = block_starts[:,np.newaxis] + np.arange(BLOCK_HEADER_WORDS)
+        output[header_index] = blocks.view('<i2').reshape(-1, BLOCK_HEADER_WORDS)
+        data_starts = block_starts + BLOCK_HEADER_WORDS - (np.cumsum(sizes) - sizes)
+        output[np.repeat(data_starts, sizes) + np.arange(sizes.sum())] = words
+        self.file.write(output.tostring())
+        self._count_blocks(blocks, sizes)
+
+    def _count_blocks(self, blocks, sizes):
+        block_type = blocks['Type']
+        channels = blocks['Channel'].astype(np.int64)
+        units = blocks['Unit'].astype(np.int64)
+        spikes = (block_type == PL_SingleWFType) & (channels < COUNTS_CHANNELS) & (units >= 0) & (units < COUNTS_UNITS)
+        np.add.at(self.ts_counts, (channels[spikes], units[spikes]), 1)
+        waveforms = spikes & (sizes > 0)
+        np.add.at(self.wf_counts, (channels[waveforms], units[waveforms]), 1)
+        events = (block_type == PL_ExtEventType) & (channels < SLOW_COUNTS_BASE)
+        np.add.at(self.ev_counts, channels[events], 1)
+        slow = (block_type == PL_ADDataType) & (SLOW_COUNTS_BASE + channels < EV_COUNTS_SIZE)
+        np.add.at(self.ev_counts, SLOW_COUNTS_BASE + channels[slow], sizes[slow])
+
+    def close(self):
+        """
+        close()
+
+        Update the counters in the file header and close the file.
+        """
+        if self.file is None:
+            return
+        header = self.file_header
+        header.LastTimestamp = self.last_tick
+        # the counters are laid out as [channel][unit] in the file
+        np.ctypeslib.as_array(header.TSCounts).reshape(-1)[:] = self.ts_counts.reshape(-1)
+        np.ctypeslib.as_array(header.WFCounts).reshape(-1)[:] = self.wf_counts.reshape(-1)
+        np.ctypeslib.as_array(header.EVCounts)[:] = self.ev_counts
+        self.file.seek(0)
+        self.file.write(bytearray(header))
+        self.file.close()
+        self.file = None
+
+class SyntheticRecording(object):
+    """
+    Generator of a synthetic recording written by PlexWriter.
+
+    Stimulus frames are shown at frame_rate and each frame shows one of params stimulus
+    parameters at random. The frame onsets are marked by stimulus words of the parameter
+    index with WORD_ONSET_FLAG, either as strobed words or on the unstrobed bits.
+    Parameters
+    ----------
+    channels, units: int
+        number of spike channels and sorted units in each channel, channels are numbered from 1
+        and units from 1
+    model: str
+        'poisson' for units firing at constant rates, 'lnp' for units tuned to the stimulus
+        parameter, filtered in time, passed through an exponential and Poisson sampled
+    rate: float
+        mean firing rate of the units in spikes per second, the rate at the preferred
+        stimulus for the lnp units
+    frame_rate: float
+        stimulus frames per second
+    params: int
+        number of stimulus parameters
+    strobed: bool
+        whether the stimulus words are strobed or unstrobed
+    slow_channels: int
+        number of slow channels
+    seed: int
+        seed of the random generator
+    other keyword arguments are passed to PlexWriter
+    """
+    def __init__(self, channels=4, units=2, model='poisson', rate=20.0, frame_rate=10.0, params=16,
+                 strobed=False, slow_channels=2, seed=0, **writer_args):
+        if model not in ('poisson', 'lnp'):
+            raise ValueError("Unknown spike model %s." %model)
+        self.channels = channels
+        self.units = units
+        self.model = model
+        self.rate = rate
+        self.frame_rate = frame_rate
+        self.params = params
+        self.strobed = strobed
+        self.slow_channels = slow_channels
+        self.writer_args = writer_args
+        self.rng = np.random.RandomState(seed)
+        unit_count = channels * units
+        self.unit_rates = self.rng.gamma(4.0, rate / 4.0, unit_count)
+        self.preferred = self.rng.randint(0, params, unit_count)
+        self.amplitudes = self.rng.uniform(300, 1500, unit_count)
+        # temporal filter of the lnp units over the recent frames
+        self.kernel = np.exp(-np.arange(4) / 1.5)
+        self.kernel /= self.kernel.sum()
+        self.features = np.zeros((unit_count, len(self.kernel) - 1))
+        self.frame_rates = self.unit_rates * np.exp(-2.0)
+        self.next_frame = 0
+        self.next_sample = 0
+
+    def get_templates(self, points, pre_threshold):
+        t = np.arange(points, dtype=float) - pre_threshold
+        shape = -np.exp(-(t / 2.0)**2) + 0.4 * np.exp(-((t - 6) / 4.0)**2)
+        return self.amplitudes[:,np.newaxis] * shape
+
+    def generate(self, writer, begin, end):
+        """
+        generate(writer, begin, end)
+
+        Write the blocks between begin and end seconds.
+        """
+        rng = self.rng
+        frequency = writer.frequency
+        parts = []
+        # stimulus frames starting in the chunk
+        first_frame = self.next_frame
+        last_frame = int(np.ceil(end * self.frame_rate))
+        self.next_frame = last_frame
+        frame_ticks = np.round(np.arange(first_frame, last_frame) / self.frame_rate * frequency).astype(np.int64)
+        frame_params = rng.randint(0, self.params, len(frame_ticks))
+        words = frame_params | WORD_ONSET_FLAG
+        if self.strobed:
+            parts.append(event_blocks(PL_StrobedExtChannel, frame_ticks, words))
+        else:
+            for bit in xrange(16):
+                set_bit = (words >> bit) & 1 == 1
+                if np.any(set_bit):
+                    parts.append(event_blocks(bit + 1, frame_ticks[set_bit]))
+
+        # spikes of every unit
+        duration = end - begin
+        begin_tick = int(round(begin * frequency))
+        end_tick = int(round(end * frequency))
+        # the frame shown at the beginning of the chunk continues from the previous chunk
+        frame_edges = np.concatenate(([begin_tick], frame_ticks, [end_tick]))
+        frame_durations = np.diff(frame_edges)
+        templates = self.get_templates(writer.points, writer.file_header.NumPointsPreThr)
+        for index in xrange(self.channels * self.units):
+            channel, unit = divmod(index, self.units)
+            if self.model == 'poisson':
+                count = rng.poisson(self.unit_rates[index] * duration)
+                ticks = np.sort(rng.randint(begin_tick, end_tick, count))
+            else:
+                rates = np.array([self.frame_rates[index]])
+                if len(frame_params):
+                    tuning = np.cos(2 * np.pi * (frame_params - self.preferred[index]) / self.params)
+                    history = np.concatenate((self.features[index], tuning))
+                    drive = np.convolve(history, self.kernel, mode='valid')
+                    self.features[index] = history[len(history) - len(self.kernel) + 1:]
+                    rates = np.append(rates, self.unit_rates[index] * np.exp(2.0 * drive - 2.0))
+                    self.frame_rates[index] = rates[-1]
+                counts = rng.poisson(rates * frame_durations / frequency)
+                ticks = np.repeat(frame_edges[:-1], counts) + \
+                        (rng.rand(counts.sum()) * np.repeat(frame_durations, counts)).astype(np.int64)
+                ticks.sort()
+            noise = rng.normal(0, 50, (len(ticks), writer.points))
+            waveforms = np.clip(templates[index] + noise, -2048, 2047)
+            parts.append(spike_blocks(channel + 1, unit + 1, ticks, waveforms))
+
+        # slow channels in blocks of AD_BLOCK_SAMPLES samples
+        # a block is written in the chunk of its first sample
+        slow_frequency = writer.slow_headers[0].ADFreq if writer.slow_headers else 1
+        samples = np.arange(self.next_sample, end * slow_frequency, AD_BLOCK_SAMPLES).astype(np.int64)
+        if len(samples):
+            self.next_sample = samples[-1] + AD_BLOCK_SAMPLES
+        ticks = np.round(samples / slow_frequency * frequency).astype(np.int64)
+        for channel in xrange(self.slow_channels):
+            sample_times = (samples[:,np.newaxis] + np.arange(AD_BLOCK_SAMPLES)) / slow_frequency
+            values = 500 * np.sin(2 * np.pi * (channel + 1) * sample_times) + rng.normal(0, 20, sample_times.shape)
+            parts.append(ad_blocks(channel, ticks, values))
+
+        writer.write_blocks(*parts)
+
+    def write(self, filename, duration=None, size=None, callback=None):
+        """
+        write(filename, duration, size, callback) -> duration
+
+        Write the recording to a plx file until duration seconds or size bytes are reached.
+        Returns the duration written in seconds.
+        Parameters
+        ----------
+        callback(percentage,done_size,file_size,elapsed_time,left_time)
+            Callback method reports file writing progress.
+        """
+        if duration is None and size is None:
+            raise ValueError("Either duration or size of the recording is required.")
+        writer = PlexWriter(filename, spike_channels=range(1, self.channels + 1),
+                            event_channels=range(1, 17) + [PL_StrobedExtChannel, PL_StartExtChannel, PL_StopExtChannel],
+                            slow_channels=range(self.slow_channels), **self.writer_args)
+        if size is not None:
+            progress = ReadingProgress(callback, 0, size)
+        else:
+            progress = ReadingProgress(callback, 0, duration)
+        with writer:
+            writer.write_blocks(event_blocks(PL_StartExtChannel, [0]))
+            begin = 0.0
+            while (duration is None or begin < duration) and (size is None or writer.tell() < size):
+                end = begin + RECORDING_CHUNK
+                if duration is not None:
+                    end = min(end, duration)
+                self.generate(writer, begin, end)
+                begin = end
+                progress.update(writer.tell() if size is not None else begin, 30000)
+            writer.write_blocks(event_blocks(PL_StopExtChannel, [int(round(begin * writer.frequency))]))
+        progress.finish()
+        return begin
+
+def main(argv):
+    if len(argv) < 3:
+        print 'Usage: python %s file.plx size_MB [poisson|lnp] [seed]' %argv[0]
+        return 1
+    filename = argv[1]
+    size = int(float(argv[2]) * 10**6)
+    model = argv[3] if len(argv) > 3 else 'poisson'
+    seed = int(argv[4]) if len(argv) > 4 else 0
+    def report(percentage, done_size, file_size, elapsed_time, left_time):
+        # pylint: disable=W0613
+        sys.stdout.write('\rWriting %s: %.0f%%' %(filename, percentage * 100))
+        sys.stdout.flush()
+    duration = SyntheticRecording(model=model, seed=seed).write(filename, size=size, callback=report)
+    print '\nWrote %.0f seconds of recording to %s' %(duration, filename)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -7,6 +7,7 @@ from PlexUtil import PlexUtil
 if __name__ == "__main__":
     with PlexClient() as pc:
         pu = PlexUtil()
+        frequency = float(pc.GetTimeStampFrequency())
         while True:
             #print "reading from server"
             data = pc.GetTimeStampArrays()
@@ -22,26 +23,26 @@ if __name__ == "__main__":
                 for unit in units:
                     spikes = pu.GetSpikeTrain(data, channel=channel, unit=unit)
                     for timestamp in spikes:
-                        print "spike:DSP%d%c t=%f" % (channel, unit, timestamp)
+                        print "spike:DSP%d%c t=%f" % (channel, unit, timestamp/frequency)
             
             start_events = pu.GetExtEvents(data, event='start')
             for timestamp in start_events:
-                print "PlexControl started at t=%f" % timestamp
+                print "PlexControl started at t=%f" % (timestamp/frequency)
                 
             stop_events = pu.GetExtEvents(data, event='stop')
             for timestamp in stop_events:
-                print "PlexControl stopped at t=%f" % timestamp
+                print "PlexControl stopped at t=%f" % (timestamp/frequency)
             
             bit_2_events = pu.GetExtEvents(data, event='unstrobed_bit', bit=2)
             bit_3_events = pu.GetExtEvents(data, event='unstrobed_bit', bit=3)
             for timestamp in bit_2_events:
-                print "found event:unstrobed bit 2 t=%f" % timestamp
+                print "found event:unstrobed bit 2 t=%f" % (timestamp/frequency)
             for timestamp in bit_3_events:
-                print "found event:unstrobed bit 3 t=%f" % timestamp
+                print "found event:unstrobed bit 3 t=%f" % (timestamp/frequency)
             
             unstrobed_word = pu.GetExtEvents(data, event='unstrobed_word')
             for value,timestamp in zip(unstrobed_word['value'],unstrobed_word['timestamp']) :
-                print "found event:unstrobed word:%d t=%f" % (value,timestamp)
+                print "found event:unstrobed word:%d t=%f" % (value,timestamp/frequency)
             
             time.sleep(1.0)
 
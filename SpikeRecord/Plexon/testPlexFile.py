@@ -4,13 +4,14 @@
 import numpy as np
 from line_profiler import LineProfiler
 from PlexFile import PlexFile
-from PlexUtil import PlexUtil,reconstruct_word
+from PlexUtil import PlexUtil,UnstrobedWordDecoder
 
 def run():
     with PlexFile('../../data/sparse-noise.plx') as pf:
         pu = PlexUtil()
         #print "reading from file"
         data = pf.GetTimeStampArrays()
+        frequency = float(pf.GetTimeStampFrequency())
         print "found %d events." %pu.GetEventsNum(data)
         # get spike trains altogether
         spike_trains = pu.GetSpikeTrains(data)
@@ -25,30 +26,30 @@ def run():
                 spikes = pu.GetSpikeTrain(data, channel=channel, unit=unit)
                 print "found %d spikes in unit %c. last 5 spikes are:" %(len(spikes),unit)
                 for timestamp in spikes[-5:]:
-                    print "spike:DSP%d%c t=%f" % (channel, unit, timestamp)
+                    print "spike:DSP%d%c t=%f" % (channel, unit, timestamp/frequency)
         
         bit_2_events = pu.GetExtEvents(data, event='unstrobed_bit', bit=2)
         bit_3_events = pu.GetExtEvents(data, event='unstrobed_bit', bit=3)
         print "found %d bit 2 events. Last 5 events are:" %(len(bit_2_events))
         for timestamp in bit_2_events[-5:]:
-            print "unstrobed bit 2 t=%f" % timestamp
+            print "unstrobed bit 2 t=%f" % (timestamp/frequency)
         print "found %d bit 3 events. Last 5 events are:" %(len(bit_3_events))
         for timestamp in bit_3_events[-5:]:
-            print "unstrobed bit 3 t=%f" % timestamp
+            print "unstrobed bit 3 t=%f" % (timestamp/frequency)
         
         unstrobed_word = pu.GetExtEvents(data, event='unstrobed_word', online=False)
         print "found %d unstrobed word events in which 10 events are:" %(len(unstrobed_word['value']))
         indices = np.arange(0,len(unstrobed_word['value']),len(unstrobed_word['value'])/10)
         for value,timestamp in zip(unstrobed_word['value'][indices],unstrobed_word['timestamp'][indices]) :
             binary_value = bin(value)
-            print "unstrobed word:%s t=%f" % (binary_value,timestamp)
+            print "unstrobed word:%s t=%f" % (binary_value,timestamp/frequency)
 
 if __name__ == "__main__":
         #run()
         profile = LineProfiler()
         profile.add_function(run)
         profile.add_function(PlexUtil.GetExtEvents)
-        profile.add_function(reconstruct_word)
+        profile.add_function(UnstrobedWordDecoder.decode)
         profile.run('run()')
         profile.print_stats()
         profile.dump_stats("testPlexFile_profile.lprof")
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Compare parallel and serial parsing of plx files
+###########################################################
+
+import os
+import ctypes
+import tempfile
+import unittest
+import numpy as np
+from SpikeRecord.Plexon import PlexIndex
+import PlexFile as PlexFileModule
+from PlexFile import PlexFile, PL_FileHeader, PL_ChanHeader, PL_EventHeader, PL_SlowChannelHeader
+
+BLOCK_HEADER = '<i2,<u2,<u4,<i2,<i2,<i2,<i2'
+
+def write_synthetic_plx(filename, blocks, seed=0, points=32, truncate=0, corrupt_at=None):
+    """
+    Write a plx file of randomly interleaved spikes, events and A/D blocks.
+    """
+    rng = np.random.RandomState(seed)
+    file_header = PL_FileHeader()
+    file_header.MagicNumber = 0x58454c50
+    file_header.Version = 106
+    file_header.ADFrequency = 40000
+    file_header.NumDSPChannels = 4
+    file_header.NumEventChannels = 3
+    file_header.NumSlowChannels = 2
+    file_header.NumPointsWave = points
+    data = []
+    timestamp = 0
+    for i in xrange(blocks):
+        timestamp += rng.randint(0, 300)
+        kind = rng.rand()
+        if kind < 0.7:
+            header = (1, 0, timestamp, rng.randint(1, 5), rng.randint(0, 4), 1, points)
+            waveform = rng.randint(-2048, 2048, points)
+        elif kind < 0.95:
+            header = (4, 0, timestamp, rng.choice([2, 3, 4, 257]), rng.randint(0, 1<<15), 0, 0)
+            waveform = []
+        else:
+            words = rng.randint(1, 256)
+            header = (5, 0, timestamp, rng.randint(0, 2), 0, 1, words)
+            waveform = rng.randint(-2048, 2048, words)
+        if i == corrupt_at:
+            header = header[:5] + (-1, points)
+        data.append(np.array([header], dtype=BLOCK_HEADER).tostring())
+        data.append(np.array(waveform, dtype='<i2').tostring())
+    data = ''.join(data)
+    with open(filename, 'wb') as plx_file:
+        plx_file.write(bytearray(file_header))
+        for channel in xrange(file_header.NumDSPChannels):
+            header = PL_ChanHeader()
+            header.Channel = channel + 1
+            plx_file.write(bytearray(header))
+        for channel in xrange(file_header.NumEventChannels):
+            header = PL_EventHeader()
+            header.Channel = channel + 1
+            plx_file.write(bytearray(header))
+        for channel in xrange(file_header.NumSlowChannels):
+            header = PL_SlowChannelHeader()
+            header.Channel = channel
+            plx_file.write(bytearray(header))
+        plx_file.write(data[:len(data) - truncate])
+
+class TestParallelParsing(unittest.TestCase):
+    def setUp(self):
+        self.min_range = PlexFileModule.PARALLEL_MIN_RANGE
+        PlexFileModule.PARALLEL_MIN_RANGE = 1<<12
+        handle, self.filename = tempfile.mkstemp(suffix='.plx')
+        os.close(handle)
+
+    def tearDown(self):
+        PlexFileModule.PARALLEL_MIN_RANGE = self.min_range
+        os.remove(self.filename)
+
+    def assert_same_parsing(self, workers):
+        serial = PlexFile(self.filename).get_block_index()
+        parallel = PlexFile(self.filename, workers=workers).get_block_index()
+        self.assertTrue(np.array_equal(serial, parallel))
+        serial = PlexFile(self.filename).GetTimeStampArrays()
+        parallel = PlexFile(self.filename, workers=workers).GetTimeStampArrays()
+        for key in serial:
+            self.assertTrue(np.array_equal(serial[key], parallel[key]))
+
+    def test_synthetic_files(self):
+        for seed in xrange(3):
+            write_synthetic_plx(self.filename, 20000, seed=seed)
+            for workers in (2, 3, 8):
+                self.assert_same_parsing(workers)
+
+    def test_parallel_parsing_is_used(self):
+        write_synthetic_plx(self.filename, 20000)
+        pf = PlexFile(self.filename, workers=4)
+        self.assertIsNotNone(pf._build_block_index_parallel())
+
+    def test_truncated_file(self):
+        write_synthetic_plx(self.filename, 20000, truncate=21)
+        self.assert_same_parsing(4)
+
+    def test_corrupted_block_falls_back_to_serial(self):
+        write_synthetic_plx(self.filename, 20000, corrupt_at=12000)
+        pf = PlexFile(self.filename, workers=4)
+        self.assertIsNone(pf._build_block_index_parallel())
+        self.assert_same_parsing(4)
+
+    def test_resync_on_block_boundary(self):
+        write_synthetic_plx(self.filename, 2000)
+        pf = PlexFile(self.filename)
+        offsets = pf.get_block_index()['Offset']
+        for offset in offsets[100:200]:
+            self.assertEqual(pf.find_block_boundary(int(offset) - 1, len(pf._get_mmap())), offset)
+
+    def test_small_file_is_parsed_serially(self):
+        write_synthetic_plx(self.filename, 10)
+        self.assertIsNone(PlexFile(self.filename, workers=4)._build_block_index_parallel())
+        self.assert_same_parsing(4)
+
+class TestChunkedIndexCache(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.plx')
+        os.close(handle)
+        write_synthetic_plx(self.filename, 5000)
+
+    def tearDown(self):
+        for path in (self.filename, PlexIndex.index_path(self.filename)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_chunked_read_saves_index(self):
+        chunks = list(PlexFile(self.filename, index_cache=True).iter_block_chunks(1000))
+        self.assertTrue(os.path.exists(PlexIndex.index_path(self.filename)))
+        pf = PlexFile(self.filename, index_cache=True)
+        cached = list(pf.iter_block_chunks(1000))
+        self.assertTrue(isinstance(pf.block_index, np.memmap))
+        self.assertTrue(np.array_equal(np.concatenate(chunks), np.concatenate(cached)))
+        self.assertTrue(np.array_equal(np.concatenate(cached), PlexFile(self.filename).get_block_index()))
+
+    def test_chunked_read_without_cache(self):
+        list(PlexFile(self.filename).iter_block_chunks(1000))
+        self.assertFalse(os.path.exists(PlexIndex.index_path(self.filename)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Fan out the events of a client through PlexHub
+###########################################################
+
+import gc
+import unittest
+import numpy as np
+from PlexHub import PlexHub
+
+class FakeClient(object):
+    """
+    Client returning the events queued with acquire, whose acquisition thread is only
+    counted.
+    """
+    def __init__(self):
+        self.pending = []
+        self.next_tick = 0
+        self.acquiring = False
+        self.starts = 0
+        self.stops = 0
+    def acquire(self, count):
+        ticks = np.arange(self.next_tick, self.next_tick + count, dtype=np.int64)
+        self.next_tick += count
+        self.pending.append(ticks)
+    def StartAcquisition(self):
+        self.acquiring = True
+        self.starts += 1
+    def StopAcquisition(self):
+        self.acquiring = False
+        self.stops += 1
+        self.pending = []
+    def GetTimeStampFrequency(self):
+        return 40000
+    def GetTimeStampArrays(self):
+        ticks = np.concatenate(self.pending) if self.pending else np.empty(0, dtype=np.int64)
+        self.pending = []
+        count = len(ticks)
+        return {'type':np.ones(count, dtype=np.uint16), 'channel':np.ones(count, dtype=np.uint16),
+                'unit':np.ones(count, dtype=np.uint16), 'timestamp':ticks}
+
+class TestPlexHub(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.hub = PlexHub(self.client, acquire=True)
+
+    def test_subscriber_skips_earlier_events(self):
+        first = self.hub.subscribe()
+        self.client.acquire(5)
+        self.assertEqual(list(first.GetTimeStampArrays()['timestamp']), range(5))
+        self.client.acquire(3)
+        second = self.hub.subscribe()
+        self.client.acquire(2)
+        self.assertEqual(list(second.GetTimeStampArrays()['timestamp']), [8, 9])
+        self.assertEqual(list(first.GetTimeStampArrays()['timestamp']), range(5, 10))
+        self.assertEqual(len(second.GetTimeStampArrays()['timestamp']), 0)
+
+    def test_batches_are_released(self):
+        first = self.hub.subscribe()
+        second = self.hub.subscribe()
+        for count in (4, 6):
+            self.client.acquire(count)
+            first.GetTimeStampArrays()
+        self.assertEqual(len(self.hub.batches), 2)
+        second.GetTimeStampArrays()
+        self.assertEqual(len(self.hub.batches), 0)
+
+    def test_acquisition_follows_subscribers(self):
+        subscriber = self.hub.subscribe()
+        self.assertTrue(self.client.acquiring)
+        self.client.acquire(5)
+        subscriber.GetTimeStampArrays()
+        self.client.acquire(5)
+        del subscriber
+        gc.collect()
+        # nothing is held or acquired without subscribers
+        self.assertFalse(self.client.acquiring)
+        self.assertEqual(len(self.hub.subscribers), 0)
+        self.assertEqual(len(self.hub.batches), 0)
+        subscriber = self.hub.subscribe()
+        self.assertTrue(self.client.acquiring)
+        self.assertEqual(len(subscriber.GetTimeStampArrays()['timestamp']), 0)
+        subscriber.CloseClient()
+        self.assertFalse(self.client.acquiring)
+        self.assertEqual((self.client.starts, self.client.stops), (2, 2))
+
+if __name__ == "__main__":
+    unittest.main()
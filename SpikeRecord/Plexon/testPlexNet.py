@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Stream a replayed plx file through PlexNet
+###########################################################
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import numpy as np
+import PlexNet
+from PlexNet import PlexPublisher, PlexSubscriber
+from PlexFile import PlexFile
+from PlexReplay import PlexReplayClient
+from PlexWriter import SyntheticRecording
+
+class TestPlexNet(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'replay.plx')
+        self.address = os.path.join(self.directory, 'plexnet.sock')
+        SyntheticRecording(seed=1).write(self.filename, duration=20)
+        self.events = PlexFile(self.filename).GetTimeStampArrays()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def receive_all(self, subscriber, replay, during=None):
+        parts = []
+        while not replay.is_finished() or sum(len(part['timestamp']) for part in parts) < len(self.events['timestamp']):
+            time.sleep(0.05)
+            parts.append(subscriber.GetTimeStampArrays())
+            if during is not None:
+                during(len(parts))
+            if len(parts) > 1000:
+                break
+        return parts
+
+    def assert_same_events(self, parts):
+        for key in self.events:
+            self.assertTrue(np.array_equal(np.concatenate([part[key] for part in parts]), self.events[key]))
+
+    def test_stream(self):
+        replay = PlexReplayClient(self.filename, speed=20)
+        replay.InitClient()
+        with PlexPublisher(replay, self.address, interval=0.01):
+            with PlexSubscriber(self.address, sequence=0, reconnect_interval=0.1) as subscriber:
+                self.assertEqual(subscriber.GetTimeStampFrequency(), 40000)
+                parts = self.receive_all(subscriber, replay)
+        self.assert_same_events(parts)
+        self.assertEqual(subscriber.stats['lost_frames'], 0)
+
+    def test_reconnect(self):
+        replay = PlexReplayClient(self.filename, speed=20)
+        replay.InitClient()
+        with PlexPublisher(replay, self.address, interval=0.01):
+            with PlexSubscriber(self.address, sequence=0, reconnect_interval=0.1) as subscriber:
+                def drop_connection(reads):
+                    if reads % 5 == 0 and subscriber.sock is not None:
+                        subscriber.sock.shutdown(socket.SHUT_RDWR)
+                parts = self.receive_all(subscriber, replay, drop_connection)
+        self.assert_same_events(parts)
+        self.assertTrue(subscriber.stats['reconnects'] > 0)
+        self.assertEqual(subscriber.stats['lost_frames'], 0)
+
+    def test_slow_subscriber_is_dropped(self):
+        replay = PlexReplayClient(self.filename)
+        replay.InitClient()
+        publisher = PlexPublisher(replay, self.address, interval=3600)
+        with publisher:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address)
+            sock.sendall(PlexNet.REQUEST.pack(PlexNet.REQUEST_MAGIC, PlexNet.NEW_STREAM))
+            while not publisher.connections:
+                time.sleep(0.01)
+            # the subscriber never reads so the socket buffers and then its queue fill up
+            for _i in xrange(PlexNet.MAX_PENDING_FRAMES * 4):
+                publisher.publish(self.events)
+            sock.close()
+        self.assertEqual(publisher.stats['dropped_subscribers'], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+#coding:utf-8
+
+###########################################################
+### Compare and benchmark the unstrobed word reconstructions
+###########################################################
+
+"""
+Usage: python testUnstrobedWord.py              run the tests
+       python testUnstrobedWord.py benchmark    time the reconstructions
+"""
+
+import sys
+import time
+import unittest
+import numpy as np
+from PlexUtil import PlexUtil, UnstrobedWordDecoder, reconstruct_words, reconstruct_event_words
+from SpikeRecord import Plexon
+
+WORD_BITS = 32
+
+def reconstruct_word_in_python(WORD_BITS,bits_num,unstrobed_bits,words_buffer,timestamps_buffer):
+    bits_indices = np.array([0]*WORD_BITS)
+    oldest_timestamps = np.array([unstrobed_bits[bit][0] for bit in xrange(WORD_BITS)])
+    # synonyms
+    bits_num = bits_num
+    unstrobed_bits = unstrobed_bits
+    words_buffer = words_buffer
+    timestamps_buffer = timestamps_buffer
+    
+    where = np.where
+    left_shift = np.left_shift
+    timestamps_min = oldest_timestamps.min
+    
+    words_count = 0
+    indices_sum = 0
+    while indices_sum < bits_num:
+        timestamp = timestamps_min()
+        word_bits = where(oldest_timestamps==timestamp)[0]
+        # construct word from bits
+        word = left_shift(1,word_bits).sum()
+        # increment the indices of previous word bits
+        bits_indices[word_bits] += 1
+        # increment indices sum so that the loop will run until all bits are processed
+        indices_sum += word_bits.size
+        # update oldest timestamp of previous word bits
+        oldest_timestamps[word_bits] = unstrobed_bits[word_bits,bits_indices[word_bits]]
+        # fill word and timestamp in buffers
+        words_buffer[words_count] = word
+        timestamps_buffer[words_count] = timestamp
+        words_count += 1
+    return words_count
+
+# reconstruct_word merges the bit streams one word at a time as PlexUtil did before it 
+# was vectorized. It is the reference of the tests and the benchmark.
+try:
+    import _unstrobed_word
+    reconstruct_word = _unstrobed_word.reconstruct_word_32
+except ImportError or ValueError:
+    reconstruct_word = reconstruct_word_in_python
+
+# float32 represents every integer below 2**24 exactly
+FLOAT32_EXACT_BITS = 24
+
+def reconstruct_period_words(WORD_BITS,unstrobed_bits_list):
+    infinity = float('inf')
+    # add an additional infinity in array end so that index of unstrobed_bits will not get out of range
+    bits_length = [len(unstrobed_bits_list[bit]) for bit in xrange(WORD_BITS)] # actural bits length
+    max_length = max(bits_length)
+    bits_num = sum(bits_length)
+    # make 2d array of timestamp 
+    unstrobed_bits = np.array([np.append(unstrobed_bits_list[bit], [infinity]*(max_length-bits_length[bit]+1)) \
+                               for bit in xrange(WORD_BITS)],dtype=np.float32)
+    # create numpy buffer to hold words and timestamps
+    words_buffer = np.empty(bits_num,dtype=np.int32)
+    timestamps_buffer = np.empty(bits_num,dtype=np.float32)
+    
+    words_count = reconstruct_word(WORD_BITS,bits_num,unstrobed_bits,words_buffer,timestamps_buffer)
+    return words_buffer[:words_count], timestamps_buffer[:words_count]
+
+def reconstruct_words_merged(WORD_BITS,unstrobed_bits_list):
+    """
+    reconstruct_words_merged(WORD_BITS,unstrobed_bits_list) -> (words, timestamps)
+    
+    reconstruct_words with reconstruct_word merging the bit streams. 
+    reconstruct_word works on float32 timestamps which are only exact below 2**24 ticks,
+    i.e. about 7 minutes at 40 kHz. So the ticks are made relative to the first bit and 
+    the bits are processed in periods of 2**24 ticks. All bits of a word have the same
+    timestamp thus no word is split between two periods.
+    """
+    all_bits = np.concatenate(unstrobed_bits_list)
+    if len(all_bits) == 0:
+        return np.empty(0,dtype=np.int32), np.empty(0,dtype=np.int64)
+    base = all_bits.min()
+    bits_periods = [(bits - base) >> FLOAT32_EXACT_BITS for bits in unstrobed_bits_list]
+    words_list = []
+    timestamps_list = []
+    for period in np.unique((all_bits - base) >> FLOAT32_EXACT_BITS):
+        period_base = base + (period << FLOAT32_EXACT_BITS)
+        period_bits_list = [bits[periods == period] - period_base for bits,periods in zip(unstrobed_bits_list,bits_periods)]
+        words, timestamps = reconstruct_period_words(WORD_BITS,period_bits_list)
+        words_list.append(words)
+        timestamps_list.append(timestamps.astype(np.int64) + period_base)
+    return np.concatenate(words_list), np.concatenate(timestamps_list)
+
+def make_unstrobed_events(words, seed=0, max_interval=400, start=0, repeats=0):
+    """
+    Timestamp arrays of unstrobed words with random values and intervals. repeats words
+    have a bit repeated at the timestamp of the previous word.
+    """
+    rng = np.random.RandomState(seed)
+    values = rng.randint(1, 1<<WORD_BITS, words).astype(np.int64)
+    ticks = start + np.cumsum(rng.randint(1, max_interval, words)).astype(np.int64)
+    repeated = rng.choice(words - 1, repeats, replace=False) + 1 if repeats else []
+    ticks[repeated] = ticks[np.asarray(repeated, dtype=int) - 1]
+    bits = (values[:,np.newaxis] >> np.arange(WORD_BITS)) & 1
+    channel = np.nonzero(bits)[1] + 1
+    timestamp = np.repeat(ticks, bits.sum(axis=1))
+    order = np.argsort(timestamp, kind='mergesort')
+    count = len(timestamp)
+    return {'type':np.repeat(np.uint16(Plexon.PL_ExtEventType), count),
+            'channel':channel[order].astype(np.uint16),
+            'unit':np.zeros(count, dtype=np.uint16),
+            'timestamp':timestamp[order]}
+
+def make_jittered_events(words, jitter, seed=0, min_interval=20, max_interval=400):
+    """
+    Timestamp arrays of unstrobed words whose bit events are up to jitter ticks after the
+    word. Returns the arrays, the values and the timestamps of the first bits.
+    """
+    rng = np.random.RandomState(seed)
+    values = rng.randint(1, 1<<WORD_BITS, words).astype(np.int64)
+    ticks = np.cumsum(rng.randint(min_interval, max_interval, words)).astype(np.int64)
+    bits = (values[:,np.newaxis] >> np.arange(WORD_BITS)) & 1
+    channel = np.nonzero(bits)[1] + 1
+    timestamp = np.repeat(ticks, bits.sum(axis=1)) + rng.randint(0, jitter + 1, len(channel))
+    first_bits = np.minimum.reduceat(timestamp, np.append(0, np.cumsum(bits.sum(axis=1))[:-1]))
+    order = np.argsort(timestamp, kind='mergesort')
+    count = len(timestamp)
+    return {'type':np.repeat(np.uint16(Plexon.PL_ExtEventType), count),
+            'channel':channel[order].astype(np.uint16),
+            'unit':np.zeros(count, dtype=np.uint16),
+            'timestamp':timestamp[order]}, values, first_bits
+
+def get_bits_list(data):
+    return [data['timestamp'][data['channel'] == bit + 1] for bit in xrange(WORD_BITS)]
+
+def reconstruct_event_words_merged(WORD_BITS, channel, timestamp):
+    return reconstruct_words_merged(WORD_BITS, [timestamp[channel == bit + 1] for bit in xrange(WORD_BITS)])
+
+def slice_data(data, begin, end):
+    return dict((key, value[begin:end]) for key, value in data.iteritems())
+
+def split_data(data, chunks, seed=0):
+    cuts = np.sort(np.random.RandomState(seed).randint(0, len(data['timestamp']), chunks - 1))
+    return [slice_data(data, begin, end) for begin, end in zip(np.append(0, cuts), np.append(cuts, len(data['timestamp'])))]
+
+def carry_over_words(chunks):
+    """
+    Words of successive reads with the last word of a read carried to the next read as
+    PlexUtil did before UnstrobedWordDecoder.
+    """
+    last_word = None
+    last_timestamp = None
+    for index, chunk in enumerate(chunks):
+        online = index < len(chunks) - 1
+        words, timestamps = reconstruct_event_words_merged(WORD_BITS, chunk['channel'], chunk['timestamp'])
+        if len(timestamps) and last_timestamp == timestamps[0]:
+            words[0] += last_word
+        elif last_word is not None:
+            words = np.append(last_word, words)
+            timestamps = np.append(last_timestamp, timestamps)
+            if len(timestamps)==1:
+                last_word = None
+                last_timestamp = None
+                yield words, timestamps
+                continue
+        if online:
+            if len(timestamps):
+                last_word = words[-1]
+                last_timestamp = timestamps[-1]
+            yield words[:-1], timestamps[:-1]
+        else:
+            yield words, timestamps
+
+class TestUnstrobedWord(unittest.TestCase):
+    def assert_same_arrays(self, arrays, expected_arrays):
+        for array, expected in zip(arrays, expected_arrays):
+            self.assertEqual(array.dtype, expected.dtype)
+            self.assertTrue(np.array_equal(array, expected))
+
+    def assert_same_words(self, data):
+        bits_list = get_bits_list(data)
+        merged = reconstruct_words_merged(WORD_BITS, bits_list)
+        self.assert_same_arrays(reconstruct_words(WORD_BITS, bits_list), merged)
+        self.assert_same_arrays(reconstruct_event_words(WORD_BITS, data['channel'], data['timestamp']), merged)
+
+    def test_random_words(self):
+        for seed in xrange(3):
+            self.assert_same_words(make_unstrobed_events(2000, seed))
+
+    def test_long_recording(self):
+        # the words span several float32 periods and the 32-bit timestamp roll over
+        self.assert_same_words(make_unstrobed_events(3000, max_interval=1<<16, start=(1<<32) - (1<<26)))
+
+    def test_repeated_bits(self):
+        self.assert_same_words(make_unstrobed_events(2000, repeats=100))
+
+    def test_unordered_events(self):
+        data = make_unstrobed_events(2000, seed=5, repeats=20)
+        # the events are grouped by bit, the events of each bit stay in time order
+        order = np.argsort(data['channel'], kind='mergesort')
+        self.assert_same_words(slice_data(dict((key, value[order]) for key, value in data.iteritems()), 0, None))
+
+    def test_empty(self):
+        self.assert_same_words(slice_data(make_unstrobed_events(10), 0, 0))
+        data = make_unstrobed_events(1)
+        data['channel'][:] = WORD_BITS
+        self.assert_same_words(slice_data(data, 0, 1))
+
+    def test_online_carry_over(self):
+        chunks = split_data(make_unstrobed_events(3000, seed=4), 41, seed=4)
+        pu = PlexUtil()
+        for index, expected in enumerate(carry_over_words(chunks)):
+            words = pu.GetExtEvents(chunks[index], event='unstrobed_word', online=index < len(chunks) - 1)
+            self.assert_same_arrays((words['value'], words['timestamp']), expected)
+            if index == 20:
+                # an empty read keeps the held word
+                words = pu.GetExtEvents(slice_data(chunks[index], 0, 0), event='unstrobed_word')
+                self.assertEqual(len(words['value']), 0)
+
+    def decode_chunks(self, decoder, chunks):
+        decoded = [decoder.decode(chunk['channel'], chunk['timestamp']) for chunk in chunks] + [decoder.flush()]
+        return np.concatenate([words for words, _timestamps in decoded]), \
+               np.concatenate([timestamps for _words, timestamps in decoded])
+
+    def test_jittered_words(self):
+        data, values, first_bits = make_jittered_events(3000, jitter=2, seed=6)
+        decoder = UnstrobedWordDecoder(window=2)
+        words, timestamps = self.decode_chunks(decoder, split_data(data, 50, seed=6))
+        self.assertTrue(np.array_equal(words.view(np.uint32), values))
+        self.assertTrue(np.array_equal(timestamps, first_bits))
+        self.assertEqual(decoder.stats['words'], 3000)
+        self.assertTrue(decoder.stats['merged_words'] > 0)
+        self.assertEqual(decoder.stats['split_words'], 0)
+        self.assertTrue(decoder.stats['max_spread'] <= 2)
+        # exact timestamps split the jittered words
+        exact = UnstrobedWordDecoder()
+        self.decode_chunks(exact, split_data(data, 50, seed=6))
+        self.assertTrue(exact.stats['words'] > 3000)
+        self.assertEqual(exact.stats['merged_words'], 0)
+
+    def test_repeated_bit_in_window(self):
+        channel = np.array([1, 2, 1, 3, 5], dtype=np.uint16)
+        timestamp = np.array([100, 101, 102, 102, 200], dtype=np.int64)
+        decoder = UnstrobedWordDecoder(window=2)
+        words, timestamps = decoder.decode(channel, timestamp)
+        # the second occurrence of bit 0 starts the second word as in reconstruct_word
+        self.assertEqual(list(words), [0b111, 0b001])
+        self.assertEqual(list(timestamps), [100, 102])
+        self.assertEqual(decoder.stats['split_words'], 1)
+        # the word on channel 5 is held until its window is closed
+        words, timestamps = decoder.decode(channel[:0], timestamp[:0])
+        self.assertEqual(len(words), 0)
+        words, timestamps = decoder.flush()
+        self.assertEqual(list(words), [0b10000])
+        self.assertEqual(list(timestamps), [200])
+
+    def test_word_across_three_reads(self):
+        decoder = UnstrobedWordDecoder(window=5)
+        reads = [(np.array([1], dtype=np.uint16), np.array([100], dtype=np.int64), 100),
+                 # the middle read has no bit events, its latest event is within the window
+                 (np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.int64), 103),
+                 (np.array([2, 3], dtype=np.uint16), np.array([104, 300], dtype=np.int64), 301)]
+        decoded = [decoder.decode(channel, timestamp, latest=latest) for channel, timestamp, latest in reads]
+        self.assertEqual([len(words) for words, _timestamps in decoded], [0, 0, 1])
+        self.assertEqual(list(decoded[2][0]), [0b011])
+        self.assertEqual(list(decoded[2][1]), [100])
+        self.assertEqual(decoder.stats['split_words'], 0)
+        # an event of any type past the window completes the held word
+        words, timestamps = decoder.decode(np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.int64), latest=306)
+        self.assertEqual(list(words), [0b100])
+        self.assertEqual(list(timestamps), [300])
+
+def benchmark():
+    kernel = 'C extension' if reconstruct_word is not reconstruct_word_in_python else 'Python loop'
+    for words in (1000, 10000, 100000):
+        data = make_unstrobed_events(words)
+        timings = []
+        for reconstruct in (reconstruct_event_words, reconstruct_event_words_merged):
+            repeats = 1 if reconstruct is reconstruct_event_words_merged and kernel == 'Python loop' else 5
+            start = time.time()
+            for _i in xrange(repeats):
+                reconstruct(WORD_BITS, data['channel'], data['timestamp'])
+            timings.append((time.time() - start) / repeats * 1000)
+        print '%6d words: vectorized %8.2f ms, %s %8.2f ms, speedup %.1fx' \
+              %(words, timings[0], kernel, timings[1], timings[1] / timings[0])
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        unittest.main()